@@ -9,6 +9,7 @@ from tqdm import tqdm
 ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(ROOT)
 
+from chatdev.statistics import load_usage, summarize_usage
 from run_all import D4J
 
 N_PHASES = {"Default": 6,
@@ -86,21 +87,26 @@ def get_metrics(project, bug_id, result_dict, res_file, test_failure_file):
     
     return result_dict
 
-def get_post_info(project, bug_id, result_dict, info_files):
+def get_post_info(project, bug_id, result_dict, info_files, ledger_files=()):
     cost = 0
     total_tokens = 0
     time = 0
     
+    # the cost and tokens are summed up from the usage ledgers, older results only have the post info
+    usage = summarize_usage(load_usage(ledger_files))
     for info_file in info_files:
         with open(info_file, "r") as f:
             lines = f.readlines()
             for line in lines:
-                if line.startswith("**cost**"):
+                if line.startswith("**cost**") and not ledger_files:
                     cost += float(line.split("$")[1].rstrip())
-                elif line.startswith("**num_total_tokens**"):
+                elif line.startswith("**num_total_tokens**") and not ledger_files:
                     total_tokens += int(line.split("=")[1].rstrip())
                 elif line.startswith("**duration**"):
                     time += float(line.split("=")[1].rstrip("s\n"))
+    if ledger_files:
+        cost = usage["cost"]
+        total_tokens = usage["num_total_tokens"]
     
     result_dict[project][bug_id].update({"cost": cost,
                                          "total_tokens": total_tokens,
@@ -158,6 +164,10 @@ def main(res_dir, config):
         for file in os.listdir(bug_res_dir):
             if file.startswith("post_info") and os.path.isfile(os.path.join(bug_res_dir, file)):
                 info_files.append(os.path.join(bug_res_dir, file))
+        log_dir = os.path.join(bug_res_dir, "log")
+        ledger_files = []
+        if os.path.isdir(log_dir):
+            ledger_files = [os.path.join(log_dir, file) for file in os.listdir(log_dir) if file.endswith(".usage.jsonl")]
         
         # Get metrics
         test_failure_file = os.path.join(ROOT, 'cache', bug_res, "test_failure.pkl")
@@ -166,7 +176,7 @@ def main(res_dir, config):
         result_dict = get_metrics(project, bug_id, result_dict, res_file, test_failure_file)
         
         # Get post info
-        result_dict = get_post_info(project, bug_id, result_dict, info_files)
+        result_dict = get_post_info(project, bug_id, result_dict, info_files, ledger_files)
     
     # Save to csv
     save_to_csv(result_dict, d4j_version)
@@ -0,0 +1,140 @@
+"""
+Microbenchmark of the per-turn overhead of the CAMEL message objects, before and after the slotted messages
+
+A turn of a phase builds the first user message of the chat, copies it into the history of the user agent,
+converts the history of the assistant into OpenAI messages, counts their tokens and reads the fields of the
+messages for the logs. The model is left out, only the message objects and the token counting are measured.
+The baseline is the former message representation: an unslotted dataclass which lists the string methods on
+every attribute access, a deepcopy of the first message and a token count of every message in every turn.
+
+usage: python3 benchmarks/bench_messages.py [--turns 2000] [--history 6]
+"""
+import argparse
+import copy
+import dataclasses
+import os
+import sys
+import time
+from typing import Any, Dict, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+from camel.messages import AssistantChatMessage, SystemMessage, UserChatMessage
+from camel.typing import ModelType, RoleType
+from camel.utils import count_tokens_openai_message
+
+PROMPT = "\n".join(["The test `testFoo` fails with the following stack trace:"] +
+                   ["    at org.example.Foo.bar(Foo.java:{})".format(i) for i in range(200)])
+MODEL = ModelType.GPT_3_5_TURBO
+
+
+@dataclasses.dataclass
+class BaselineMessage:
+    # the former BaseMessage, reduced to the parts used by a turn
+    role_name: str
+    role_type: Optional[RoleType]
+    meta_dict: Optional[Dict[str, str]]
+    role: str
+    content: str
+
+    def __getattribute__(self, name: str) -> Any:
+        delegate_methods = [
+            method for method in dir(str) if not method.startswith('_')
+        ]
+        if name in delegate_methods:
+            content = super().__getattribute__('content')
+            if isinstance(content, str):
+                content_method = getattr(content, name, None)
+                if callable(content_method):
+
+                    def wrapper(*args: Any, **kwargs: Any) -> Any:
+                        output = content_method(*args, **kwargs)
+                        return self._create_new_instance(output) if isinstance(output, str) else output
+
+                    return wrapper
+        return super().__getattribute__(name)
+
+    def _create_new_instance(self, content: str) -> "BaselineMessage":
+        return self.__class__(role_name=self.role_name, role_type=self.role_type,
+                              meta_dict=self.meta_dict, role=self.role, content=content)
+
+    def to_openai_message(self, role: Optional[str] = None) -> Dict[str, str]:
+        role = role or self.role
+        if role not in {"system", "user", "assistant"}:
+            raise ValueError(f"Unrecognized role: {role}")
+        return {"role": role, "content": self.content}
+
+    def num_openai_tokens(self, model: ModelType, role: Optional[str] = None) -> int:
+        return count_tokens_openai_message(self.to_openai_message(role), model.value_for_tiktoken)
+
+
+def baseline_messages(history_len):
+    system_msg = BaselineMessage(role_name="Software Architect", role_type=RoleType.ASSISTANT, meta_dict=None,
+                                 role="system", content=PROMPT)
+    history = [BaselineMessage(role_name="Software Architect", role_type=RoleType.ASSISTANT, meta_dict=None,
+                               role="assistant", content=PROMPT) for _ in range(history_len)]
+
+    def user_message():
+        return BaselineMessage(role_name="Software Test Engineer", role_type=RoleType.USER, meta_dict=None,
+                               role="user", content=PROMPT)
+
+    def pseudo_message(user_msg):
+        # the copy of the first message kept by the user agent, as in the former RolePlaying.init_chat
+        pseudo_msg = copy.deepcopy(user_msg)
+        pseudo_msg.role = "assistant"
+        return pseudo_msg
+
+    return system_msg, history, user_message, pseudo_message
+
+
+def slotted_messages(history_len):
+    system_msg = SystemMessage(role_name="Software Architect", role_type=RoleType.ASSISTANT, content=PROMPT)
+    history = [AssistantChatMessage(role_name="Software Architect", content=PROMPT) for _ in range(history_len)]
+
+    def user_message():
+        return UserChatMessage(role_name="Software Test Engineer", role="user", content=PROMPT)
+
+    def pseudo_message(user_msg):
+        # the copy of the first message kept by the user agent, as in RolePlaying.init_chat
+        return dataclasses.replace(user_msg, role="assistant")
+
+    return system_msg, history, user_message, pseudo_message
+
+
+def turn(system_msg, history, user_message, pseudo_message):
+    user_msg = user_message()
+    pseudo_msg = pseudo_message(user_msg)
+    messages = [system_msg] + history + [user_msg]
+    openai_messages = [message.to_openai_message() for message in messages]
+    num_tokens = sum(message.num_openai_tokens(MODEL) for message in messages)
+    names = [(message.role_name, message.role, len(message.content)) for message in messages]
+    stripped = user_msg.strip().startswith("The test")
+    return pseudo_msg, openai_messages, num_tokens, names, stripped
+
+
+def measure(messages, turns):
+    for _ in range(10):
+        turn(*messages)
+    start = time.perf_counter()
+    for _ in range(turns):
+        turn(*messages)
+    return (time.perf_counter() - start) / turns * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmark of the CAMEL message objects")
+    parser.add_argument("--turns", type=int, default=2000, help="Number of turns")
+    parser.add_argument("--history", type=int, default=6, help="Number of messages in the history of a chat")
+    args = parser.parse_args()
+
+    baseline = measure(baseline_messages(args.history), args.turns)
+    slotted = measure(slotted_messages(args.history), args.turns)
+    print("{} turns, {} messages of history, us per turn:".format(args.turns, args.history))
+    print("  baseline (unslotted, dir(str) per access, deepcopy, uncached token count): {:.2f}".format(baseline))
+    print("  slotted (precomputed delegation, shallow copy, cached token count):       {:.2f}".format(slotted))
+    print("  speedup: {:.1f}x".format(baseline / slotted))
+
+
+if __name__ == "__main__":
+    main()
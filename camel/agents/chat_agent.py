@@ -12,7 +12,7 @@
 # limitations under the License.
 # =========== Copyright 2023 @ CAMEL-AI.org. All Rights Reserved. ===========
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 from openai.types.chat import ChatCompletion
 from tenacity import retry
@@ -21,14 +21,10 @@ from tenacity.wait import wait_exponential
 
 from camel.agents import BaseAgent
 from camel.configs import ChatGPTConfig
-from camel.messages import ChatMessage, MessageType, SystemMessage
+from camel.messages import ChatMessage, MessageType, OpenAIMessage, SystemMessage
 from camel.model_backend import ModelBackend, ModelFactory
 from camel.typing import ModelType, RoleType
-from camel.utils import (
-    get_model_token_limit,
-    num_tokens_from_messages,
-    openai_api_key_required,
-)
+from camel.utils import get_model_token_limit, openai_api_key_required
 
 
 @dataclass(frozen=True)
@@ -75,6 +71,16 @@ class ChatAgent(BaseAgent):
         message_window_size (int, optional): The maximum number of previous
             messages to include in the context window. If `None`, no windowing
             is performed. (default: :obj:`None`)
+        asynchronous (bool, optional): Whether to use a backend with a native
+            async client for :obj:`astep`. (default: :obj:`False`)
+        conclusion_pattern (str, optional): A regex of the answer expected from
+            the agent. With a streaming :obj:`model_config`, the generation
+            stops once the response matches it. (default: :obj:`None`)
+        latency_key (str, optional): The key the latency of the completions
+            is tracked under for hedging, e.g., the name of the phase.
+            (default: :obj:`None`)
+        call_info (Dict[str, Any], optional): The tags of the completions in
+            the usage ledger, e.g., the bug and the phase. (default: :obj:`None`)
     """
 
     def __init__(
@@ -83,6 +89,10 @@ class ChatAgent(BaseAgent):
             model: Optional[ModelType] = None,
             model_config: Optional[Any] = None,
             message_window_size: Optional[int] = None,
+            asynchronous: bool = False,
+            conclusion_pattern: Optional[str] = None,
+            latency_key: Optional[str] = None,
+            call_info: Optional[Dict[str, Any]] = None,
     ) -> None:
 
         self.system_message: SystemMessage = system_message
@@ -92,7 +102,11 @@ class ChatAgent(BaseAgent):
         self.model_config: ChatGPTConfig = model_config or ChatGPTConfig()
         self.model_token_limit: int = get_model_token_limit(self.model)
         self.message_window_size: Optional[int] = message_window_size
-        self.model_backend: ModelBackend = ModelFactory.create(self.model, self.model_config.__dict__)
+        self.model_backend: ModelBackend = ModelFactory.create(self.model, self.model_config.__dict__,
+                                                               asynchronous=asynchronous)
+        self.conclusion_pattern: Optional[str] = conclusion_pattern
+        self.latency_key: Optional[str] = latency_key
+        self.call_info: Optional[Dict[str, Any]] = call_info
         self.terminated: bool = False
         self.info: bool = False
         self.init_messages()
@@ -154,23 +168,9 @@ class ChatAgent(BaseAgent):
         self.stored_messages.append(message)
         return self.stored_messages
 
-    # @retry(wait=wait_exponential(min=5, max=60), stop=stop_after_attempt(5))
-    # @openai_api_key_required
-    def step(
-            self,
-            input_message: ChatMessage,
-    ) -> ChatAgentResponse:
-        r"""Performs a single step in the chat session by generating a response
-        to the input message.
-
-        Args:
-            input_message (ChatMessage): The input message to the agent.
-
-        Returns:
-            ChatAgentResponse: A struct
-                containing the output messages, a boolean indicating whether
-                the chat session has terminated, and information about the chat
-                session.
+    def _prepare_messages(self, input_message: ChatMessage) -> Tuple[List[OpenAIMessage], int]:
+        r"""Stores the input message and returns the messages to send in the
+        OpenAI format, together with their number of tokens.
         """
         messages = self.update_messages(input_message)
         if self.message_window_size is not None and len(
@@ -178,18 +178,25 @@ class ChatAgent(BaseAgent):
             messages = [self.system_message
                         ] + messages[-self.message_window_size:]
         openai_messages = [message.to_openai_message() for message in messages]
-        num_tokens = num_tokens_from_messages(openai_messages, self.model)
+        # the counts of the stored messages are cached, only new messages are encoded
+        num_tokens = sum(message.num_openai_tokens(self.model) for message in messages)
+        num_tokens += 2  # every reply is primed with <im_start>assistant
 
         # for openai_message in openai_messages:
         #     # print("{}\t{}".format(openai_message.role, openai_message.content))
         #     print("{}\t{}\t{}".format(openai_message["role"], hash(openai_message["content"]), openai_message["content"][:60].replace("\n", "")))
         # print()
 
+        return openai_messages, num_tokens
+
+    def _process_response(self, response: ChatCompletion, num_tokens: int) -> ChatAgentResponse:
+        r"""Converts the response of the backend to a :obj:`ChatAgentResponse`.
+        A response of None means that the token limit of the model is exceeded.
+        """
         output_messages: Optional[List[ChatMessage]]
         info: Dict[str, Any]
 
-        if num_tokens < self.model_token_limit:
-            response = self.model_backend.run(messages=openai_messages)
+        if response is not None:
             if not isinstance(response, ChatCompletion):
                 raise RuntimeError("OpenAI returned unexpected struct")
             output_messages = [
@@ -221,6 +228,58 @@ class ChatAgent(BaseAgent):
 
         return ChatAgentResponse(output_messages, self.terminated, info)
 
+    # @retry(wait=wait_exponential(min=5, max=60), stop=stop_after_attempt(5))
+    # @openai_api_key_required
+    def step(
+            self,
+            input_message: ChatMessage,
+    ) -> ChatAgentResponse:
+        r"""Performs a single step in the chat session by generating a response
+        to the input message.
+
+        Args:
+            input_message (ChatMessage): The input message to the agent.
+
+        Returns:
+            ChatAgentResponse: A struct
+                containing the output messages, a boolean indicating whether
+                the chat session has terminated, and information about the chat
+                session.
+        """
+        openai_messages, num_tokens = self._prepare_messages(input_message)
+        response = None
+        if num_tokens < self.model_token_limit:
+            response = self.model_backend.run(messages=openai_messages,
+                                              conclusion_pattern=self.conclusion_pattern,
+                                              latency_key=self.latency_key,
+                                              call_info=self.call_info)
+        return self._process_response(response, num_tokens)
+
+    async def astep(
+            self,
+            input_message: ChatMessage,
+    ) -> ChatAgentResponse:
+        r"""Awaitable variant of :obj:`step`, the completion is awaited on the
+        event loop instead of blocking the thread.
+
+        Args:
+            input_message (ChatMessage): The input message to the agent.
+
+        Returns:
+            ChatAgentResponse: A struct
+                containing the output messages, a boolean indicating whether
+                the chat session has terminated, and information about the chat
+                session.
+        """
+        openai_messages, num_tokens = self._prepare_messages(input_message)
+        response = None
+        if num_tokens < self.model_token_limit:
+            response = await self.model_backend.arun(messages=openai_messages,
+                                                     conclusion_pattern=self.conclusion_pattern,
+                                                     latency_key=self.latency_key,
+                                                     call_info=self.call_info)
+        return self._process_response(response, num_tokens)
+
     def __repr__(self) -> str:
         r"""Returns a string representation of the :obj:`ChatAgent`.
 
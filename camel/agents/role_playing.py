@@ -11,7 +11,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # =========== Copyright 2023 @ CAMEL-AI.org. All Rights Reserved. ===========
-import copy
+import dataclasses
 from typing import Dict, List, Optional, Sequence, Tuple
 
 from camel.agents import ChatAgent, TaskPlannerAgent, TaskSpecifyAgent
@@ -90,8 +90,8 @@ class RolePlaying:
             content=content
             # content here will be concatenated with assistant role prompt (because we mock user and send msg to assistant) in the ChatAgent.step
         )
-        pseudo_msg = copy.deepcopy(user_msg)
-        pseudo_msg.role = "assistant"
+        # a shallow copy, the fields are immutable and the prompt is shared
+        pseudo_msg = dataclasses.replace(user_msg, role="assistant")
         self.user_agent.update_messages(pseudo_msg)
 
         # here we concatenate to store the real message in the log
@@ -123,35 +123,39 @@ class RolePlaying:
 
         return processed_msg
 
-    def step(
+    def _process_assistant_response(
             self,
-            user_msg: ChatMessage,
+            assistant_response: ChatAgentResponse,
             assistant_only: bool,
-    ) -> Tuple[ChatAgentResponse, ChatAgentResponse]:
-        assert isinstance(user_msg, ChatMessage), print("broken user_msg: " + str(user_msg))
+    ) -> Tuple[Optional[Tuple[ChatAgentResponse, ChatAgentResponse]], Optional[ChatMessage]]:
+        r"""Processes the response of the assistant agent.
 
-        # print("assistant...")
-        user_msg_rst = user_msg.set_user_role_at_backend()
-        assistant_response = self.assistant_agent.step(user_msg_rst)
+        Returns:
+            A tuple of the final responses of the step (None if the user agent
+            should respond) and the processed assistant message.
+        """
         if assistant_response.terminated or assistant_response.msgs is None:
             return (
-                ChatAgentResponse([assistant_response.msgs], assistant_response.terminated, assistant_response.info),
-                ChatAgentResponse([], False, {}))
+                (ChatAgentResponse([assistant_response.msgs], assistant_response.terminated, assistant_response.info),
+                 ChatAgentResponse([], False, {})), None)
         assistant_msg = self.process_messages(assistant_response.msgs)
         if self.assistant_agent.info:
-            return (ChatAgentResponse([assistant_msg], assistant_response.terminated, assistant_response.info),
-                    ChatAgentResponse([], False, {}))
+            return ((ChatAgentResponse([assistant_msg], assistant_response.terminated, assistant_response.info),
+                     ChatAgentResponse([], False, {})), assistant_msg)
         self.assistant_agent.update_messages(assistant_msg)
 
         if assistant_only:
             return (
-                ChatAgentResponse([assistant_msg], assistant_response.terminated, assistant_response.info),
-                ChatAgentResponse([], False, {})
-            )
+                (ChatAgentResponse([assistant_msg], assistant_response.terminated, assistant_response.info),
+                 ChatAgentResponse([], False, {})), assistant_msg)
+        return None, assistant_msg
 
-        # print("user...")
-        assistant_msg_rst = assistant_msg.set_user_role_at_backend()
-        user_response = self.user_agent.step(assistant_msg_rst)
+    def _process_user_response(
+            self,
+            assistant_msg: ChatMessage,
+            assistant_response: ChatAgentResponse,
+            user_response: ChatAgentResponse,
+    ) -> Tuple[ChatAgentResponse, ChatAgentResponse]:
         if user_response.terminated or user_response.msgs is None:
             return (ChatAgentResponse([assistant_msg], assistant_response.terminated, assistant_response.info),
                     ChatAgentResponse([user_response], user_response.terminated, user_response.info))
@@ -165,3 +169,40 @@ class RolePlaying:
             ChatAgentResponse([assistant_msg], assistant_response.terminated, assistant_response.info),
             ChatAgentResponse([user_msg], user_response.terminated, user_response.info),
         )
+
+    def step(
+            self,
+            user_msg: ChatMessage,
+            assistant_only: bool,
+    ) -> Tuple[ChatAgentResponse, ChatAgentResponse]:
+        assert isinstance(user_msg, ChatMessage), print("broken user_msg: " + str(user_msg))
+
+        # print("assistant...")
+        user_msg_rst = user_msg.set_user_role_at_backend()
+        assistant_response = self.assistant_agent.step(user_msg_rst)
+        responses, assistant_msg = self._process_assistant_response(assistant_response, assistant_only)
+        if responses is not None:
+            return responses
+
+        # print("user...")
+        assistant_msg_rst = assistant_msg.set_user_role_at_backend()
+        user_response = self.user_agent.step(assistant_msg_rst)
+        return self._process_user_response(assistant_msg, assistant_response, user_response)
+
+    async def astep(
+            self,
+            user_msg: ChatMessage,
+            assistant_only: bool,
+    ) -> Tuple[ChatAgentResponse, ChatAgentResponse]:
+        r"""Awaitable variant of :obj:`step`."""
+        assert isinstance(user_msg, ChatMessage), print("broken user_msg: " + str(user_msg))
+
+        user_msg_rst = user_msg.set_user_role_at_backend()
+        assistant_response = await self.assistant_agent.astep(user_msg_rst)
+        responses, assistant_msg = self._process_assistant_response(assistant_response, assistant_only)
+        if responses is not None:
+            return responses
+
+        assistant_msg_rst = assistant_msg.set_user_role_at_backend()
+        user_response = await self.user_agent.astep(assistant_msg_rst)
+        return self._process_user_response(assistant_msg, assistant_response, user_response)
@@ -11,7 +11,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # =========== Copyright 2023 @ CAMEL-AI.org. All Rights Reserved. ===========
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 from typing import Any, Dict, List, Optional, Tuple, Union
 
 from camel.messages import (
@@ -25,6 +25,52 @@ from camel.prompts import CodePrompt, TextPrompt
 from camel.typing import ModelType, RoleType
 
 
+# the public string methods, delegated by the messages to their content
+STR_METHODS = frozenset(method for method in dir(str) if not method.startswith('_'))
+
+
+def slotted(cls):
+    r"""Class decorator rebuilding a dataclass with :obj:`__slots__` for its
+    fields, i.e., :obj:`dataclass(slots=True)` of Python 3.10 and later. The
+    fields inherited from a slotted base class keep the slots of the base.
+
+    Args:
+        cls (type): The dataclass.
+
+    Returns:
+        type: The slotted dataclass.
+    """
+    inherited = {name for base in cls.__mro__[1:] for name in getattr(base, "__slots__", ())}
+    names = [f.name for f in fields(cls)] + list(cls.__dict__.get("__extra_slots__", ()))
+    cls_dict = dict(cls.__dict__)
+    cls_dict["__slots__"] = tuple(name for name in names if name not in inherited)
+    for name in names:
+        # the defaults are kept by the generated __init__
+        cls_dict.pop(name, None)
+    cls_dict.pop("__dict__", None)
+    cls_dict.pop("__weakref__", None)
+    return type(cls)(cls.__name__, cls.__bases__, cls_dict)
+
+
+def _delegate_arg(arg: Any) -> Any:
+    r"""Replaces the messages in an argument of a delegated string method
+    with their content.
+
+    Args:
+        arg (Any): The argument value.
+
+    Returns:
+        Any: The modified argument value.
+    """
+    if isinstance(arg, BaseMessage):
+        return arg.content
+    elif isinstance(arg, (list, tuple)):
+        return type(arg)(_delegate_arg(item) for item in arg)
+    else:
+        return arg
+
+
+@slotted
 @dataclass
 class BaseMessage:
     r"""Base class for message objects used in CAMEL chat system.
@@ -44,42 +90,27 @@ class BaseMessage:
     meta_dict: Optional[Dict[str, str]]
     role: str
     content: str
+    # the token counts cached by num_openai_tokens
+    __extra_slots__ = ("_token_counts",)
 
-    def __getattribute__(self, name: str) -> Any:
-        r"""Get attribute override to delegate string methods to the
-        :obj:`content`.
+    def __getattr__(self, name: str) -> Any:
+        r"""Delegates the public string methods to the :obj:`content`. Only
+        called for the names the message does not have, so the fields and
+        methods of the message are read without any overhead.
 
         Args:
             name (str): The name of the attribute.
 
         Returns:
-            Any: The attribute value.
+            Any: The delegated method, its string results are returned as
+                messages.
         """
-        delegate_methods = [
-            method for method in dir(str) if not method.startswith('_')
-        ]
-        if name in delegate_methods:
-            content = super().__getattribute__('content')
+        if name in STR_METHODS:
+            content = self.content
             if isinstance(content, str):
-                content_method = getattr(content, name, None)
+                content_method = getattr(content, name)
                 if callable(content_method):
 
-                    def modify_arg(arg: Any) -> Any:
-                        r"""Modify the argument for delegate method.
-
-                        Args:
-                            arg (Any): The argument value.
-
-                        Returns:
-                            Any: The modified argument value.
-                        """
-                        if isinstance(arg, BaseMessage):
-                            return arg.content
-                        elif isinstance(arg, (list, tuple)):
-                            return type(arg)(modify_arg(item) for item in arg)
-                        else:
-                            return arg
-
                     def wrapper(*args: Any, **kwargs: Any) -> Any:
                         r"""Wrapper function for delegate method.
 
@@ -90,19 +121,12 @@ class BaseMessage:
                         Returns:
                             Any: The result of the delegate method.
                         """
-                        modified_args = [modify_arg(arg) for arg in args]
-                        modified_kwargs = {
-                            k: modify_arg(v)
-                            for k, v in kwargs.items()
-                        }
-                        output = content_method(*modified_args,
-                                                **modified_kwargs)
-                        return self._create_new_instance(output) if isinstance(
-                            output, str) else output
+                        output = content_method(*[_delegate_arg(arg) for arg in args],
+                                                **{k: _delegate_arg(v) for k, v in kwargs.items()})
+                        return self._create_new_instance(output) if isinstance(output, str) else output
 
                     return wrapper
-
-        return super().__getattribute__(name)
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
 
     def _create_new_instance(self, content: str) -> "BaseMessage":
         r"""Create a new instance of the :obj:`BaseMessage` with updated
@@ -188,6 +212,31 @@ class BaseMessage:
         from camel.utils import num_tokens_from_messages
         return num_tokens_from_messages([self.to_openai_chat_message()], model)
 
+    def num_openai_tokens(self, model: ModelType, role: Optional[str] = None) -> int:
+        r"""Returns the number of tokens of the message as an
+        :obj:`OpenAIMessage`. The count is cached on the message, so a chat
+        history is only encoded once, and recomputed if the content changes.
+
+        Args:
+            model (ModelType): The model type to count the tokens for.
+            role (Optional[str]): The role of the message in OpenAI chat
+                system. (default: :obj:`None`)
+
+        Returns:
+            int: The number of tokens of the message.
+        """
+        from camel.utils import count_tokens_openai_message
+        role = role or self.role
+        content = self.content
+        token_counts = getattr(self, "_token_counts", None)
+        if token_counts is None:
+            token_counts = self._token_counts = {}
+        cached = token_counts.get((model, role))
+        if cached is None or cached[0] is not content:
+            num_tokens = count_tokens_openai_message(self.to_openai_message(role), model.value_for_tiktoken)
+            cached = token_counts[(model, role)] = (content, num_tokens)
+        return cached[1]
+
     def extract_text_and_code_prompts(
             self) -> Tuple[List[TextPrompt], List[CodePrompt]]:
         r"""Extract text and code prompts from the message content.
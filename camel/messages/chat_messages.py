@@ -15,9 +15,11 @@ from dataclasses import dataclass
 from typing import Dict, Optional
 
 from camel.messages import BaseMessage
+from camel.messages.base import slotted
 from camel.typing import RoleType
 
 
+@slotted
 @dataclass
 class ChatMessage(BaseMessage):
     r"""Base class for chat messages used in CAMEL chat system.
@@ -47,6 +49,7 @@ class ChatMessage(BaseMessage):
         )
 
 
+@slotted
 @dataclass
 class AssistantChatMessage(ChatMessage):
     r"""Class for chat messages from the assistant role used in CAMEL chat
@@ -69,6 +72,7 @@ class AssistantChatMessage(ChatMessage):
     content: str = ""
 
 
+@slotted
 @dataclass
 class UserChatMessage(ChatMessage):
     r"""Class for chat messages from the user role used in CAMEL chat system.
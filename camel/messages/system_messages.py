@@ -15,9 +15,11 @@ from dataclasses import dataclass
 from typing import Dict, Optional
 
 from camel.messages import BaseMessage
+from camel.messages.base import slotted
 from camel.typing import RoleType
 
 
+@slotted
 @dataclass
 class SystemMessage(BaseMessage):
     r"""Class for system messages used in CAMEL chat system.
@@ -39,6 +41,7 @@ class SystemMessage(BaseMessage):
     content: str = ""
 
 
+@slotted
 @dataclass
 class AssistantSystemMessage(SystemMessage):
     r"""Class for system messages from the assistant used in the CAMEL chat
@@ -61,6 +64,7 @@ class AssistantSystemMessage(SystemMessage):
     content: str = ""
 
 
+@slotted
 @dataclass
 class UserSystemMessage(SystemMessage):
     r"""Class for system messages from the user used in the CAMEL chat system.
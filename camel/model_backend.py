@@ -11,17 +11,76 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # =========== Copyright 2023 @ CAMEL-AI.org. All Rights Reserved. ===========
+import asyncio
+import concurrent.futures
+import contextlib
+import fcntl
+import functools
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import re
+import socket
+import tempfile
+import threading
 import time
+import weakref
+from collections import deque
 from abc import ABC, abstractmethod
-from typing import Any, Dict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 
 import openai
-import tiktoken
 from openai.types.chat import ChatCompletion
 
 from camel.typing import ModelType
+from camel.utils import num_tokens_from_string
 from chatdev.utils import log_online
 
+# connection settings of the OpenAI clients, set to your own OpenAI API key and base url
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL")
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", 600))
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", 100))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("LLM_MAX_KEEPALIVE_CONNECTIONS", 20))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_KEEPALIVE_EXPIRY", 60))
+
+# on-disk response cache, enabled by pointing LLM_CACHE_DIR to a directory
+# LLM_CACHE_MODE: "readwrite" (default) or "replay" (read-only, misses are errors)
+LLM_CACHE_DIR = os.environ.get("LLM_CACHE_DIR")
+LLM_CACHE_MODE = os.environ.get("LLM_CACHE_MODE", "readwrite")
+LLM_CACHE_MAX_MB = int(os.environ.get("LLM_CACHE_MAX_MB", 2048))
+
+# rate limits of the API, shared by all processes on the machine (e.g., the workers of run_all.py)
+# LLM_RPM / LLM_TPM: requests / tokens per minute, 0 disables the limit;
+# per model overrides e.g. LLM_RPM_GPT_4 or LLM_TPM_GPT_3_5_TURBO
+LLM_RPM = int(os.environ.get("LLM_RPM", 0))
+LLM_TPM = int(os.environ.get("LLM_TPM", 0))
+LLM_LIMIT_DIR = os.environ.get("LLM_LIMIT_DIR", os.path.join(tempfile.gettempdir(), "soapfl_rate_limit"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", 6))
+
+# adaptive concurrency, the requests in flight of a model over all processes are kept within a window
+# that grows by one per window of healthy answers and is halved on 429s, timeouts and latency spikes.
+# LLM_MAX_CONCURRENCY: upper bound of the window, 0 disables the control; per model overrides
+# e.g. LLM_MAX_CONCURRENCY_GPT_4_O; a latency LLM_LATENCY_SPIKE times the average of the phase is a spike
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 0))
+LLM_MIN_CONCURRENCY = int(os.environ.get("LLM_MIN_CONCURRENCY", 1))
+LLM_LATENCY_SPIKE = float(os.environ.get("LLM_LATENCY_SPIKE", 3.0))
+
+# batch mode, the MethodReview requests are collected under LLM_BATCH_DIR instead of being sent,
+# see run_project_batch in run_all.py
+LLM_BATCH_DIR = os.environ.get("LLM_BATCH_DIR")
+
+# hedged requests, a duplicate of a completion still running after the LLM_HEDGE_PERCENTILE-th percentile
+# of the recent latencies of its model and phase is sent and the first answer wins; 0 disables hedging.
+# LLM_HEDGE_BUDGET caps the prompt tokens of the duplicates at a fraction of all prompt tokens sent
+LLM_HEDGE_PERCENTILE = float(os.environ.get("LLM_HEDGE_PERCENTILE", 0))
+LLM_HEDGE_BUDGET = float(os.environ.get("LLM_HEDGE_BUDGET", 0.05))
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get("LLM_HEDGE_MIN_SAMPLES", 20))
+LLM_HEDGE_WINDOW = int(os.environ.get("LLM_HEDGE_WINDOW", 200))
+
 
 class ModelBackend(ABC):
     r"""Base class for different model backends.
@@ -40,6 +99,813 @@ class ModelBackend(ABC):
         """
         pass
 
+    async def arun(self, *args, **kwargs) -> Dict[str, Any]:
+        r"""Awaitable variant of :obj:`run`. Backends without a native async
+        client run the blocking query in the default executor of the loop.
+
+        Returns:
+            Dict[str, Any]: All backends must return a dict in OpenAI format.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self.run, *args, **kwargs))
+
+
+_client: Optional[openai.OpenAI] = None
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, openai.AsyncOpenAI]" = weakref.WeakKeyDictionary()
+_client_lock = threading.Lock()
+
+
+def _http_limits():
+    # the limits of the http transport the SDK is built on, the same type as its default limits
+    return type(openai.DEFAULT_CONNECTION_LIMITS)(max_connections=LLM_MAX_CONNECTIONS,
+                                                  max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+                                                  keepalive_expiry=LLM_KEEPALIVE_EXPIRY)
+
+
+def get_openai_client() -> openai.OpenAI:
+    r"""Returns the process-wide OpenAI client. All backends share its pool
+    of keep-alive connections, so a completion does not pay for a new
+    connection and TLS handshake."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = openai.OpenAI(
+                base_url=OPENAI_BASE_URL,
+                api_key=OPENAI_API_KEY,
+                max_retries=0,
+                http_client=openai.DefaultHttpxClient(limits=_http_limits(), timeout=openai.Timeout(LLM_TIMEOUT)),
+            )
+    return _client
+
+
+def get_async_openai_client() -> openai.AsyncOpenAI:
+    r"""Returns the async OpenAI client of the running event loop. The
+    connections of an async client are bound to the loop they are opened in,
+    so there is one pooled client per loop."""
+    loop = asyncio.get_running_loop()
+    with _client_lock:
+        client = _async_clients.get(loop)
+        if client is None:
+            client = openai.AsyncOpenAI(
+                base_url=OPENAI_BASE_URL,
+                api_key=OPENAI_API_KEY,
+                max_retries=0,
+                http_client=openai.DefaultAsyncHttpxClient(limits=_http_limits(),
+                                                            timeout=openai.Timeout(LLM_TIMEOUT)),
+            )
+            _async_clients[loop] = client
+    return client
+
+
+async def close_async_openai_client() -> None:
+    r"""Closes the async OpenAI client of the running event loop and its
+    connections. To be awaited by the coroutine run by :obj:`asyncio.run`
+    before its loop is closed, the pool of the client is not closed when the
+    loop is garbage collected."""
+    loop = asyncio.get_running_loop()
+    with _client_lock:
+        client = _async_clients.pop(loop, None)
+    if client is not None:
+        await client.close()
+
+
+class ResponseCache:
+    r"""Content-addressed on-disk cache of chat completions.
+
+    Every entry is stored as a JSON file named by the SHA-256 of the model
+    name, the model config and the exact list of messages, so identical
+    prompts issued by different runs (or after a crash) are answered from
+    disk. The file modification time is used as the access time, which gives
+    LRU eviction once the cache grows beyond :obj:`max_bytes`. The cache
+    directory can be shared by several processes.
+
+    Args:
+        directory (str): The directory to store the cached responses.
+        max_bytes (int): The size bound of the cache directory.
+        replay (bool, optional): If True, the cache is read-only and a miss
+            raises an error, which allows rerunning the chain offline.
+            (default: :obj:`False`)
+    """
+
+    # seconds after which a temporary file is left over from a killed process
+    TMP_MAX_AGE = 3600
+
+    def __init__(self, directory: str, max_bytes: int, replay: bool = False) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.replay = replay
+        self._size: Optional[int] = None
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(model: str, model_config_dict: Dict, messages: List[Dict]) -> str:
+        payload = json.dumps({"model": model, "config": model_config_dict, "messages": messages},
+                             sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get(self, key: str) -> Optional[ChatCompletion]:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not self.replay:
+            # touch the entry so that it becomes the most recently used one
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+        return ChatCompletion(**data)
+
+    def put(self, key: str, response: ChatCompletion) -> None:
+        if self.replay:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps(response.model_dump(), ensure_ascii=False).encode("utf-8")
+        # write to a temporary file first, a concurrent reader never sees a partial entry
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            # an entry written again (e.g., by another process) replaces the size of the old one
+            try:
+                old_size = os.stat(path).st_size
+            except OSError:
+                old_size = 0
+            os.replace(tmp_path, path)
+            if self._size is None:
+                self._size = sum(size for _, _, size in self._entries())
+            else:
+                self._size += len(data) - old_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    @contextlib.contextmanager
+    def lock(self, key: str):
+        r"""Holds the inter-process lock of a key while its response is
+        requested, so that the other processes wait for the entry instead of
+        sending the same prompt. The locks are striped over 4096 files."""
+        with open(self._lock_path(key), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @contextlib.asynccontextmanager
+    async def alock(self, key: str):
+        r"""Awaitable variant of :obj:`lock`, polls the lock so that the
+        event loop is not blocked."""
+        with open(self._lock_path(key), "a") as f:
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(0.05)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _lock_path(self, key: str) -> str:
+        lock_dir = os.path.join(self.directory, "locks")
+        os.makedirs(lock_dir, exist_ok=True)
+        return os.path.join(lock_dir, key[:3] + ".lock")
+
+    def _entries(self):
+        r"""Returns the entries of the cache, and removes the temporary files
+        of the processes killed while writing an entry."""
+        entries = []
+        now = time.time()
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith((".json", ".tmp")):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                    if filename.endswith(".tmp"):
+                        # a live writer renames its temporary file right away
+                        if now - stat.st_mtime > self.TMP_MAX_AGE:
+                            os.remove(path)
+                        continue
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+        return entries
+
+    def _evict(self) -> None:
+        # evict the least recently used entries down to 90% of the bound,
+        # so that the directory is not rescanned on every following put
+        entries = sorted(self._entries())
+        total = sum(size for _, _, size in entries)
+        target = int(self.max_bytes * 0.9)
+        for _, path, size in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self._size = total
+
+
+_response_cache: Optional[ResponseCache] = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    r"""Returns the process-wide response cache, or None if the cache is not
+    enabled by :obj:`LLM_CACHE_DIR`."""
+    global _response_cache
+    if LLM_CACHE_DIR is None:
+        return None
+    with _response_cache_lock:
+        if _response_cache is None:
+            if LLM_CACHE_MODE not in {"readwrite", "replay"}:
+                raise ValueError(f"Unknown LLM_CACHE_MODE: {LLM_CACHE_MODE}")
+            _response_cache = ResponseCache(LLM_CACHE_DIR,
+                                            LLM_CACHE_MAX_MB * 1024 * 1024,
+                                            replay=LLM_CACHE_MODE == "replay")
+    return _response_cache
+
+
+class UsageLedger:
+    r"""Append-only ledger of the model calls of a run, one json row per
+    call with the tags of the caller (e.g., the bug, test suite and phase),
+    the usage, the wall latency, the time queued behind the rate limits,
+    the retries and whether the answer came from the cache. A row is
+    appended with a single write, so the threads and processes of a run can
+    share the file.
+
+    Args:
+        path (str): The jsonl file of the ledger.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def record(self, row: Dict[str, Any]) -> None:
+        data = (json.dumps(row) + "\n").encode("utf8")
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def load(path: str) -> List[Dict[str, Any]]:
+        r"""Returns the rows of a ledger file, a torn last row is skipped."""
+        rows = []
+        with open(path, "r", encoding="utf8") as f:
+            for line in f:
+                try:
+                    rows.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        return rows
+
+
+_usage_ledger: Optional[UsageLedger] = None
+
+
+def set_usage_ledger(path: Optional[str]) -> None:
+    r"""Records the model calls of the process into the ledger at ``path``,
+    None stops recording."""
+    global _usage_ledger
+    _usage_ledger = UsageLedger(path) if path is not None else None
+
+
+def get_usage_ledger() -> Optional[UsageLedger]:
+    return _usage_ledger
+
+
+def _cached_tokens(usage) -> int:
+    r"""Returns the prompt tokens served from the prefix cache of the
+    provider."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", None) or 0
+
+
+class SingleFlight:
+    r"""Coalesces concurrent identical requests of the process into one
+    upstream call. The first caller of a key (the leader) runs the call, the
+    callers arriving while it is in flight wait for its result or error.
+    Threads and coroutines can wait for the same call."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: Dict[str, concurrent.futures.Future] = {}
+
+    def _join(self, key: str) -> Tuple[concurrent.futures.Future, bool]:
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, False
+            future = self._calls[key] = concurrent.futures.Future()
+            return future, True
+
+    def _leave(self, key: str) -> None:
+        with self._lock:
+            del self._calls[key]
+
+    def do(self, key: str, func: Callable[[], Any]) -> Tuple[Any, bool]:
+        r"""Runs :obj:`func` unless an identical call is in flight.
+
+        Returns:
+            Tuple[Any, bool]: The result and whether this caller ran the call.
+        """
+        future, leader = self._join(key)
+        if not leader:
+            return future.result(), False
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, True
+        finally:
+            self._leave(key)
+
+    async def ado(self, key: str, func: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        r"""Awaitable variant of :obj:`do`, :obj:`func` returns an
+        awaitable."""
+        future, leader = self._join(key)
+        if not leader:
+            return await asyncio.wrap_future(future), False
+        try:
+            result = await func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, True
+        finally:
+            self._leave(key)
+
+
+_single_flight = SingleFlight()
+
+
+def _update_state_file(path: str, lock: threading.Lock, func):
+    r"""Applies ``func(state, now)`` to the json state file shared by the
+    processes, under ``fcntl.flock`` and the thread lock. ``func`` is given
+    None for a new file and returns the state to store and the result."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    with lock, os.fdopen(fd, "r+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            content = f.read()
+            state, result = func(json.loads(content) if content else None, time.time())
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(state))
+            # the buffered write must land before the lock is released
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+    return result
+
+
+async def _in_thread(func, *args):
+    r"""Runs a blocking call, e.g., an update of a state file under
+    ``fcntl.flock``, in the default executor, so that the event loop is not
+    blocked while another process holds the lock."""
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+
+
+class RateLimiter:
+    r"""Token buckets of the requests per minute and tokens per minute of a
+    model. The buckets live in a small json file guarded by ``fcntl.flock``,
+    so concurrent processes draw from the same quota instead of each one
+    bursting into 429 errors on its own.
+
+    Args:
+        path (str): The state file of the buckets.
+        rpm (int): Requests per minute, 0 for no limit.
+        tpm (int): Tokens per minute, 0 for no limit.
+    """
+
+    def __init__(self, path: str, rpm: int, tpm: int) -> None:
+        self.path = path
+        self.rpm = rpm
+        self.tpm = tpm
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def _update(self, func):
+        r"""Refills the buckets, applies ``func(state, now)`` and stores the
+        state, all under the file lock. Returns the result of ``func``."""
+
+        def update(state, now):
+            if state is None:
+                state = {"requests": self.rpm, "tokens": self.tpm, "time": now, "blocked_until": 0}
+            elapsed = max(0.0, now - state["time"])
+            state["requests"] = min(self.rpm, state["requests"] + elapsed * self.rpm / 60)
+            state["tokens"] = min(self.tpm, state["tokens"] + elapsed * self.tpm / 60)
+            state["time"] = now
+            return state, func(state, now)
+
+        return _update_state_file(self.path, self._lock, update)
+
+    def _reserve(self, num_tokens: int) -> float:
+        r"""Takes one request and ``num_tokens`` tokens from the buckets if
+        they are available. Returns 0 on success, otherwise the seconds to
+        wait before they are."""
+        # a prompt larger than the whole budget is admitted once the bucket is full
+        num_tokens = min(num_tokens, self.tpm) if self.tpm else 0
+
+        def reserve(state, now):
+            if state["blocked_until"] > now:
+                return state["blocked_until"] - now
+            wait = 0.0
+            if self.rpm and state["requests"] < 1:
+                wait = max(wait, (1 - state["requests"]) * 60 / self.rpm)
+            if self.tpm and state["tokens"] < num_tokens:
+                wait = max(wait, (num_tokens - state["tokens"]) * 60 / self.tpm)
+            if wait == 0:
+                state["requests"] -= 1 if self.rpm else 0
+                state["tokens"] -= num_tokens
+            return wait
+
+        return self._update(reserve)
+
+    def acquire(self, num_tokens: int) -> None:
+        r"""Blocks until a request with ``num_tokens`` prompt tokens is
+        admitted."""
+        while True:
+            wait = self._reserve(num_tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def aacquire(self, num_tokens: int) -> None:
+        r"""Awaitable variant of :obj:`acquire`."""
+        while True:
+            wait = await _in_thread(self._reserve, num_tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def charge(self, num_tokens: int) -> None:
+        r"""Charges the completion tokens of an admitted request, the bucket
+        may go into debt which delays the following requests."""
+        if self.tpm and num_tokens > 0:
+            self._update(lambda state, now: state.__setitem__("tokens", state["tokens"] - num_tokens))
+
+    def block(self, seconds: float) -> None:
+        r"""Stops admitting requests of all processes for ``seconds``, used
+        when the API answers with a 429 error."""
+
+        def block(state, now):
+            state["blocked_until"] = max(state["blocked_until"], now + seconds)
+            state["requests"] = min(state["requests"], 0)
+
+        self._update(block)
+
+
+_rate_limiters: Dict[str, Optional[RateLimiter]] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model: str) -> Optional[RateLimiter]:
+    r"""Returns the rate limiter of the model, or None if the model has no
+    limits configured."""
+    with _rate_limiters_lock:
+        if model not in _rate_limiters:
+            suffix = model.upper().replace("-", "_").replace(".", "_")
+            rpm = int(os.environ.get("LLM_RPM_" + suffix, LLM_RPM))
+            tpm = int(os.environ.get("LLM_TPM_" + suffix, LLM_TPM))
+            limiter = None
+            if rpm or tpm:
+                limiter = RateLimiter(os.path.join(LLM_LIMIT_DIR, "{}.json".format(model)), rpm, tpm)
+            _rate_limiters[model] = limiter
+        return _rate_limiters[model]
+
+
+class Hedger:
+    r"""Latency statistics and spend budget of the hedged requests of the
+    process. The latencies of the completions are kept per key (the model
+    and the phase), a completion slower than the given percentile of its
+    key is duplicated as long as the duplicates stay within the budget.
+
+    Args:
+        percentile (float): The percentile of the latencies after which a
+            completion is hedged.
+        budget (float): The prompt tokens of the duplicates as a fraction
+            of all prompt tokens sent.
+        min_samples (int): The latencies observed for a key before its
+            completions are hedged.
+        window (int): The number of recent latencies kept per key.
+    """
+
+    def __init__(self, percentile: float, budget: float, min_samples: int, window: int) -> None:
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.window = window
+        self._lock = threading.Lock()
+        self._latencies: Dict[Tuple[str, Optional[str]], deque] = {}
+        self._sent_tokens = 0
+        self._hedged_tokens = 0
+
+    def record(self, key: Tuple[str, Optional[str]], seconds: float, num_tokens: int) -> None:
+        r"""Records the latency and the prompt tokens of a completion."""
+        with self._lock:
+            self._latencies.setdefault(key, deque(maxlen=self.window)).append(seconds)
+            self._sent_tokens += num_tokens
+
+    def delay(self, key: Tuple[str, Optional[str]]) -> Optional[float]:
+        r"""Returns the seconds after which a completion of the key is hedged,
+        or None if too few of its latencies are known."""
+        with self._lock:
+            latencies = self._latencies.get(key)
+            if latencies is None or len(latencies) < self.min_samples:
+                return None
+            latencies = sorted(latencies)
+        index = max(0, math.ceil(self.percentile / 100 * len(latencies)) - 1)
+        return latencies[index]
+
+    def try_hedge(self, num_tokens: int) -> bool:
+        r"""Takes a duplicate of ``num_tokens`` prompt tokens from the budget.
+
+        Returns:
+            bool: Whether the duplicate is within the budget.
+        """
+        with self._lock:
+            if self._hedged_tokens + num_tokens > self.budget * self._sent_tokens:
+                return False
+            self._hedged_tokens += num_tokens
+            self._sent_tokens += num_tokens
+            return True
+
+
+_hedger: Optional[Hedger] = None
+_hedge_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+_hedger_lock = threading.Lock()
+
+
+def get_hedger() -> Optional[Hedger]:
+    r"""Returns the hedger of the process, or None if hedging is disabled."""
+    global _hedger
+    if LLM_HEDGE_PERCENTILE <= 0:
+        return None
+    with _hedger_lock:
+        if _hedger is None:
+            _hedger = Hedger(LLM_HEDGE_PERCENTILE, LLM_HEDGE_BUDGET, LLM_HEDGE_MIN_SAMPLES, LLM_HEDGE_WINDOW)
+    return _hedger
+
+
+def _get_hedge_executor() -> concurrent.futures.ThreadPoolExecutor:
+    r"""Returns the threads the blocking completions race on while they may
+    be hedged, one per pooled connection and its duplicate."""
+    global _hedge_executor
+    with _hedger_lock:
+        if _hedge_executor is None:
+            _hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2 * LLM_MAX_CONNECTIONS,
+                                                                    thread_name_prefix="llm_hedge")
+    return _hedge_executor
+
+
+def _abort_stream(stream) -> None:
+    r"""Shuts down the socket of a stream of the blocking client. Closing the
+    stream from another thread does not wake up a read blocked on it, the
+    shut down socket ends the read at once and drops the connection."""
+    try:
+        sock = stream.response.extensions["network_stream"].get_extra_info("socket")
+        if sock is not None and not stream.response.is_closed:
+            sock.shutdown(socket.SHUT_RDWR)
+    except (AttributeError, KeyError, OSError):
+        pass
+
+
+class _Attempt:
+    r"""One request of a completion that may race against its hedged
+    duplicate. It keeps the time the request was sent, the latencies of the
+    hedger are measured from it, and the release of its concurrency lease.
+    An ``abortable`` attempt is streamed, so that the winner of the race can
+    abort it for real: its socket is shut down, which stops the generation
+    on the server, and its lease is given back right away.
+    """
+
+    def __init__(self, abortable: bool = False) -> None:
+        self.abortable = abortable
+        self.cancelled = threading.Event()
+        self.sent = threading.Event()
+        self.sent_at = 0.0
+        self._lock = threading.Lock()
+        self._stream = None
+        self._release: Optional[Callable[[str], None]] = None
+
+    def check(self) -> None:
+        if self.cancelled.is_set():
+            raise concurrent.futures.CancelledError()
+
+    def dispatch(self, release: Callable[[str], None]) -> None:
+        r"""Marks the request as sent, ``release(outcome)`` gives back its
+        lease."""
+        with self._lock:
+            self._release = release
+        self.sent_at = time.monotonic()
+        self.sent.set()
+
+    def release(self, outcome: str) -> None:
+        with self._lock:
+            release, self._release = self._release, None
+        if release is not None:
+            release(outcome)
+
+    def open(self, stream) -> None:
+        with self._lock:
+            self._stream = stream
+            if self.cancelled.is_set():
+                _abort_stream(stream)
+
+    def close(self) -> None:
+        with self._lock:
+            stream, self._stream = self._stream, None
+        if stream is not None:
+            # closing the stream aborts the generation of the remaining tokens
+            stream.close()
+
+    def abort(self) -> None:
+        self.cancelled.set()
+        with self._lock:
+            if self._stream is not None:
+                _abort_stream(self._stream)
+        self.release("cancelled")
+
+
+class ConcurrencyController:
+    r"""Additive increase, multiplicative decrease (AIMD) window of the
+    requests of a model in flight. Each answer within the usual latency of
+    its key (the phase) grows the window by ``1 / window``, i.e., by one per
+    window of answers, a 429 error, a timeout or a latency spike halves it.
+    Only the requests sent after the last decrease can decrease it again,
+    so one overload is not punished once per request in flight. The window
+    and the leases of the requests live in a json file guarded by
+    ``fcntl.flock`` like the buckets of :obj:`RateLimiter`, the leases of
+    dead processes are dropped.
+
+    Args:
+        path (str): The state file of the window.
+        min_window (int): The lower bound of the window.
+        max_window (int): The upper bound of the window.
+        spike (float): The factor over the average latency of the key that
+            counts as a spike.
+    """
+
+    def __init__(self, path: str, min_window: int, max_window: int, spike: float) -> None:
+        self.path = path
+        self.min_window = max(1, min(min_window, max_window))
+        self.max_window = max_window
+        self.spike = spike
+        self._lock = threading.Lock()
+        self._leases = itertools.count()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def _update(self, func):
+        def update(state, now):
+            if state is None:
+                state = {"window": float(self.min_window), "leases": {}, "last_decrease": 0, "latency": {}}
+            for lease in list(state["leases"]):
+                pid = int(lease.split(":")[0])
+                if pid != os.getpid() and not _process_alive(pid):
+                    del state["leases"][lease]
+            return state, func(state, now)
+
+        return _update_state_file(self.path, self._lock, update)
+
+    def _admit(self) -> Optional[str]:
+        lease = "{}:{}".format(os.getpid(), next(self._leases))
+
+        def admit(state, now):
+            if len(state["leases"]) >= int(state["window"]):
+                return None
+            state["leases"][lease] = now
+            return lease
+
+        return self._update(admit)
+
+    def acquire(self) -> str:
+        r"""Blocks until a request is admitted into the window.
+
+        Returns:
+            str: The lease of the request, given back with :obj:`release`.
+        """
+        while True:
+            lease = self._admit()
+            if lease is not None:
+                return lease
+            time.sleep(0.05 + random.random() / 10)
+
+    async def aacquire(self) -> str:
+        r"""Awaitable variant of :obj:`acquire`."""
+        while True:
+            lease = await _in_thread(self._admit)
+            if lease is not None:
+                return lease
+            await asyncio.sleep(0.05 + random.random() / 10)
+
+    def release(self, lease: str, key: Optional[str], seconds: float, outcome: str) -> None:
+        r"""Gives back the lease of a finished request and adapts the window.
+
+        Args:
+            lease (str): The lease returned by :obj:`acquire`.
+            key (str, optional): The key of the latency, e.g., the phase.
+            seconds (float): The latency of the request.
+            outcome (str): ``ok`` for an answer, ``overload`` for a 429 error
+                or a timeout, anything else leaves the window as it is.
+        """
+
+        def release(state, now):
+            start = state["leases"].pop(lease, now)
+            window = state["window"]
+            overload = outcome == "overload"
+            if outcome == "ok":
+                average, count = state["latency"].get(str(key), [seconds, 0])
+                overload = count >= 10 and seconds > self.spike * average
+                state["latency"][str(key)] = [average + 0.1 * (seconds - average), count + 1]
+                if not overload:
+                    state["window"] = min(float(self.max_window), window + 1 / window)
+            if overload and start >= state["last_decrease"]:
+                state["window"] = max(float(self.min_window), window / 2)
+                state["last_decrease"] = now
+            return window, state["window"], len(state["leases"])
+
+        before, after, in_flight = self._update(release)
+        if int(before) != int(after):
+            log_online("**[OpenAI_Usage_Info Concurrency]**\nwindow: {}\nin_flight: {}\n".format(
+                int(after), in_flight))
+
+    def window(self) -> float:
+        r"""Returns the current window, the metric of the controller."""
+        return self._update(lambda state, now: state["window"])
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+_concurrency_controllers: Dict[str, Optional[ConcurrencyController]] = {}
+
+
+def get_concurrency_controller(model: str) -> Optional[ConcurrencyController]:
+    r"""Returns the concurrency controller of the model, or None if the
+    model has no concurrency bound configured."""
+    with _rate_limiters_lock:
+        if model not in _concurrency_controllers:
+            suffix = model.upper().replace("-", "_").replace(".", "_")
+            max_window = int(os.environ.get("LLM_MAX_CONCURRENCY_" + suffix, LLM_MAX_CONCURRENCY))
+            controller = None
+            if max_window > 0:
+                controller = ConcurrencyController(os.path.join(LLM_LIMIT_DIR, "{}.concurrency.json".format(model)),
+                                                   LLM_MIN_CONCURRENCY, max_window, LLM_LATENCY_SPIKE)
+            _concurrency_controllers[model] = controller
+        return _concurrency_controllers[model]
+
+
+def _request_outcome(error: openai.APIError) -> str:
+    r"""Classifies a failed request for the concurrency controller."""
+    if isinstance(error, (openai.RateLimitError, openai.APITimeoutError)):
+        return "overload"
+    return "error"
+
+
+def _retry_after(error: openai.APIStatusError, attempt: int) -> float:
+    r"""Seconds to wait before retrying a failed request, the server's
+    ``retry-after`` header if given, otherwise exponential backoff with
+    jitter."""
+    try:
+        return float(error.response.headers["retry-after"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return min(60.0, 2 ** attempt) * (0.5 + random.random() / 2)
+
 
 class OpenAIModel(ModelBackend):
     r"""OpenAI API in a unified ModelBackend interface."""
@@ -47,13 +913,18 @@ class OpenAIModel(ModelBackend):
     def __init__(self, model_type: ModelType, model_config_dict: Dict) -> None:
         super().__init__()
         self.model_type = model_type
-        self.model_config_dict = model_config_dict
+        # the backend is shared by concurrent chats, so the config is never changed, the max_tokens of a
+        # prompt only goes into the config of its own request (see _request_config)
+        self.model_config_dict = dict(model_config_dict)
 
-    def run(self, *args, **kwargs) -> Dict[str, Any]:
-        string = "\n".join([message["content"] for message in kwargs["messages"]])
-        encoding = tiktoken.encoding_for_model(self.model_type.value)
-        num_prompt_tokens = len(encoding.encode(string))
-        gap_between_send_receive = 15 * len(kwargs["messages"])
+    def _request_config(self, messages: List[Dict]) -> Tuple[int, Dict]:
+        r"""Returns the number of prompt tokens of the messages and the config
+        of their request, with the completion budget left by the prompt as
+        ``max_tokens``."""
+        # the contents are counted one by one, so the history of a chat hits the memoized counts
+        num_prompt_tokens = sum(num_tokens_from_string(message["content"], self.model_type.value)
+                                for message in messages)
+        gap_between_send_receive = 15 * len(messages)
         num_prompt_tokens += gap_between_send_receive
 
         num_max_token_map = {
@@ -73,30 +944,608 @@ class OpenAIModel(ModelBackend):
             num_max_completion_tokens = 16384
         elif self.model_type == ModelType.GPT_3_5_TURBO:
             num_max_completion_tokens = 4096
-        self.model_config_dict['max_tokens'] = num_max_completion_tokens
-        
-        # set to your own OpenAI API key
-        client = openai.OpenAI(
-            base_url="",
-            api_key="",
-        )
-        
-        response = client.chat.completions.create(
-            *args,
-            **kwargs,
-            model=self.model_type.value,
-            **self.model_config_dict
-        )
-        # time.sleep(2)
+        return num_prompt_tokens, dict(self.model_config_dict, max_tokens=num_max_completion_tokens)
+
+    def _request_key(self, messages: List[Dict], config: Dict, conclusion_pattern: Optional[str] = None) -> str:
+        if self._streaming(conclusion_pattern):
+            config = dict(config, conclusion_pattern=conclusion_pattern)
+        return ResponseCache.make_key(self.model_type.value, config, messages)
+
+    def _lookup_cache(self, messages: List[Dict], config: Dict, conclusion_pattern: Optional[str] = None):
+        r"""Looks up the response cache for the messages. A stream cut off at
+        the conclusion pattern is cached apart from the full response.
+
+        Returns:
+            Tuple[ResponseCache, str, ChatCompletion]: The cache, the cache
+                key and the cached response, all of them may be None.
+        """
+        cache = get_response_cache()
+        if cache is None:
+            return None, None, None
+        cache_key = self._request_key(messages, config, conclusion_pattern)
+        response = cache.get(cache_key)
+        if response is not None:
+            log_online("**[OpenAI_Usage_Info Cache Hit]**\nid: {}\n".format(response.id))
+        elif cache.replay:
+            raise RuntimeError("No cached response for the prompt in replay mode (key: {})".format(cache_key))
+        return cache, cache_key, response
 
+    def _finish(self, response, cache: Optional[ResponseCache], cache_key: Optional[str]) -> ChatCompletion:
         log_online(
-            "**[OpenAI_Usage_Info Receive]**\nprompt_tokens: {}\ncompletion_tokens: {}\ntotal_tokens: {}\n".format(
+            "**[OpenAI_Usage_Info Receive]**\nprompt_tokens: {}\ncompletion_tokens: {}\ntotal_tokens: {}\n"
+            "cached_tokens: {}\n".format(
                 response.usage.prompt_tokens, response.usage.completion_tokens,
-                response.usage.total_tokens))
+                response.usage.total_tokens, _cached_tokens(response.usage)))
         if not isinstance(response, ChatCompletion):
             raise RuntimeError("Unexpected return from OpenAI API")
+        if cache is not None:
+            cache.put(cache_key, response)
+        return response
+
+    def make_request_body(self, messages: List[Dict]) -> Dict:
+        r"""Returns the body of the chat completion request :obj:`run` would
+        send for the messages, used to collect the request into a batch."""
+        _, config = self._request_config(messages)
+        return dict(config, stream=False, model=self.model_type.value, messages=messages)
+
+    def _streaming(self, conclusion_pattern: Optional[str]) -> bool:
+        return bool(self.model_config_dict.get("stream")) and conclusion_pattern is not None
+
+    def _stream_kwargs(self, config: Dict, streamed: bool) -> Dict:
+        r"""Returns the config to send. A request is streamed only if there
+        is a pattern to cut the stream at or if it may have to be aborted, a
+        full stream gains nothing over a plain request otherwise."""
+        if streamed:
+            return dict(config, stream=True, stream_options={"include_usage": True})
+        return dict(config, stream=False)
+
+    def _stream_state(self) -> Dict:
+        return {"id": None, "created": 0, "model": self.model_type.value, "content": "",
+                "finish_reason": None, "usage": None}
+
+    def _consume_chunk(self, state: Dict, chunk, pattern) -> bool:
+        r"""Adds a streamed chunk to the state of the response.
+
+        Returns:
+            bool: Whether the conclusion pattern has arrived, so the rest of
+                the stream is not needed.
+        """
+        state["id"] = state["id"] or chunk.id
+        state["created"] = state["created"] or chunk.created
+        if getattr(chunk, "usage", None) is not None:
+            state["usage"] = chunk.usage.model_dump()
+        if not chunk.choices:
+            return False
+        choice = chunk.choices[0]
+        if choice.finish_reason is not None:
+            state["finish_reason"] = choice.finish_reason
+        if choice.delta.content:
+            # only the tail can complete a new match
+            start = max(0, len(state["content"]) - 512)
+            state["content"] += choice.delta.content
+            if pattern is not None and pattern.search(state["content"], start) is not None:
+                return True
+        return False
+
+    def _stream_response(self, state: Dict, num_prompt_tokens: int, cut: bool) -> ChatCompletion:
+        r"""Builds the response of a consumed stream. A stream closed at the
+        conclusion pattern reports no usage, so it is counted with tiktoken."""
+        usage = state["usage"]
+        if usage is None:
+            completion_tokens = num_tokens_from_string(state["content"], self.model_type.value)
+            usage = {"prompt_tokens": num_prompt_tokens, "completion_tokens": completion_tokens,
+                     "total_tokens": num_prompt_tokens + completion_tokens}
+        if cut:
+            # the usage lines are logged once by _finish, get_info sums them up
+            log_online("**[OpenAI_Usage_Info Stream Cut]**\nid: {}\n".format(state["id"]))
+        return ChatCompletion(
+            id=state["id"] or "stream",
+            created=state["created"],
+            model=state["model"],
+            object="chat.completion",
+            choices=[dict(index=0, finish_reason="stop" if cut else (state["finish_reason"] or "stop"),
+                          message=dict(role="assistant", content=state["content"]))],
+            usage=usage,
+        )
+
+    def _on_error(self, error: openai.APIError, attempt: int,
+                  limiter: Optional[RateLimiter]) -> float:
+        r"""Decides whether a failed request is retried.
+
+        Returns:
+            float: The seconds to wait before the retry.
+
+        Raises:
+            openai.APIError: if the error is not transient or the retries
+                are exhausted.
+        """
+        transient = isinstance(error, (openai.RateLimitError, openai.APIConnectionError,
+                                       openai.InternalServerError))
+        if not transient or attempt >= LLM_MAX_RETRIES:
+            raise error
+        wait = _retry_after(error, attempt)
+        if isinstance(error, openai.RateLimitError) and limiter is not None:
+            limiter.block(wait)
+        log_online("**[OpenAI_Usage_Info Retry]**\nerror: {}\nattempt: {}\nwait: {:.1f}s\n".format(
+            type(error).__name__, attempt + 1, wait))
+        return wait
+
+    def _charge(self, response, limiter: Optional[RateLimiter]) -> None:
+        if limiter is not None and getattr(response, "usage", None) is not None:
+            limiter.charge(response.usage.completion_tokens)
+
+    def _run_stream(self, stream, conclusion_pattern: Optional[str], num_prompt_tokens: int,
+                    attempt: _Attempt) -> ChatCompletion:
+        pattern = re.compile(conclusion_pattern) if conclusion_pattern is not None else None
+        state = self._stream_state()
+        cut = False
+        attempt.open(stream)
+        try:
+            for chunk in stream:
+                if self._consume_chunk(state, chunk, pattern):
+                    cut = True
+                    break
+        except Exception:
+            # the read of an aborted attempt fails on its shut down socket
+            attempt.check()
+            raise
+        finally:
+            attempt.close()
+        # or it just ends early
+        attempt.check()
+        return self._stream_response(state, num_prompt_tokens, cut)
+
+    @staticmethod
+    def _release_lease(controller: Optional["ConcurrencyController"], lease, latency_key: Optional[str],
+                       start: float, outcome: str) -> None:
+        if controller is not None:
+            controller.release(lease, latency_key, time.monotonic() - start, outcome)
+
+    def _request(self, args, kwargs, config: Dict, conclusion_pattern: Optional[str], num_prompt_tokens: int,
+                 call: Dict, attempt: Optional[_Attempt] = None) -> ChatCompletion:
+        r"""Sends the request until it succeeds or fails for good, the queue
+        wait and retries are added to the record of the ``call``. The
+        ``attempt`` of a hedged race is aborted by the winner, it then
+        raises :obj:`concurrent.futures.CancelledError`."""
+        client = get_openai_client()
+        limiter = get_rate_limiter(self.model_type.value)
+        controller = get_concurrency_controller(self.model_type.value)
+        attempt = attempt or _Attempt()
+        streamed = self._streaming(conclusion_pattern) or attempt.abortable
+        retry = 0
+        while True:
+            attempt.check()
+            queued = time.monotonic()
+            if limiter is not None:
+                limiter.acquire(num_prompt_tokens)
+            lease = controller.acquire() if controller is not None else None
+            start = time.monotonic()
+            call["queue_wait"] += start - queued
+            attempt.dispatch(functools.partial(self._release_lease, controller, lease, call["latency_key"], start))
+            outcome = "cancelled"
+            try:
+                # aborted while waiting for the limits
+                attempt.check()
+                response = client.chat.completions.create(
+                    *args,
+                    **kwargs,
+                    model=self.model_type.value,
+                    **self._stream_kwargs(config, streamed)
+                )
+                if streamed:
+                    response = self._run_stream(response, conclusion_pattern, num_prompt_tokens, attempt)
+                outcome = "ok"
+            except openai.APIError as e:
+                # the connection of an aborted attempt fails
+                attempt.check()
+                outcome = _request_outcome(e)
+                wait = self._on_error(e, retry, limiter)
+            finally:
+                attempt.release(outcome)
+            if outcome == "ok":
+                break
+            time.sleep(wait)
+            retry += 1
+            call["retries"] += 1
+        self._charge(response, limiter)
         return response
 
+    def _log_hedge(self, call: Dict, delay: float, num_prompt_tokens: int) -> None:
+        # the prompt of the duplicate is billed whichever answer wins
+        call["hedged_prompt_tokens"] += num_prompt_tokens
+        log_online("**[OpenAI_Usage_Info Hedge]**\nkey: {}\ndelay: {:.1f}s\nprompt_tokens: {}\n".format(
+            call["latency_key"], delay, num_prompt_tokens))
+
+    @staticmethod
+    def _wait_hedge(future: concurrent.futures.Future, attempt: _Attempt, delay: float) -> bool:
+        r"""Waits until the attempt has been in flight for ``delay`` seconds,
+        the time it waits for the limits does not count.
+
+        Returns:
+            bool: Whether the attempt is still running.
+        """
+        while not attempt.sent.wait(0.05):
+            if future.done():
+                return False
+        done, _ = concurrent.futures.wait([future], timeout=max(0.0, attempt.sent_at + delay - time.monotonic()))
+        return not done
+
+    def _hedged_request(self, args, kwargs, config: Dict, conclusion_pattern: Optional[str], num_prompt_tokens: int,
+                        call: Dict) -> ChatCompletion:
+        r"""Sends the request, and a duplicate of it if it has been in flight
+        for longer than the percentile of the recent latencies of its model
+        and latency key. The requests of a race are streamed, the first
+        answer wins and the other request is aborted: its connection is shut
+        down and its concurrency lease given back at once."""
+        hedger = get_hedger()
+        if hedger is None:
+            return self._request(args, kwargs, config, conclusion_pattern, num_prompt_tokens, call)
+        key = (self.model_type.value, call["latency_key"])
+        delay = hedger.delay(key)
+        if delay is None:
+            winner = _Attempt()
+            response = self._request(args, kwargs, config, conclusion_pattern, num_prompt_tokens, call, winner)
+        else:
+            executor = _get_hedge_executor()
+            attempts = {}
+
+            def submit():
+                attempt = _Attempt(abortable=True)
+                future = executor.submit(self._request, args, kwargs, config, conclusion_pattern,
+                                         num_prompt_tokens, call, attempt)
+                attempts[future] = attempt
+                return future
+
+            primary = submit()
+            if not self._wait_hedge(primary, attempts[primary], delay) or not hedger.try_hedge(num_prompt_tokens):
+                response = primary.result()
+                winner = attempts[primary]
+            else:
+                self._log_hedge(call, delay, num_prompt_tokens)
+                pending = {primary, submit()}
+                error = None
+                winner = None
+                try:
+                    while pending and winner is None:
+                        done, pending = concurrent.futures.wait(pending,
+                                                                return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done:
+                            if future.exception() is None:
+                                response = future.result()
+                                winner = attempts[future]
+                                break
+                            error = error or future.exception()
+                    if winner is None:
+                        raise error
+                finally:
+                    for attempt in attempts.values():
+                        if attempt is not winner:
+                            attempt.abort()
+        # the latency of the answer, without the wait for the limits
+        hedger.record(key, time.monotonic() - winner.sent_at, num_prompt_tokens)
+        return response
+
+    def _log_coalesced(self, response, call: Dict) -> None:
+        call["source"] = "coalesced"
+        log_online("**[OpenAI_Usage_Info Coalesced]**\nid: {}\n".format(response.id))
+
+    @staticmethod
+    def _start_call(kwargs) -> Dict:
+        r"""Pops the latency key and the ledger tags of the caller from the
+        arguments of :obj:`run` and starts the record of the call."""
+        return {"latency_key": kwargs.pop("latency_key", None), "info": kwargs.pop("call_info", None) or {},
+                "start": time.monotonic(), "queue_wait": 0.0, "retries": 0, "hedged_prompt_tokens": 0,
+                "source": "api"}
+
+    def _record(self, call: Dict, response) -> ChatCompletion:
+        r"""Appends the finished call to the usage ledger, if there is one."""
+        ledger = get_usage_ledger()
+        if ledger is not None:
+            usage = response.usage
+            ledger.record(dict(call["info"],
+                               time=time.time(),
+                               model=self.model_type.value,
+                               prompt_tokens=usage.prompt_tokens,
+                               completion_tokens=usage.completion_tokens,
+                               total_tokens=usage.total_tokens,
+                               cached_tokens=_cached_tokens(usage),
+                               hedged_prompt_tokens=call["hedged_prompt_tokens"],
+                               latency=round(time.monotonic() - call["start"], 3),
+                               queue_wait=round(call["queue_wait"], 3),
+                               retries=call["retries"],
+                               cache_hit=call["source"] == "cache",
+                               coalesced=call["source"] == "coalesced"))
+        return response
+
+    def run(self, *args, **kwargs) -> Dict[str, Any]:
+        r"""Runs the query to the backend model. With the ``stream`` config and
+        a ``conclusion_pattern`` regex, the completion is streamed and cut off
+        as soon as its text matches the pattern. Identical requests in flight
+        at the same time are sent only once. The latency of the completion is
+        tracked under the model and ``latency_key`` for hedging, the call is
+        recorded in the usage ledger with the ``call_info`` tags."""
+        conclusion_pattern = kwargs.pop("conclusion_pattern", None)
+        call = self._start_call(kwargs)
+        num_prompt_tokens, config = self._request_config(kwargs["messages"])
+        cache, cache_key, response = self._lookup_cache(kwargs["messages"], config, conclusion_pattern)
+        if response is not None:
+            call["source"] = "cache"
+            return self._record(call, response)
+        key = cache_key or self._request_key(kwargs["messages"], config, conclusion_pattern)
+
+        def send():
+            return self._hedged_request(args, kwargs, config, conclusion_pattern, num_prompt_tokens, call)
+
+        def request():
+            if cache is None:
+                return self._finish(send(), cache, key)
+            with cache.lock(key):
+                # another process may have answered the prompt while we waited
+                cached = cache.get(key)
+                if cached is not None:
+                    self._log_coalesced(cached, call)
+                    return cached
+                return self._finish(send(), cache, key)
+
+        response, leader = _single_flight.do(key, request)
+        if not leader:
+            self._log_coalesced(response, call)
+        return self._record(call, response)
+
+
+class AsyncOpenAIModel(OpenAIModel):
+    r"""OpenAI API on the async client, many completions of this backend can
+    be awaited concurrently from one event loop. The blocking :obj:`run` of
+    :obj:`OpenAIModel` is still available."""
+
+    async def _arun_stream(self, stream, conclusion_pattern: str, num_prompt_tokens: int) -> ChatCompletion:
+        pattern = re.compile(conclusion_pattern)
+        state = self._stream_state()
+        cut = False
+        async for chunk in stream:
+            if self._consume_chunk(state, chunk, pattern):
+                cut = True
+                break
+        await stream.close()
+        return self._stream_response(state, num_prompt_tokens, cut)
+
+    async def _arequest(self, args, kwargs, config: Dict, conclusion_pattern: Optional[str], num_prompt_tokens: int,
+                        call: Dict, attempt: Optional[_Attempt] = None) -> ChatCompletion:
+        client = get_async_openai_client()
+        limiter = get_rate_limiter(self.model_type.value)
+        controller = get_concurrency_controller(self.model_type.value)
+        attempt = attempt or _Attempt()
+        retry = 0
+        while True:
+            queued = time.monotonic()
+            if limiter is not None:
+                await limiter.aacquire(num_prompt_tokens)
+            lease = await controller.aacquire() if controller is not None else None
+            start = time.monotonic()
+            call["queue_wait"] += start - queued
+            attempt.dispatch(functools.partial(self._release_lease, controller, lease, call["latency_key"], start))
+            outcome = "cancelled"
+            try:
+                response = await client.chat.completions.create(
+                    *args,
+                    **kwargs,
+                    model=self.model_type.value,
+                    **self._stream_kwargs(config, self._streaming(conclusion_pattern))
+                )
+                if self._streaming(conclusion_pattern):
+                    response = await self._arun_stream(response, conclusion_pattern, num_prompt_tokens)
+                outcome = "ok"
+            except openai.APIError as e:
+                outcome = _request_outcome(e)
+                wait = await _in_thread(self._on_error, e, retry, limiter)
+            finally:
+                # the release runs to its end even if the task is cancelled again
+                await _in_thread(attempt.release, outcome)
+            if outcome == "ok":
+                break
+            await asyncio.sleep(wait)
+            retry += 1
+            call["retries"] += 1
+        await _in_thread(self._charge, response, limiter)
+        return response
+
+    async def _ahedged_request(self, args, kwargs, config: Dict, conclusion_pattern: Optional[str],
+                               num_prompt_tokens: int, call: Dict) -> ChatCompletion:
+        r"""Awaitable variant of :obj:`_hedged_request`. The losing request is
+        cancelled, which closes its connection, and its lease is given back
+        at once."""
+        hedger = get_hedger()
+        if hedger is None:
+            return await self._arequest(args, kwargs, config, conclusion_pattern, num_prompt_tokens, call)
+        key = (self.model_type.value, call["latency_key"])
+        delay = hedger.delay(key)
+        attempts = {}
+
+        def submit():
+            attempt = _Attempt()
+            task = asyncio.ensure_future(
+                self._arequest(args, kwargs, config, conclusion_pattern, num_prompt_tokens, call, attempt))
+            attempts[task] = attempt
+            return task
+
+        primary = submit()
+        hedge = False
+        if delay is not None:
+            # the delay counts from the dispatch of the request, not from its wait for the limits
+            while not attempts[primary].sent.is_set() and not primary.done():
+                await asyncio.wait({primary}, timeout=0.05)
+            if not primary.done():
+                timeout = max(0.0, attempts[primary].sent_at + delay - time.monotonic())
+                done, _ = await asyncio.wait({primary}, timeout=timeout)
+                hedge = not done and hedger.try_hedge(num_prompt_tokens)
+        if not hedge:
+            response = await primary
+            winner = attempts[primary]
+        else:
+            self._log_hedge(call, delay, num_prompt_tokens)
+            pending = {primary, submit()}
+            error = None
+            winner = None
+            try:
+                while pending and winner is None:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task.exception() is None:
+                            response = task.result()
+                            winner = attempts[task]
+                            break
+                        error = error or task.exception()
+                if winner is None:
+                    raise error
+            finally:
+                for task, attempt in attempts.items():
+                    if attempt is not winner:
+                        task.cancel()
+                        await _in_thread(attempt.abort)
+        hedger.record(key, time.monotonic() - winner.sent_at, num_prompt_tokens)
+        return response
+
+    async def arun(self, *args, **kwargs) -> Dict[str, Any]:
+        conclusion_pattern = kwargs.pop("conclusion_pattern", None)
+        call = self._start_call(kwargs)
+        num_prompt_tokens, config = self._request_config(kwargs["messages"])
+        cache, cache_key, response = self._lookup_cache(kwargs["messages"], config, conclusion_pattern)
+        if response is not None:
+            call["source"] = "cache"
+            return self._record(call, response)
+        key = cache_key or self._request_key(kwargs["messages"], config, conclusion_pattern)
+
+        async def send():
+            return await self._ahedged_request(args, kwargs, config, conclusion_pattern, num_prompt_tokens, call)
+
+        async def request():
+            if cache is None:
+                return self._finish(await send(), cache, key)
+            async with cache.alock(key):
+                cached = cache.get(key)
+                if cached is not None:
+                    self._log_coalesced(cached, call)
+                    return cached
+                return self._finish(await send(), cache, key)
+
+        response, leader = await _single_flight.ado(key, request)
+        if not leader:
+            self._log_coalesced(response, call)
+        return self._record(call, response)
+
+
+class BatchBackend(ABC):
+    r"""Base class of the services that answer a file of chat completion
+    requests in bulk. The input and output files follow the format of the
+    OpenAI Batch API, one json request per line with a ``custom_id``."""
+
+    @abstractmethod
+    def submit(self, input_path: str) -> str:
+        r"""Submits the requests of the input file.
+
+        Returns:
+            str: The id of the batch.
+        """
+        pass
+
+    @abstractmethod
+    def status(self, batch_id: str) -> str:
+        r"""Returns the status of the batch, the batch is done once it is one
+        of ``completed``, ``failed``, ``expired`` or ``cancelled``."""
+        pass
+
+    @abstractmethod
+    def results(self, batch_id: str) -> List[Dict]:
+        r"""Returns the output lines of a done batch, each one has the
+        ``custom_id`` of its request and either a ``response`` or an
+        ``error``."""
+        pass
+
+
+class OpenAIBatchBackend(BatchBackend):
+    r"""The OpenAI Batch API, completed within 24 hours at a discount."""
+
+    def submit(self, input_path: str) -> str:
+        client = get_openai_client()
+        with open(input_path, "rb") as f:
+            input_file = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions",
+                                      completion_window="24h")
+        return batch.id
+
+    def status(self, batch_id: str) -> str:
+        return get_openai_client().batches.retrieve(batch_id).status
+
+    def results(self, batch_id: str) -> List[Dict]:
+        client = get_openai_client()
+        batch = client.batches.retrieve(batch_id)
+        lines = []
+        for file_id in [batch.output_file_id, batch.error_file_id]:
+            if file_id:
+                lines += [json.loads(line) for line in client.files.content(file_id).text.splitlines() if line]
+        return lines
+
+
+class LocalBatchBackend(BatchBackend):
+    r"""A directory based stand-in of the Batch API. A submitted file is
+    copied to ``<directory>/<batch_id>/input.jsonl`` and answered on the first
+    :obj:`status` poll through the pooled client (e.g., pointed to the mock
+    server), or by anything else that writes ``output.jsonl`` next to it.
+
+    Args:
+        directory (str): The directory of the batches.
+        process (bool, optional): Whether to answer the requests itself.
+            (default: :obj:`True`)
+    """
+
+    def __init__(self, directory: str, process: bool = True) -> None:
+        self.directory = directory
+        self.process = process
+
+    def submit(self, input_path: str) -> str:
+        with open(input_path, "rb") as f:
+            data = f.read()
+        batch_id = "batch_" + hashlib.sha256(data).hexdigest()[:24]
+        batch_dir = os.path.join(self.directory, batch_id)
+        os.makedirs(batch_dir, exist_ok=True)
+        with open(os.path.join(batch_dir, "input.jsonl"), "wb") as f:
+            f.write(data)
+        return batch_id
+
+    def _answer(self, batch_dir: str) -> None:
+        client = get_openai_client()
+        lines = []
+        with open(os.path.join(batch_dir, "input.jsonl"), "r", encoding="utf8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                try:
+                    response = client.chat.completions.create(**request["body"])
+                    lines.append({"custom_id": request["custom_id"], "error": None,
+                                  "response": {"status_code": 200, "body": response.model_dump()}})
+                except openai.APIError as e:
+                    lines.append({"custom_id": request["custom_id"], "response": None,
+                                  "error": {"code": type(e).__name__, "message": str(e)}})
+        tmp_path = os.path.join(batch_dir, "output.jsonl.tmp")
+        with open(tmp_path, "w", encoding="utf8") as f:
+            f.write("".join(json.dumps(line) + "\n" for line in lines))
+        os.replace(tmp_path, os.path.join(batch_dir, "output.jsonl"))
+
+    def status(self, batch_id: str) -> str:
+        batch_dir = os.path.join(self.directory, batch_id)
+        if not os.path.exists(os.path.join(batch_dir, "input.jsonl")):
+            return "failed"
+        if not os.path.exists(os.path.join(batch_dir, "output.jsonl")):
+            if not self.process:
+                return "in_progress"
+            self._answer(batch_dir)
+        return "completed"
+
+    def results(self, batch_id: str) -> List[Dict]:
+        with open(os.path.join(self.directory, batch_id, "output.jsonl"), "r", encoding="utf8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
 
 class StubModel(ModelBackend):
     r"""A dummy model used for unit tests."""
@@ -125,14 +1574,14 @@ class ModelFactory:
     """
 
     @staticmethod
-    def create(model_type: ModelType, model_config_dict: Dict) -> ModelBackend:
+    def create(model_type: ModelType, model_config_dict: Dict, asynchronous: bool = False) -> ModelBackend:
         default_model_type = ModelType.GPT_3_5_TURBO
 
         if model_type in {
             ModelType.GPT_3_5_TURBO, ModelType.GPT_4, ModelType.GPT_4_32k, ModelType.GPT_4_O,
             None
         }:
-            model_class = OpenAIModel
+            model_class = AsyncOpenAIModel if asynchronous else OpenAIModel
         elif model_type == ModelType.STUB:
             model_class = StubModel
         else:
@@ -11,11 +11,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # =========== Copyright 2023 @ CAMEL-AI.org. All Rights Reserved. ===========
+import hashlib
 import os
 import re
+import threading
 import zipfile
-from functools import wraps
-from typing import Any, Callable, List, Optional, Set, TypeVar
+from collections import OrderedDict
+from functools import lru_cache, wraps
+from typing import Any, Callable, List, Optional, Set, Tuple, TypeVar
 
 import requests
 import tiktoken
@@ -28,28 +31,95 @@ F = TypeVar('F', bound=Callable[..., Any])
 import time
 
 
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str) -> Any:
+    r"""Returns the tiktoken encoding of a model, the encodings are built
+    once per process.
+
+    Args:
+        model_name (str): The name of the model, unknown models fall back to
+            the :obj:`cl100k_base` encoding.
+
+    Returns:
+        Any: The encoding of the model.
+    """
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+# memo of num_tokens_from_string, keyed by a digest of the string so that the
+# multi-KB prompts are not kept alive by the memo
+_TOKEN_COUNTS_SIZE = 8192
+_token_counts: "OrderedDict[Tuple[bytes, str], int]" = OrderedDict()
+_token_counts_lock = threading.Lock()
+
+
+def num_tokens_from_string(text: str, model_name: str) -> int:
+    r"""Returns the number of tokens of a string, memoized since the same
+    prompts and docs are counted again and again.
+
+    Args:
+        text (str): The string to encode.
+        model_name (str): The name of the model.
+
+    Returns:
+        int: The number of tokens of the string.
+    """
+    key = (hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest(), model_name)
+    with _token_counts_lock:
+        num_tokens = _token_counts.get(key)
+        if num_tokens is not None:
+            _token_counts.move_to_end(key)
+            return num_tokens
+    num_tokens = len(get_encoding(model_name).encode(text))
+    with _token_counts_lock:
+        _token_counts[key] = num_tokens
+        if len(_token_counts) > _TOKEN_COUNTS_SIZE:
+            _token_counts.popitem(last=False)
+    return num_tokens
+
+
+def count_tokens_openai_message(
+        message: OpenAIMessage,
+        model_name: str,
+) -> int:
+    r"""Counts the number of tokens of a single message of an OpenAI chat.
+
+    Args:
+        message (OpenAIMessage): The message.
+        model_name (str): The name of the model to encode with.
+
+    Returns:
+        int: The number of tokens of the message.
+    """
+    # message follows <im_start>{role/name}\n{content}<im_end>\n
+    num_tokens = 4
+    for key, value in message.items():
+        num_tokens += num_tokens_from_string(value, model_name)
+        if key == "name":  # if there's a name, the role is omitted
+            num_tokens += -1  # role is always 1 token
+    return num_tokens
+
+
 def count_tokens_openai_chat_models(
         messages: List[OpenAIMessage],
-        encoding: Any,
+        model_name: str,
 ) -> int:
     r"""Counts the number of tokens required to generate an OpenAI chat based
     on a given list of messages.
 
     Args:
         messages (List[OpenAIMessage]): The list of messages.
-        encoding (Any): The encoding method to use.
+        model_name (str): The name of the model to encode with.
 
     Returns:
         int: The number of tokens required.
     """
     num_tokens = 0
     for message in messages:
-        # message follows <im_start>{role/name}\n{content}<im_end>\n
-        num_tokens += 4
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":  # if there's a name, the role is omitted
-                num_tokens += -1  # role is always 1 token
+        num_tokens += count_tokens_openai_message(message, model_name)
     num_tokens += 2  # every reply is primed with <im_start>assistant
     return num_tokens
 
@@ -76,17 +146,11 @@ def num_tokens_from_messages(
         - https://platform.openai.com/docs/models/gpt-4
         - https://platform.openai.com/docs/models/gpt-3-5
     """
-    try:
-        value_for_tiktoken = model.value_for_tiktoken
-        encoding = tiktoken.encoding_for_model(value_for_tiktoken)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-
     if model in {
         ModelType.GPT_3_5_TURBO, ModelType.GPT_4, ModelType.GPT_4_32k, ModelType.GPT_4_O,
         ModelType.STUB
     }:
-        return count_tokens_openai_chat_models(messages, encoding)
+        return count_tokens_openai_chat_models(messages, model.value_for_tiktoken)
     else:
         raise NotImplementedError(
             f"`num_tokens_from_messages`` is not presently implemented "
@@ -1,19 +1,24 @@
+import copy
+import functools
 import importlib
 import json
 import logging
 import os
 import shutil
 import time
+from concurrent.futures import FIRST_COMPLETED, Executor, ThreadPoolExecutor, wait
 from datetime import datetime
 from typing import List
 
 from camel.agents import RolePlaying
 from camel.configs import ChatGPTConfig
+from camel.model_backend import set_usage_ledger
 from camel.typing import ModelType, TaskType
 from chatdev.chat_env import ChatEnv, ChatEnvConfig
 from chatdev.statistics import get_info
 from chatdev.test_suite import TestCase, TestSuite
-from chatdev.utils import log_online, now
+from chatdev.utils import log_online, now, stop_logging
+from functions.func import covered_classes_prompt
 
 
 def check_bool(s):
@@ -68,6 +73,8 @@ class ChatChain:
 
         # init chatchain config and recruitments
         self.chain = self.config["chain"]
+        # "chain" runs the phases one after another, "dag" runs the independent phases concurrently
+        self.scheduler = self.config.get("scheduler", "chain")
         self.recruitments = self.config["recruitments"]
 
         # init default max chat turn
@@ -86,7 +93,12 @@ class ChatChain:
                                              class_doc_tokens=self.config["class_doc_tokens"],
                                              method_doc_tokens=self.config["method_doc_tokens"],
                                              num_selected_classes=self.config["num_selected_classes"],
-                                             basement=self.config["basement"])
+                                             basement=self.config["basement"],
+                                             stream=check_bool(self.config.get("stream", "False")),
+                                             prompt_layout=self.config.get("prompt_layout", "original"),
+                                             max_concurrency=int(self.config.get("max_concurrency", 1)),
+                                             concurrent_suites=check_bool(self.config.get("concurrent_suites", "False")),
+                                             prefetch=check_bool(self.config.get("prefetch", "False")))
         self.chat_env = ChatEnv(self.chat_env_config)
 
         # init role prompts
@@ -100,19 +112,34 @@ class ChatChain:
         self.directory = project_path
         self.cache_dir = cache_dir
         self.start_time, self.log_filepath = self.get_logfilepath()
+        # every model call of the run is recorded into the usage ledger next to the log
+        self.ledger_filepath = os.path.splitext(self.log_filepath)[0] + ".usage.jsonl"
+        set_usage_ledger(self.ledger_filepath)
 
-        # init SimplePhase instances
-        # import all used phases in PhaseConfig.json from chatdev.phase
-        # note that in PhaseConfig.json there only exist SimplePhases
-        # ComposedPhases are defined in ChatChainConfig.json and will be imported in self.execute_step
         self.compose_phase_module = importlib.import_module("chatdev.composed_phase")
         self.phase_module = importlib.import_module("chatdev.phase")
+        self.make_phases()
+
+    def make_phases(self):
+        """
+        init SimplePhase instances
+        import all used phases in PhaseConfig.json from chatdev.phase
+        note that in PhaseConfig.json there only exist SimplePhases
+        ComposedPhases are defined in ChatChainConfig.json and will be imported in self.execute_step
+        Returns: None
+
+        """
         self.phases = dict()
         for phase in self.config_phase:
             assistant_role_name = self.config_phase[phase]['assistant_role_name']
             user_role_name = self.config_phase[phase]['user_role_name']
-            phase_prompt = "\n\n".join(self.config_phase[phase]['phase_prompt'])
             phase_class = getattr(self.phase_module, phase)
+            phase_prompt = self.config_phase[phase]['phase_prompt']
+            if self.chat_env_config.prompt_layout == "prefix_cache":
+                phase_prompt = phase_class.prefix_cache_layout(phase_prompt)
+            elif self.chat_env_config.prompt_layout != "original":
+                raise ValueError(f"Unknown prompt_layout: {self.chat_env_config.prompt_layout}")
+            phase_prompt = "\n\n".join(phase_prompt)
             phase_instance = phase_class(assistant_role_name=assistant_role_name,
                                          user_role_name=user_role_name,
                                          phase_prompt=phase_prompt,
@@ -122,7 +149,50 @@ class ChatChain:
                                          log_filepath=self.log_filepath)
             self.phases[phase] = phase_instance
 
+    def fork(self, test_suite: TestSuite, test_cases: List[TestCase]) -> "ChatChain":
+        """
+        copy the chain for a test suite, the copy has its own ChatEnv and phase instances,
+        so that the test suites of a bug can run concurrently, the log and the usage ledger are shared
+        Returns:
+            the chain of the test suite
 
+        """
+        chain = copy.copy(self)
+        chain.test_suite = test_suite
+        chain.test_cases = test_cases
+        chain.chat_env = ChatEnv(self.chat_env_config)
+        chain.chat_env.prefetched = self.chat_env.prefetched
+        chain.make_phases()
+        return chain
+
+    def merge(self, chains: List["ChatChain"]):
+        """
+        merge the results of the chains of the test suites (see self.fork) in the order of the test suites,
+        the same way as the test suites run one after another on this chain
+        Returns: None
+
+        """
+        for chain in chains:
+            self.chat_env.merge_result(chain.chat_env)
+            self.chat_env.set_directory(chain.chat_env.env_dict['directory'])
+
+    def prefetch(self, executor: Executor, test_suite: TestSuite):
+        """
+        start the coverage based class extraction of SearchSuspiciousClass for a test suite in the background,
+        so that running the tests under instrumentation overlaps the chats of the earlier phases
+        Args:
+            executor: the executor of the background work
+            test_suite: the selected test suite
+
+        Returns: None
+
+        """
+        if "SearchSuspiciousClass" not in [phase_item['phase'] for phase_item in self.chain]:
+            return
+        self.chat_env.prefetched[("SearchSuspiciousClass", test_suite.name)] = executor.submit(
+            covered_classes_prompt, self.d4j_version, self.project_name, self.bug_ID, self.directory,
+            self.cache_dir, test_suite, self.model_type, class_doc_tokens=self.chat_env_config.class_doc_tokens,
+            basement=self.chat_env_config.basement)
 
     def make_recruitment(self):
         """
@@ -179,9 +249,67 @@ class ChatChain:
         Returns: None
 
         """
+        if self.scheduler == "dag":
+            self.execute_dag()
+            return
         for phase_item in self.chain:
             self.execute_step(phase_item)
 
+    def make_dag(self):
+        """
+        the steps of the chain and their dependencies based on the keys of chat_env.env_dict that the phases read
+        and write (Phase.reads/writes, or "reads"/"writes" of the phase in ChatChainConfig.json).
+        a step depends on the earlier steps that write the keys it reads, or read or write the keys it writes,
+        a phase without declared keys depends on all earlier steps and all later steps depend on it.
+        the prepare step of a phase (see Phase.prepare) is a step of its own before the phase
+        Returns:
+            steps: list of (name, func, reads, writes)
+            deps: the indices of the steps each step depends on
+
+        """
+        steps = []
+        for phase_item in self.chain:
+            phase = self.phases.get(phase_item['phase']) if phase_item['phaseType'] == "SimplePhase" else None
+            reads = phase_item.get('reads', phase.reads if phase else None)
+            writes = phase_item.get('writes', phase.writes if phase else None)
+            prepare_writes = phase_item.get('prepare_writes', phase.prepare_writes if phase else ())
+            if phase and prepare_writes:
+                steps.append((phase_item['phase'] + ".prepare", functools.partial(phase.prepare, self.chat_env),
+                              (), prepare_writes))
+            steps.append((phase_item['phase'], functools.partial(self.execute_step, phase_item), reads, writes))
+
+        deps = []
+        for j, (_, _, reads, writes) in enumerate(steps):
+            deps.append({i for i, (_, _, r, w) in enumerate(steps[:j])
+                         if None in (r, w, reads, writes)
+                         or set(w) & set(reads) or set(r) & set(writes) or set(w) & set(writes)})
+        return steps, deps
+
+    def execute_dag(self):
+        """
+        execute the chain as a DAG, every step starts as soon as the steps it depends on are finished (see make_dag)
+        Returns: None
+
+        """
+        steps, deps = self.make_dag()
+        log_online("**[Phase DAG]**\n\n" + "\n\n".join(
+            "{} <- {}".format(steps[j][0], ", ".join(steps[i][0] for i in sorted(deps[j])) or "None")
+            for j in range(len(steps))))
+
+        done = set()
+        running = dict()
+        # a failed step stops the scheduling, the running steps are finished before the error is raised
+        with ThreadPoolExecutor(max_workers=len(steps)) as executor:
+            while len(done) < len(steps):
+                for j, (_, func, _, _) in enumerate(steps):
+                    if j not in done and j not in running.values() and deps[j] <= done:
+                        running[executor.submit(func)] = j
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    j = running.pop(future)
+                    future.result()
+                    done.add(j)
+
 
     def get_logfilepath(self):
         """
@@ -221,6 +349,7 @@ class ChatChain:
         preprocess_msg += "**bug_ID**: {}\n\n".format(self.bug_ID)
         preprocess_msg += "**test_suite**: {}\n\n".format(str(self.test_suite.name))
         preprocess_msg += "**Log File**: {}\n\n".format(self.log_filepath)
+        preprocess_msg += "**Usage Ledger**: {}\n\n".format(self.ledger_filepath)
         preprocess_msg += "**ChatDevConfig**:\n {}\n\n".format(self.chat_env.config.__str__())
         preprocess_msg += "**ChatGPTConfig**:\n {}\n\n".format(chat_gpt_config)
         log_online(preprocess_msg)
@@ -253,7 +382,7 @@ class ChatChain:
         duration = (datetime2 - datetime1).total_seconds()
 
         post_info += "Software Info: {}".format(
-            get_info(directory, self.log_filepath) + "\n\n**duration**={:.2f}s\n\n".format(duration))
+            get_info(directory, self.log_filepath, self.ledger_filepath) + "\n\n**duration**={:.2f}s\n\n".format(duration))
 
         post_info += "DebugDev Starts ({})".format(self.start_time) + "\n\n"
         post_info += "DebugDev Ends ({})".format(now_time) + "\n\n"
@@ -268,6 +397,7 @@ class ChatChain:
         os.system(f"rm -rf {buggy_path}")
         os.system(f"rm -rf {fixed_path}")
 
+        stop_logging()
         logging.shutdown()
         time.sleep(1)
 
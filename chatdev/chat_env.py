@@ -30,7 +30,12 @@ class ChatEnvConfig:
                  class_doc_tokens,
                  method_doc_tokens,
                  num_selected_classes,
-                 basement):
+                 basement,
+                 stream=False,
+                 prompt_layout="original",
+                 max_concurrency=1,
+                 concurrent_suites=False,
+                 prefetch=False):
         self.config_name = config_name
         self.clear_structure = clear_structure
         self.brainstorming = brainstorming
@@ -44,6 +49,11 @@ class ChatEnvConfig:
         self.method_doc_tokens = method_doc_tokens
         self.num_selected_classes = num_selected_classes
         self.basement = basement
+        self.stream = stream
+        self.prompt_layout = prompt_layout
+        self.max_concurrency = max_concurrency
+        self.concurrent_suites = concurrent_suites
+        self.prefetch = prefetch
 
     def __str__(self):
         string = ""
@@ -57,6 +67,11 @@ class ChatEnvConfig:
         string += "ChatEnvConfig.method_doc_tokens: {}\n".format(self.method_doc_tokens)
         string += "ChatEnvConfig.num_selected_classes: {}\n".format(self.num_selected_classes)
         string += "ChatEnvConfig.basement: {}\n".format(self.basement)
+        string += "ChatEnvConfig.stream: {}\n".format(self.stream)
+        string += "ChatEnvConfig.prompt_layout: {}\n".format(self.prompt_layout)
+        string += "ChatEnvConfig.max_concurrency: {}\n".format(self.max_concurrency)
+        string += "ChatEnvConfig.concurrent_suites: {}\n".format(self.concurrent_suites)
+        string += "ChatEnvConfig.prefetch: {}\n".format(self.prefetch)
         return string
 
 
@@ -70,6 +85,8 @@ class ChatEnv:
         self.requirements: Documents = Documents()
         self.manuals: Documents = Documents()
         self.if_run_search = True
+        self.pending_batch = False  # some requests are collected into a batch, the result is incomplete
+        self.prefetched = {}  # (phase name, test suite name) -> Future of the local work started in the background
         self.res_dict = {
             "buggy_classes": [],
             "buggy_methods": [],  # buggy methods for all test suites
@@ -87,12 +104,38 @@ class ChatEnv:
             "test_codes": "",
             "test_behavior": "",
             "test_failure_causes": "",
+            "covered_classes": None,  # None until the coverage of the test suite is extracted
             "classes_dict": {},
             "suspicious_classes": [],
             "suspicious_methods": {},
             "directory": ""
         }
 
+    def add_buggy_method(self, buggy_method, buggy_code):
+        method_name = buggy_method['method_name']
+        if method_name not in self.res_dict['buggy_codes']:
+            self.res_dict['buggy_codes'][method_name] = buggy_code
+            self.res_dict['buggy_methods'].append(buggy_method)
+        else:
+            # we keep the highest score as the final score
+            for old_buggy_method in self.res_dict['buggy_methods']:
+                if old_buggy_method['method_name'] == method_name:
+                    old_score = old_buggy_method['score']
+                    if buggy_method['score'] > old_score:
+                        old_buggy_method['score'] = buggy_method['score']
+                    break
+
+    def merge_result(self, chat_env):
+        """merge the result of another test suite of the bug, as if it ran after the test suites of this ChatEnv.
+        """
+        if chat_env.res_dict['buggy_classes']:
+            self.res_dict['buggy_classes'] = chat_env.res_dict['buggy_classes']
+        for buggy_method in chat_env.res_dict['buggy_methods']:
+            self.add_buggy_method(dict(buggy_method),
+                                  dict(chat_env.res_dict['buggy_codes'][buggy_method['method_name']]))
+        self.pending_batch = self.pending_batch or chat_env.pending_batch
+        self.res_dict['buggy_methods'] = sorted(self.res_dict['buggy_methods'], key=lambda x: x['score'], reverse=True)
+
     @staticmethod
     def fix_module_not_found_error(test_reports):
         if "ModuleNotFoundError" in test_reports:
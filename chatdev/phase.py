@@ -1,13 +1,18 @@
+import asyncio
+import hashlib
+import json
 import os
 import re
 from abc import ABC, abstractmethod
 
 from camel.agents import RolePlaying
+from camel.configs import ChatGPTConfig
 from camel.messages import ChatMessage
+from camel.model_backend import LLM_BATCH_DIR, close_async_openai_client
 from camel.typing import ModelType, TaskType
 from chatdev.chat_env import ChatEnv
 from chatdev.statistics import get_info
-from chatdev.utils import log_arguments, log_online
+from chatdev.utils import log_arguments, log_online, write_file_atomic
 from functions.func import (
     all_methods_code_prompt,
     buggy_codes_prompt,
@@ -24,6 +29,14 @@ from functions.func import (
 
 
 class Phase(ABC):
+    # placeholders of the phase prompt that change with every chat of the phase in a test suite,
+    # e.g., the method under review, see prefix_cache_layout
+    item_placeholders = ()
+    # keys of chat_env.env_dict read and written by the phase, phases without them run one after another,
+    # see ChatChain.execute_dag. prepare_writes are the keys written by self.prepare
+    reads = None
+    writes = None
+    prepare_writes = ()
 
     def __init__(self,
                  assistant_role_name,
@@ -55,6 +68,136 @@ class Phase(ABC):
         self.model_type = model_type
         self.log_filepath = log_filepath
 
+    @classmethod
+    def prefix_cache_layout(cls, paragraphs):
+        """
+        reorder the paragraphs of the phase prompt, so that the invariant context (test infos, failure causes, ...)
+        comes first as a byte-identical prefix for the prompt caching of the provider, then the paragraphs with
+        the item placeholders, then the trailing instructions.
+        a paragraph ending with a colon is a label kept together with the next paragraph
+        Args:
+            paragraphs: paragraphs of the phase prompt in PhaseConfig.json
+
+        Returns:
+            the reordered paragraphs
+        """
+        blocks = []
+        for paragraph in paragraphs:
+            if blocks and blocks[-1][-1].rstrip().endswith(":"):
+                blocks[-1].append(paragraph)
+            else:
+                blocks.append([paragraph])
+        is_item = [any("{" + p + "}" in paragraph for paragraph in block for p in cls.item_placeholders)
+                   for block in blocks]
+        if not any(is_item):
+            return list(paragraphs)
+        last_item = max(i for i, item in enumerate(is_item) if item)
+        head = [block for i, block in enumerate(blocks[:last_item + 1]) if not is_item[i]]
+        items = [block for i, block in enumerate(blocks[:last_item + 1]) if is_item[i]]
+        tail = blocks[last_item + 1:]
+        return [paragraph for block in head + items + tail for paragraph in block]
+
+    def _start_chatting(self, chat_env, assistant_role_name, user_role_name, phase_prompt,
+                        assistant_role_prompt, user_role_prompt, task_type, model_type,
+                        placeholders, chat_turn_limit, asynchronous=False, conclusion_pattern=None):
+        """
+        check the roles, init the role play session and start the chat
+        if streaming is enabled, the answer of the assistant is cut off once it matches conclusion_pattern
+        Returns:
+            role_play_session: the role play session of this chat
+            input_user_msg: the first message sent to the assistant
+        """
+        if placeholders is None:
+            placeholders = {}
+        assert 1 <= chat_turn_limit <= 100
+
+        if not chat_env.exist_employee(assistant_role_name):
+            raise ValueError(f"{assistant_role_name} not recruited in ChatEnv.")
+        if not chat_env.exist_employee(user_role_name):
+            raise ValueError(f"{user_role_name} not recruited in ChatEnv.")
+
+        # the latencies are tracked per phase for hedging the slow completions
+        call_info = dict(bug=os.path.basename(os.path.normpath(chat_env.env_dict['directory'])),
+                         suite=chat_env.test_suite.name, phase=self.phase_name)
+        agent_kwargs = dict(asynchronous=asynchronous, latency_key=self.phase_name, call_info=call_info)
+        assistant_agent_kwargs = dict(agent_kwargs)
+        if conclusion_pattern is not None and chat_env.config.stream:
+            assistant_agent_kwargs.update(model_config=ChatGPTConfig(stream=True),
+                                          conclusion_pattern=conclusion_pattern)
+
+        # init role play
+        role_play_session = RolePlaying(
+            assistant_role_name=assistant_role_name,
+            user_role_name=user_role_name,
+            assistant_role_prompt=assistant_role_prompt,
+            user_role_prompt=user_role_prompt,
+            task_type=task_type,
+            model_type=model_type,
+            assistant_agent_kwargs=assistant_agent_kwargs,
+            user_agent_kwargs=agent_kwargs,
+        )
+
+        # log_online("System", role_play_session.assistant_sys_msg)
+        # log_online("System", role_play_session.user_sys_msg)
+
+        # start the chat
+        _, input_user_msg = role_play_session.init_chat(None, placeholders, phase_prompt)
+        return role_play_session, input_user_msg
+
+    @staticmethod
+    def _process_turn(role_play_session, assistant_response, user_response, conversation_meta, chat_turn_limit):
+        """
+        log the responses of one chat turn and decide whether the chat goes on
+        Returns:
+            seminar_conclusion: the conclusion marked by "<INFO>", None if there is no such conclusion
+            next_user_msg: the message to start the next turn, None if the chat is over
+        """
+        # TODO: max_tokens_exceeded errors here
+        if isinstance(assistant_response.msg, ChatMessage):
+            # we log the second interaction here
+            log_online(role_play_session.assistant_agent.role_name,
+                                 conversation_meta + "[" + role_play_session.user_agent.system_message.content + "]\n\n" + assistant_response.msg.content)
+            if role_play_session.assistant_agent.info:
+                return assistant_response.msg.content, None
+            if assistant_response.terminated:
+                return None, None
+
+        if isinstance(user_response.msg, ChatMessage):
+            # here is the result of the second interaction, which may be used to start the next chat turn
+            log_online(role_play_session.user_agent.role_name,
+                                 conversation_meta + "[" + role_play_session.assistant_agent.system_message.content + "]\n\n" + user_response.msg.content)
+            if role_play_session.user_agent.info:
+                return user_response.msg.content, None
+            if user_response.terminated:
+                return None, None
+
+        # continue the chat
+        if chat_turn_limit > 1 and isinstance(user_response.msg, ChatMessage):
+            return None, user_response.msg
+        return None, None
+
+    def _conclude(self, chat_env, role_play_session, assistant_response, seminar_conclusion, phase_name,
+                  need_reflect) -> str:
+        # conduct self reflection
+        if need_reflect:
+            if seminar_conclusion in [None, ""]:
+                seminar_conclusion = "<INFO> " + self.self_reflection(role_play_session, phase_name,
+                                                                      chat_env)
+            if "recruiting" in phase_name:
+                if "Yes".lower() not in seminar_conclusion.lower() and "No".lower() not in seminar_conclusion.lower():
+                    seminar_conclusion = "<INFO> " + self.self_reflection(role_play_session,
+                                                                          phase_name,
+                                                                          chat_env)
+            elif seminar_conclusion in [None, ""]:
+                seminar_conclusion = "<INFO> " + self.self_reflection(role_play_session, phase_name,
+                                                                      chat_env)
+        else:
+            seminar_conclusion = assistant_response.msg.content
+
+        log_online("**[Seminar Conclusion]**:\n\n {}".format(seminar_conclusion))
+        seminar_conclusion = seminar_conclusion.split("<INFO>")[-1]
+        return seminar_conclusion
+
     @log_arguments
     def chatting(
             self,
@@ -69,7 +212,8 @@ class Phase(ABC):
             need_reflect=False,
             model_type=ModelType.GPT_3_5_TURBO,
             placeholders=None,
-            chat_turn_limit=10
+            chat_turn_limit=10,
+            conclusion_pattern=None
     ) -> str:
         """
 
@@ -86,35 +230,16 @@ class Phase(ABC):
             model_type: model type
             placeholders: placeholders for phase environment to generate phase prompt
             chat_turn_limit: turn limits in each chat
+            conclusion_pattern: regex of the expected answer, the streamed answer is cut off once it matches
 
         Returns:
 
         """
-
-        if placeholders is None:
-            placeholders = {}
-        assert 1 <= chat_turn_limit <= 100
-
-        if not chat_env.exist_employee(assistant_role_name):
-            raise ValueError(f"{assistant_role_name} not recruited in ChatEnv.")
-        if not chat_env.exist_employee(user_role_name):
-            raise ValueError(f"{user_role_name} not recruited in ChatEnv.")
-
-        # init role play
-        role_play_session = RolePlaying(
-            assistant_role_name=assistant_role_name,
-            user_role_name=user_role_name,
-            assistant_role_prompt=assistant_role_prompt,
-            user_role_prompt=user_role_prompt,
-            task_type=task_type,
-            model_type=model_type,
-        )
-
-        # log_online("System", role_play_session.assistant_sys_msg)
-        # log_online("System", role_play_session.user_sys_msg)
-
-        # start the chat
-        _, input_user_msg = role_play_session.init_chat(None, placeholders, phase_prompt)
+        role_play_session, input_user_msg = self._start_chatting(chat_env, assistant_role_name, user_role_name,
+                                                                 phase_prompt, assistant_role_prompt,
+                                                                 user_role_prompt, task_type, model_type,
+                                                                 placeholders, chat_turn_limit,
+                                                                 conclusion_pattern=conclusion_pattern)
         seminar_conclusion = None
 
         # handle chats
@@ -137,52 +262,88 @@ class Phase(ABC):
             conversation_meta = "**" + assistant_role_name + "<->" + user_role_name + " on : " + str(
                 phase_name) + ", turn " + str(i) + "**\n\n"
 
-            # TODO: max_tokens_exceeded errors here
-            if isinstance(assistant_response.msg, ChatMessage):
-                # we log the second interaction here
-                log_online(role_play_session.assistant_agent.role_name,
-                                     conversation_meta + "[" + role_play_session.user_agent.system_message.content + "]\n\n" + assistant_response.msg.content)
-                if role_play_session.assistant_agent.info:
-                    seminar_conclusion = assistant_response.msg.content
-                    break
-                if assistant_response.terminated:
-                    break
-
-            if isinstance(user_response.msg, ChatMessage):
-                # here is the result of the second interaction, which may be used to start the next chat turn
-                log_online(role_play_session.user_agent.role_name,
-                                     conversation_meta + "[" + role_play_session.assistant_agent.system_message.content + "]\n\n" + user_response.msg.content)
-                if role_play_session.user_agent.info:
-                    seminar_conclusion = user_response.msg.content
-                    break
-                if user_response.terminated:
-                    break
-
-            # continue the chat
-            if chat_turn_limit > 1 and isinstance(user_response.msg, ChatMessage):
-                input_user_msg = user_response.msg
-            else:
+            seminar_conclusion, input_user_msg = self._process_turn(role_play_session, assistant_response,
+                                                                    user_response, conversation_meta,
+                                                                    chat_turn_limit)
+            if input_user_msg is None:
                 break
 
-        # conduct self reflection
-        if need_reflect:
-            if seminar_conclusion in [None, ""]:
-                seminar_conclusion = "<INFO> " + self.self_reflection(role_play_session, phase_name,
-                                                                      chat_env)
-            if "recruiting" in phase_name:
-                if "Yes".lower() not in seminar_conclusion.lower() and "No".lower() not in seminar_conclusion.lower():
-                    seminar_conclusion = "<INFO> " + self.self_reflection(role_play_session,
-                                                                          phase_name,
-                                                                          chat_env)
-            elif seminar_conclusion in [None, ""]:
-                seminar_conclusion = "<INFO> " + self.self_reflection(role_play_session, phase_name,
-                                                                      chat_env)
-        else:
-            seminar_conclusion = assistant_response.msg.content
+        return self._conclude(chat_env, role_play_session, assistant_response, seminar_conclusion, phase_name,
+                              need_reflect)
 
-        log_online("**[Seminar Conclusion]**:\n\n {}".format(seminar_conclusion))
-        seminar_conclusion = seminar_conclusion.split("<INFO>")[-1]
-        return seminar_conclusion
+    @log_arguments
+    async def achatting(
+            self,
+            chat_env,
+            assistant_role_name: str,
+            user_role_name: str,
+            phase_prompt: str,
+            phase_name: str,
+            assistant_role_prompt: str,
+            user_role_prompt: str,
+            task_type=TaskType.CHATDEV,
+            need_reflect=False,
+            model_type=ModelType.GPT_3_5_TURBO,
+            placeholders=None,
+            chat_turn_limit=10,
+            conclusion_pattern=None
+    ) -> str:
+        """
+        awaitable variant of self.chatting, the completions are awaited on the event loop,
+        so that many chats can be in flight at the same time
+        Args:
+            the same as self.chatting
+
+        Returns:
+
+        """
+        role_play_session, input_user_msg = self._start_chatting(chat_env, assistant_role_name, user_role_name,
+                                                                 phase_prompt, assistant_role_prompt,
+                                                                 user_role_prompt, task_type, model_type,
+                                                                 placeholders, chat_turn_limit,
+                                                                 asynchronous=True,
+                                                                 conclusion_pattern=conclusion_pattern)
+        seminar_conclusion = None
+
+        for i in range(chat_turn_limit):
+            assistant_response, user_response = await role_play_session.astep(input_user_msg, chat_turn_limit == 1)
+
+            conversation_meta = "**" + assistant_role_name + "<->" + user_role_name + " on : " + str(
+                phase_name) + ", turn " + str(i) + "**\n\n"
+
+            seminar_conclusion, input_user_msg = self._process_turn(role_play_session, assistant_response,
+                                                                    user_response, conversation_meta,
+                                                                    chat_turn_limit)
+            if input_user_msg is None:
+                break
+
+        return self._conclude(chat_env, role_play_session, assistant_response, seminar_conclusion, phase_name,
+                              need_reflect)
+
+    def prepare(self, chat_env):
+        """
+        local work of the phase (e.g., running the tests under instrumentation) that only needs the bug and the
+        test suite, not the conclusions of other phases. The DAG scheduler runs it ahead of the phase,
+        it writes the keys in self.prepare_writes
+        Args:
+            chat_env: global chat chain environment
+
+        Returns: None
+
+        """
+        pass
+
+    def get_conclusion_pattern(self, chat_env):
+        """
+        regex of the part of the answer parsed by self.update_chat_env, nothing after it is needed,
+        so a streamed answer stops there. None (default) keeps the whole answer
+        Args:
+            chat_env: global chat chain environment
+
+        Returns:
+            the regex or None
+        """
+        return None
 
     @abstractmethod
     def update_phase_env(self, chat_env):
@@ -220,27 +381,26 @@ class Phase(ABC):
         pass
     
     
-    def save_conclusion(self, chat_env, sub_phase_name=None) -> None:
-        """save the output content of current phase to the directory.
+    def checkpoint_path(self, chat_env, sub_phase_name=None) -> str:
+        """the file of the output content of current phase.
         """
         ckpt_dir = os.path.join(chat_env.env_dict['directory'], "checkpoint", chat_env.test_suite.name)
         if sub_phase_name:
-            content_file = os.path.join(ckpt_dir, f"{self.phase_name}_{sub_phase_name}.txt")
-        else:
-            content_file = os.path.join(ckpt_dir, self.phase_name + ".txt")
-        if not os.path.exists(ckpt_dir):
-            os.makedirs(ckpt_dir, exist_ok=True)
-        with open(content_file, "w") as f:
-            f.write(self.seminar_conclusion)
+            return os.path.join(ckpt_dir, f"{self.phase_name}_{sub_phase_name}.txt")
+        return os.path.join(ckpt_dir, self.phase_name + ".txt")
+
+    def save_conclusion(self, chat_env, sub_phase_name=None, conclusion=None) -> None:
+        """save the output content of current phase (self.seminar_conclusion by default) to the directory.
+        the file is replaced atomically, an interrupted run never leaves a truncated checkpoint behind.
+        """
+        if conclusion is None:
+            conclusion = self.seminar_conclusion
+        write_file_atomic(self.checkpoint_path(chat_env, sub_phase_name), conclusion)
     
     def load_conclusion(self, chat_env, sub_phase_name=None) -> None:
         """load the output content of current phase from the directory.
         """
-        ckpt_dir = os.path.join(chat_env.env_dict['directory'], "checkpoint", chat_env.test_suite.name)
-        if sub_phase_name:
-            content_file = os.path.join(ckpt_dir, f"{self.phase_name}_{sub_phase_name}.txt")
-        else:
-            content_file = os.path.join(ckpt_dir, self.phase_name + ".txt")
+        content_file = self.checkpoint_path(chat_env, sub_phase_name)
         if os.path.exists(content_file):
             with open(content_file, "r") as f:
                 self.seminar_conclusion = f.read()
@@ -250,6 +410,119 @@ class Phase(ABC):
         else:
             return False
 
+    def collect_batch(self, chat_env, chat_turn_limit, need_reflect, sub_phase_name=None) -> bool:
+        """collect the request of the chatting into the batch file of the bug instead of chatting.
+        only single turn chats without reflection are collected, their conclusion is the answer of the assistant,
+        which is written to the checkpoint of the phase once the batch is completed (see run_all.py).
+        Returns:
+            whether the request is collected
+        """
+        if LLM_BATCH_DIR is None or chat_turn_limit != 1 or need_reflect:
+            return False
+        role_play_session, input_user_msg = self._start_chatting(chat_env, self.assistant_role_name,
+                                                                 self.user_role_name, self.phase_prompt,
+                                                                 self.assistant_role_prompt, self.user_role_prompt,
+                                                                 TaskType.CHATDEV, self.model_type, self.phase_env,
+                                                                 chat_turn_limit)
+        assistant_agent = role_play_session.assistant_agent
+        openai_messages, _ = assistant_agent._prepare_messages(input_user_msg.set_user_role_at_backend())
+        content_file = self.checkpoint_path(chat_env, sub_phase_name)
+        request = {
+            "custom_id": hashlib.md5(content_file.encode()).hexdigest(),
+            "checkpoint": content_file,
+            "body": assistant_agent.model_backend.make_request_body(openai_messages),
+        }
+        bug_name = os.path.basename(os.path.normpath(chat_env.env_dict['directory']))
+        batch_file = os.path.join(LLM_BATCH_DIR, "requests", bug_name + ".jsonl")
+        os.makedirs(os.path.dirname(batch_file), exist_ok=True)
+        with open(batch_file, "a", encoding="utf8") as f:
+            f.write(json.dumps(request) + "\n")
+        chat_env.pending_batch = True
+        log_online("**[Batch Request]**:\n\n {}".format(content_file))
+        return True
+
+    def chat_items(self, chat_env, items, chat_turn_limit, need_reflect, batch=False):
+        """chat for each item of the phase (e.g., each suspicious class), the chats of the items are independent.
+        up to chat_env.config.max_concurrency chats are in flight at the same time, the placeholders of all items
+        are prepared before, and the conclusion of each chat is checkpointed as soon as it arrives.
+        Args:
+            items: list of (sub_phase_name, args), the placeholders of an item are self.phase_env after
+                self.update_phase_env(chat_env, *args), its checkpoint is named by sub_phase_name
+            batch: collect the requests into the batch file instead of chatting in batch mode (see collect_batch)
+
+        Returns:
+            list of (placeholders, conclusion) in the order of the items, the conclusion of a collected item is None
+        """
+        results = []
+        pending = []
+        for index, (sub_phase_name, args) in enumerate(items):
+            self.update_phase_env(chat_env, *args)
+            placeholders = dict(self.phase_env)
+            if self.load_conclusion(chat_env, sub_phase_name):
+                results.append((placeholders, self.seminar_conclusion))
+            elif batch and self.collect_batch(chat_env, chat_turn_limit, need_reflect, sub_phase_name):
+                results.append((placeholders, None))
+            else:
+                results.append((placeholders, None))
+                pending.append(index)
+
+        if chat_env.config.max_concurrency <= 1:
+            for index in pending:
+                sub_phase_name, placeholders = items[index][0], results[index][0]
+                conclusion = self.chatting(chat_env=chat_env,
+                                           need_reflect=need_reflect,
+                                           assistant_role_name=self.assistant_role_name,
+                                           user_role_name=self.user_role_name,
+                                           phase_prompt=self.phase_prompt,
+                                           phase_name=self.phase_name,
+                                           assistant_role_prompt=self.assistant_role_prompt,
+                                           user_role_prompt=self.user_role_prompt,
+                                           chat_turn_limit=chat_turn_limit,
+                                           placeholders=placeholders,
+                                           model_type=self.model_type,
+                                           conclusion_pattern=self.get_conclusion_pattern(chat_env))
+                self.save_conclusion(chat_env, sub_phase_name, conclusion)
+                results[index] = (placeholders, conclusion)
+            return results
+
+        conclusions = asyncio.run(self._achat_items(chat_env, [(items[index][0], results[index][0])
+                                                               for index in pending],
+                                                    chat_turn_limit, need_reflect))
+        # the chats still in flight when one fails are finished and checkpointed, then the first error is raised
+        for conclusion in conclusions:
+            if isinstance(conclusion, BaseException):
+                raise conclusion
+        for index, conclusion in zip(pending, conclusions):
+            results[index] = (results[index][0], conclusion)
+        return results
+
+    async def _achat_items(self, chat_env, items, chat_turn_limit, need_reflect):
+        semaphore = asyncio.Semaphore(chat_env.config.max_concurrency)
+
+        async def chat(sub_phase_name, placeholders):
+            async with semaphore:
+                conclusion = await self.achatting(chat_env=chat_env,
+                                                  need_reflect=need_reflect,
+                                                  assistant_role_name=self.assistant_role_name,
+                                                  user_role_name=self.user_role_name,
+                                                  phase_prompt=self.phase_prompt,
+                                                  phase_name=self.phase_name,
+                                                  assistant_role_prompt=self.assistant_role_prompt,
+                                                  user_role_prompt=self.user_role_prompt,
+                                                  chat_turn_limit=chat_turn_limit,
+                                                  placeholders=placeholders,
+                                                  model_type=self.model_type,
+                                                  conclusion_pattern=self.get_conclusion_pattern(chat_env))
+            self.save_conclusion(chat_env, sub_phase_name, conclusion)
+            return conclusion
+
+        try:
+            return await asyncio.gather(*[chat(sub_phase_name, placeholders)
+                                          for sub_phase_name, placeholders in items],
+                                        return_exceptions=True)
+        finally:
+            # the client of the loop of asyncio.run would leak its connection pool
+            await close_async_openai_client()
 
     def execute(self, chat_env, chat_turn_limit, need_reflect) -> ChatEnv:
         """
@@ -286,7 +559,8 @@ class Phase(ABC):
                               user_role_prompt=self.user_role_prompt,
                               chat_turn_limit=chat_turn_limit,
                               placeholders=self.phase_env,
-                              model_type=self.model_type)
+                              model_type=self.model_type,
+                              conclusion_pattern=self.get_conclusion_pattern(chat_env))
             self.save_conclusion(chat_env)
 
         chat_env = self.update_chat_env(chat_env)
@@ -294,6 +568,8 @@ class Phase(ABC):
 
 
 class TestBehaviorAnalysis(Phase):
+    reads = ()
+    writes = ("failed_tests", "test_codes", "test_behavior")
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
@@ -314,6 +590,8 @@ class TestBehaviorAnalysis(Phase):
 
 
 class TestFailureAnalysis(Phase):
+    reads = ("failed_tests", "test_behavior")
+    writes = ("test_infos", "test_failure_causes")
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
@@ -333,20 +611,34 @@ class TestFailureAnalysis(Phase):
 
 
 class SearchSuspiciousClass(Phase):
+    reads = ("covered_classes", "classes_dict", "failed_tests", "test_infos", "test_failure_causes", "test_behavior")
+    writes = ("failed_tests", "test_infos", "suspicious_classes")
+    prepare_writes = ("covered_classes", "classes_dict")
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
-    def update_phase_env(self, chat_env):
-        covered_classes, classes_dict = covered_classes_prompt(chat_env.env_dict['d4j_version'],
-                                                               chat_env.env_dict['project_name'],
-                                                               chat_env.env_dict['bug_ID'],
-                                                               chat_env.env_dict['directory'],
-                                                               chat_env.env_dict['cache_dir'],
-                                                               chat_env.test_suite,
-                                                               self.model_type,
-                                                               class_doc_tokens=chat_env.config.class_doc_tokens,
-                                                               basement=chat_env.config.basement)
+    def prepare(self, chat_env):
+        # the extraction may be started in the background when the test suite is selected (ChatChain.prefetch)
+        future = chat_env.prefetched.pop((self.phase_name, chat_env.test_suite.name), None)
+        if future is not None:
+            covered_classes, classes_dict = future.result()
+        else:
+            covered_classes, classes_dict = covered_classes_prompt(chat_env.env_dict['d4j_version'],
+                                                                   chat_env.env_dict['project_name'],
+                                                                   chat_env.env_dict['bug_ID'],
+                                                                   chat_env.env_dict['directory'],
+                                                                   chat_env.env_dict['cache_dir'],
+                                                                   chat_env.test_suite,
+                                                                   self.model_type,
+                                                                   class_doc_tokens=chat_env.config.class_doc_tokens,
+                                                                   basement=chat_env.config.basement)
+        chat_env.env_dict['covered_classes'] = covered_classes
         chat_env.env_dict['classes_dict'] = classes_dict
+
+    def update_phase_env(self, chat_env):
+        # an empty prompt is a valid result of the extraction, it is not run again
+        if chat_env.env_dict['covered_classes'] is None:
+            self.prepare(chat_env)
         
         # if no previous phases, need to initialize the following infos
         if chat_env.env_dict['failed_tests'] == "":
@@ -360,10 +652,16 @@ class SearchSuspiciousClass(Phase):
                                "failed_tests": chat_env.env_dict['failed_tests'],
                                "test_infos": chat_env.env_dict['test_infos'],
                                "test_failure_causes": chat_env.env_dict['test_failure_causes'],
-                               "covered_classes": covered_classes,
+                               "covered_classes": chat_env.env_dict['covered_classes'],
                                "num_selected_classes": chat_env.config.num_selected_classes,
                                "test_behavior": chat_env.env_dict['test_behavior']})
 
+    def get_conclusion_pattern(self, chat_env):
+        # the recommended class is emphasized as "#com.google.ClassName#", only one class is selected
+        if chat_env.config.num_selected_classes == 1:
+            return r"#(?:\w+\.)+\w+#"
+        return None
+
     def update_chat_env(self, chat_env) -> ChatEnv:
         # process seminar_conclusion
         class_names = re.findall(r"(?:\w+\.)+\w+", self.seminar_conclusion)
@@ -377,6 +675,10 @@ class SearchSuspiciousClass(Phase):
 
 
 class MethodDocEnhancement(Phase):
+    item_placeholders = ("class_name", "class_documentation", "methods")
+    reads = ("classes_dict", "suspicious_classes")
+    writes = ("classes_dict",)
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
@@ -403,31 +705,27 @@ class MethodDocEnhancement(Phase):
     def execute(self, chat_env, chat_turn_limit, need_reflect) -> ChatEnv:
         if chat_env.config.basement != "None":
             return chat_env
+        suspicious_classes = []
         for suspicious_class in chat_env.env_dict['suspicious_classes']:
             print(f"Start {self.phase_name} Phase for {suspicious_class}.")
             if chat_env.env_dict['classes_dict'][suspicious_class].methods == {}:
                 print(f"No methods in {suspicious_class}.")
                 continue
-            self.update_phase_env(chat_env, suspicious_class)
-            if not self.load_conclusion(chat_env, suspicious_class):
-                self.seminar_conclusion = \
-                    self.chatting(chat_env=chat_env,
-                                  need_reflect=need_reflect,
-                                  assistant_role_name=self.assistant_role_name,
-                                  user_role_name=self.user_role_name,
-                                  phase_prompt=self.phase_prompt,
-                                  phase_name=self.phase_name,
-                                  assistant_role_prompt=self.assistant_role_prompt,
-                                  user_role_prompt=self.user_role_prompt,
-                                  chat_turn_limit=chat_turn_limit,
-                                  placeholders=self.phase_env,
-                                  model_type=self.model_type)
-                self.save_conclusion(chat_env, suspicious_class)
+            suspicious_classes.append(suspicious_class)
+        # the classes are chatted concurrently, their conclusions are merged in the order of the classes
+        results = self.chat_items(chat_env, [(c, (c,)) for c in suspicious_classes], chat_turn_limit, need_reflect)
+        for suspicious_class, (_, conclusion) in zip(suspicious_classes, results):
+            self.seminar_conclusion = conclusion
             chat_env = self.update_chat_env(chat_env, suspicious_class)
         return chat_env
 
 
 class FindRelatedMethods(Phase):
+    item_placeholders = ("class_name", "class_documentation", "methods_list")
+    reads = ("classes_dict", "suspicious_classes", "failed_tests", "test_infos", "test_failure_causes",
+             "test_behavior")
+    writes = ("suspicious_methods",)
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
@@ -457,7 +755,7 @@ class FindRelatedMethods(Phase):
         # filter out methods not in this suspicious class
         src_ids = [java_class.methods[m].src_id for m in java_class.methods]
         method_names = [m for m in method_names if m in src_ids]
-        method_names = list(set(method_names))
+        method_names = list(dict.fromkeys(method_names))
         if len(method_names) == 0:
             print(f"No Related Methods Finded in Conclusion (FindRelatedMethods phase): {self.seminar_conclusion}")
         chat_env.env_dict['suspicious_methods'][suspicious_class] = method_names
@@ -466,31 +764,27 @@ class FindRelatedMethods(Phase):
     def execute(self, chat_env, chat_turn_limit, need_reflect) -> ChatEnv:
         if chat_env.config.basement != "None":
             return chat_env
+        suspicious_classes = []
         for suspicious_class in chat_env.env_dict['suspicious_classes']:
             print(f"Start {self.phase_name} Phase for {suspicious_class}.")
             if chat_env.env_dict['classes_dict'][suspicious_class].methods == {}:
                 print(f"No methods in {suspicious_class}.")
                 continue
-            self.update_phase_env(chat_env, suspicious_class)
-            if not self.load_conclusion(chat_env, suspicious_class):
-                self.seminar_conclusion = \
-                    self.chatting(chat_env=chat_env,
-                                  need_reflect=need_reflect,
-                                  assistant_role_name=self.assistant_role_name,
-                                  user_role_name=self.user_role_name,
-                                  phase_prompt=self.phase_prompt,
-                                  phase_name=self.phase_name,
-                                  assistant_role_prompt=self.assistant_role_prompt, 
-                                  user_role_prompt=self.user_role_prompt,
-                                  chat_turn_limit=chat_turn_limit,
-                                  placeholders=self.phase_env,
-                                  model_type=self.model_type)
-                self.save_conclusion(chat_env, suspicious_class)
+            suspicious_classes.append(suspicious_class)
+        # the classes are chatted concurrently, their conclusions are merged in the order of the classes
+        results = self.chat_items(chat_env, [(c, (c,)) for c in suspicious_classes], chat_turn_limit, need_reflect)
+        for suspicious_class, (_, conclusion) in zip(suspicious_classes, results):
+            self.seminar_conclusion = conclusion
             chat_env = self.update_chat_env(chat_env, suspicious_class)
         return chat_env
 
 
 class MethodReview(Phase):
+    item_placeholders = ("method_name", "method_code", "method_doc", "class_name", "class_doc")
+    reads = ("classes_dict", "suspicious_methods", "failed_tests", "test_infos", "test_failure_causes",
+             "test_behavior")
+    writes = ("suspicious_methods",)
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
     
@@ -528,6 +822,10 @@ class MethodReview(Phase):
                                "all_methods": all_methods_text,
                                "test_behavior": chat_env.env_dict['test_behavior']})
 
+    def get_conclusion_pattern(self, chat_env):
+        # "#SCORE# DESCRIPTION", the whole line of the score is kept as the reason
+        return r"#\d+#[^\n]*\n"
+
     def update_chat_env(self, chat_env) -> ChatEnv:
         # process seminar_conclusion
         conclusion = self.seminar_conclusion.strip('"')
@@ -554,17 +852,7 @@ class MethodReview(Phase):
             "method_code": self.phase_env['method_code'],
             "method_doc": self.phase_env['method_doc'],
         }
-        if method_name not in chat_env.res_dict['buggy_codes']:
-            chat_env.res_dict['buggy_codes'][method_name] = buggy_code
-            chat_env.res_dict['buggy_methods'].append(buggy_method)
-        else:
-            # we keep the highest score as the final score
-            for old_buggy_method in chat_env.res_dict['buggy_methods']:
-                if old_buggy_method['method_name'] == method_name:
-                    old_score = old_buggy_method['score']
-                    if score > old_score:
-                        old_buggy_method['score'] = score
-                    break
+        chat_env.add_buggy_method(buggy_method, buggy_code)
         return chat_env
     
     def update_chat_env_multi(self, chat_env) -> ChatEnv:
@@ -590,17 +878,7 @@ class MethodReview(Phase):
             buggy_code = {
                 "method_name": method_name,
             }
-            if method_name not in chat_env.res_dict['buggy_codes']:
-                chat_env.res_dict['buggy_codes'][method_name] = buggy_code
-                chat_env.res_dict['buggy_methods'].append(buggy_method)
-            else:
-                # we keep the highest score as the final score
-                for old_buggy_method in chat_env.res_dict['buggy_methods']:
-                    if old_buggy_method['method_name'] == method_name:
-                        old_score = old_buggy_method['score']
-                        if score > old_score:
-                            old_buggy_method['score'] = score
-                        break
+            chat_env.add_buggy_method(buggy_method, buggy_code)
         return chat_env
 
     def execute(self, chat_env: ChatEnv, chat_turn_limit, need_reflect) -> ChatEnv:
@@ -628,25 +906,19 @@ class MethodReview(Phase):
                 self.save_conclusion(chat_env)
             chat_env = self.update_chat_env_multi(chat_env)
         else:
+            items = []
             for spc_class, spc_methods in chat_env.env_dict['suspicious_methods'].items():
                 for spc_method in spc_methods:
                     print(f"Start {self.phase_name} Phase for {spc_method}.")
-                    self.update_phase_env(chat_env, spc_class, spc_method)
-                    if not self.load_conclusion(chat_env, spc_method):
-                        self.seminar_conclusion = \
-                            self.chatting(chat_env=chat_env,
-                                        need_reflect=need_reflect,
-                                        assistant_role_name=self.assistant_role_name,
-                                        user_role_name=self.user_role_name,
-                                        phase_prompt=self.phase_prompt,
-                                        phase_name=self.phase_name,
-                                        assistant_role_prompt=self.assistant_role_prompt,
-                                        user_role_prompt=self.user_role_prompt,
-                                        chat_turn_limit=chat_turn_limit,
-                                        placeholders=self.phase_env,
-                                        model_type=self.model_type)
-                        self.save_conclusion(chat_env, spc_method)
-                    chat_env = self.update_chat_env(chat_env)
+                    items.append((spc_method, (spc_class, spc_method)))
+            # the methods are reviewed concurrently, in batch mode they are reviewed once the batch is completed.
+            # the reviews are merged one by one in the order of the methods, so res_dict needs no lock
+            for placeholders, conclusion in self.chat_items(chat_env, items, chat_turn_limit, need_reflect,
+                                                            batch=True):
+                if conclusion is None:
+                    continue
+                self.phase_env, self.seminar_conclusion = placeholders, conclusion
+                chat_env = self.update_chat_env(chat_env)
         
         # rank methods
         if len(chat_env.res_dict['buggy_methods']) > 1:
@@ -1,9 +1,81 @@
 import os
 
-import numpy as np
-
-
-def get_info(dir, log_filepath):
+from camel.model_backend import UsageLedger
+
+
+# prices per 1000 tokens, cached prompt tokens are billed at half price
+PROMPT_PRICE = 0.0025
+CACHED_PROMPT_PRICE = 0.00125
+COMPLETION_PRICE = 0.01
+
+
+def get_cost(num_prompt_tokens, num_completion_tokens, num_cached_tokens=0):
+    return (num_prompt_tokens - num_cached_tokens) * PROMPT_PRICE / 1000.0 \
+        + num_cached_tokens * CACHED_PROMPT_PRICE / 1000.0 \
+        + num_completion_tokens * COMPLETION_PRICE / 1000.0
+
+
+def load_usage(ledger_filepaths):
+    """
+    read the rows of the usage ledgers written by the model backend, missing ledgers are skipped
+    """
+    rows = []
+    for ledger_filepath in ledger_filepaths:
+        if ledger_filepath is not None and os.path.exists(ledger_filepath):
+            rows += UsageLedger.load(ledger_filepath)
+    return rows
+
+
+def summarize_usage(rows):
+    """
+    sum up the rows of the usage ledger, in total and per phase
+    the answers from the response cache and the coalesced calls are not billed
+    Returns:
+        usage: dict of the token counts, cost, latency, queue wait and retries, "phases" maps each phase to its usage
+    """
+    usage = {"num_calls": 0, "num_cache_hits": 0, "num_coalesced": 0, "num_hedged_requests": 0, "num_retries": 0,
+             "num_prompt_tokens": 0, "num_completion_tokens": 0, "num_total_tokens": 0, "num_cached_tokens": 0,
+             "cost": 0.0, "latency": 0.0, "queue_wait": 0.0, "phases": {}}
+    for row in rows:
+        phase = usage["phases"].setdefault(row.get("phase"), {"num_calls": 0, "num_total_tokens": 0, "cost": 0.0,
+                                                              "latency": 0.0})
+        for counter in [usage, phase]:
+            counter["num_calls"] += 1
+            counter["latency"] += row["latency"]
+        usage["queue_wait"] += row["queue_wait"]
+        usage["num_retries"] += row["retries"]
+        if row["cache_hit"] or row["coalesced"]:
+            usage["num_cache_hits" if row["cache_hit"] else "num_coalesced"] += 1
+            continue
+        num_prompt_tokens = row["prompt_tokens"] + row["hedged_prompt_tokens"]
+        cost = get_cost(num_prompt_tokens, row["completion_tokens"], row["cached_tokens"])
+        usage["num_hedged_requests"] += 1 if row["hedged_prompt_tokens"] else 0
+        usage["num_prompt_tokens"] += num_prompt_tokens
+        usage["num_completion_tokens"] += row["completion_tokens"]
+        usage["num_total_tokens"] += row["total_tokens"] + row["hedged_prompt_tokens"]
+        usage["num_cached_tokens"] += row["cached_tokens"]
+        for counter in [usage, phase]:
+            counter["cost"] += cost
+        phase["num_total_tokens"] += row["total_tokens"] + row["hedged_prompt_tokens"]
+    return usage
+
+
+def scrape_usage(lines):
+    """
+    sum up the usage lines of the log, for the runs without a usage ledger
+    the hedged duplicates are logged with their prompt tokens, which are billed as well
+    """
+    usage = summarize_usage([])
+    usage["num_calls"] = len([line for line in lines if "**[OpenAI_Usage_Info Receive]**" in line])
+    for key, prefix in [("num_prompt_tokens", "prompt_tokens:"), ("num_completion_tokens", "completion_tokens:"),
+                        ("num_total_tokens", "total_tokens:"), ("num_cached_tokens", "cached_tokens:")]:
+        usage[key] = sum(int(line.split(": ")[-1]) for line in lines if line.startswith(prefix))
+    usage["num_hedged_requests"] = len([line for line in lines if "**[OpenAI_Usage_Info Hedge]**" in line])
+    usage["cost"] = get_cost(usage["num_prompt_tokens"], usage["num_completion_tokens"], usage["num_cached_tokens"])
+    return usage
+
+
+def get_info(dir, log_filepath, ledger_filepath=None):
     print("dir:", dir)
 
     version_updates = -1
@@ -19,6 +91,9 @@ def get_info(dir, log_filepath):
     num_prompt_tokens = -1
     num_completion_tokens = -1
     num_total_tokens = -1
+    num_cached_tokens = -1
+    num_hedged_requests = -1
+    lines = []
 
     if os.path.exists(dir):
         filenames = os.listdir(dir)
@@ -47,53 +122,41 @@ def get_info(dir, log_filepath):
                 code_lines += len([line for line in lines if len(line.strip()) > 0])
         # print("code_lines:", code_lines)
 
-        lines = open(log_filepath, "r", encoding="utf8").read().split("\n")
+        with open(log_filepath, "r", encoding="utf8") as f:
+            lines = f.read().split("\n")
         start_lines = [line for line in lines if "**[Start Chat]**" in line]
         chat_lines = [line for line in lines if "<->" in line]
         num_utterance = len(start_lines) + len(chat_lines)
         # print("num_utterance:", num_utterance)
 
-        lines = open(log_filepath, "r", encoding="utf8").read().split("\n")
-        sublines = [line for line in lines if line.startswith("prompt_tokens:")]
-        if len(sublines) > 0:
-            nums = [int(line.split(": ")[-1]) for line in sublines]
-            num_prompt_tokens = np.sum(nums)
-            # print("num_prompt_tokens:", num_prompt_tokens)
-
-        lines = open(log_filepath, "r", encoding="utf8").read().split("\n")
-        sublines = [line for line in lines if line.startswith("completion_tokens:")]
-        if len(sublines) > 0:
-            nums = [int(line.split(": ")[-1]) for line in sublines]
-            num_completion_tokens = np.sum(nums)
-            # print("num_completion_tokens:", num_completion_tokens)
-
-        lines = open(log_filepath, "r", encoding="utf8").read().split("\n")
-        sublines = [line for line in lines if line.startswith("total_tokens:")]
-        if len(sublines) > 0:
-            nums = [int(line.split(": ")[-1]) for line in sublines]
-            num_total_tokens = np.sum(nums)
-            # print("num_total_tokens:", num_total_tokens)
-
-        lines = open(log_filepath, "r", encoding="utf8").read().split("\n")
-
-        lines = open(log_filepath, "r", encoding="utf8").read().split("\n")
         num_reflection = 0
         for line in lines:
             if "on : Reflection" in line:
                 num_reflection += 1
         # print("num_reflection:", num_reflection)
 
+    if ledger_filepath is not None and os.path.exists(ledger_filepath):
+        usage = summarize_usage(load_usage([ledger_filepath]))
+    else:
+        usage = scrape_usage(lines)
+    if usage["num_calls"] > 0:
+        num_prompt_tokens = usage["num_prompt_tokens"]
+        num_completion_tokens = usage["num_completion_tokens"]
+        num_total_tokens = usage["num_total_tokens"]
+        num_cached_tokens = usage["num_cached_tokens"]
+        num_hedged_requests = usage["num_hedged_requests"]
+
     cost = 0.0
     if num_png_files != -1:
         cost += num_png_files * 0.016
-    if num_prompt_tokens != -1:
-        cost += num_prompt_tokens * 0.0025 / 1000.0
-    if num_completion_tokens != -1:
-        cost += num_completion_tokens * 0.01 / 1000.0
+    cost += usage["cost"]
+    cached_token_ratio = -1
+    if num_cached_tokens != -1 and num_prompt_tokens > 0:
+        cached_token_ratio = num_cached_tokens / num_prompt_tokens
 
     # info = f"🕑duration={duration}s 💰cost=${cost} 🔨version_updates={version_updates} 📃num_code_files={num_code_files} 🏞num_png_files={num_png_files} 📚num_doc_files={num_doc_files} 📃code_lines={code_lines} 📋env_lines={env_lines} 📒manual_lines={manual_lines} 🗣num_utterances={num_utterance} 🤔num_self_reflections={num_reflection} ❓num_prompt_tokens={num_prompt_tokens} ❗num_completion_tokens={num_completion_tokens} ⁉️num_total_tokens={num_total_tokens}"
 
-    info = "\n\n**cost**=${:.6f}\n\n**version_updates**={}\n\n**num_code_files**={}\n\n**num_png_files**={}\n\n**num_doc_files**={}\n\n**code_lines**={}\n\n**env_lines**={}\n\n**manual_lines**={}\n\n**num_utterances**={}\n\n**num_self_reflections**={}\n\n**num_prompt_tokens**={}\n\n**num_completion_tokens**={}\n\n**num_total_tokens**={}" \
+    info = "\n\n**cost**=${:.6f}\n\n**version_updates**={}\n\n**num_code_files**={}\n\n**num_png_files**={}\n\n**num_doc_files**={}\n\n**code_lines**={}\n\n**env_lines**={}\n\n**manual_lines**={}\n\n**num_utterances**={}\n\n**num_self_reflections**={}\n\n**num_prompt_tokens**={}\n\n**num_completion_tokens**={}\n\n**num_total_tokens**={}\n\n**num_cached_tokens**={}\n\n**cached_token_ratio**={:.4f}\n\n**num_hedged_requests**={}\n\n**num_model_calls**={}\n\n**num_cache_hits**={}\n\n**num_retries**={}\n\n**queue_wait**={:.2f}s\n\n**latency**={:.2f}s" \
         .format(cost,
                 version_updates,
                 num_code_files,
@@ -106,6 +169,17 @@ def get_info(dir, log_filepath):
                 num_reflection,
                 num_prompt_tokens,
                 num_completion_tokens,
-                num_total_tokens)
+                num_total_tokens,
+                num_cached_tokens,
+                cached_token_ratio,
+                num_hedged_requests,
+                usage["num_calls"],
+                usage["num_cache_hits"],
+                usage["num_retries"],
+                usage["queue_wait"],
+                usage["latency"])
+    for phase, phase_usage in usage["phases"].items():
+        info += "\n\n**cost[{}]**=${:.6f}\n\n**num_total_tokens[{}]**={}".format(
+            phase, phase_usage["cost"], phase, phase_usage["num_total_tokens"])
 
     return info
@@ -1,7 +1,12 @@
+import atexit
 import html
 import inspect
 import logging
+import logging.handlers
+import os
+import queue
 import re
+import tempfile
 import time
 
 import markdown
@@ -13,6 +18,59 @@ def now():
     return time.strftime("%Y%m%d%H%M%S", time.localtime())
 
 
+_log_listener = None
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    puts the log records on the queue as they are, unlike QueueHandler the messages are not formatted by the caller
+    but by the writer thread
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(log_filepath, mode="sync"):
+    """
+    log into the log file
+    Args:
+        log_filepath: path to the log
+        mode: "sync" writes every record in the calling thread,
+              "deferred" queues the records for a background writer thread, which also renders their markdown
+
+    Returns: None
+
+    """
+    global _log_listener
+    log_format = '[%(asctime)s %(levelname)s] %(message)s'
+    date_format = '%Y-%d-%m %H:%M:%S'
+    if mode == "sync":
+        logging.basicConfig(filename=log_filepath, level=logging.INFO, format=log_format, datefmt=date_format)
+        return
+    if mode != "deferred":
+        raise ValueError(f"Unknown log_mode: {mode}")
+    file_handler = logging.FileHandler(log_filepath)
+    file_handler.setFormatter(logging.Formatter(log_format, datefmt=date_format))
+    log_queue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(log_queue, file_handler)
+    _log_listener.start()
+    root_logger = logging.getLogger()
+    root_logger.addHandler(DeferredQueueHandler(log_queue))
+    root_logger.setLevel(logging.INFO)
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """
+    write out the records queued by the deferred logging and stop its writer thread
+    """
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+
 def log_and_print_online(role, content=None):
     if not content:
         logging.info(role + "\n")
@@ -57,28 +115,56 @@ def convert_to_markdown_table(records_kv):
     return markdown_table
 
 
-def log_arguments(func):
-    def wrapper(*args, **kwargs):
-        sig = inspect.signature(func)
-        params = sig.parameters
+class ArgumentsRecord:
+    """
+    the arguments of a call, rendered into a markdown table only when the log record is written
+    the arguments are converted into strings at the call, so later changes of them are not logged
+    """
+    __slots__ = ("func_name", "records_kv")
 
-        all_args = {}
-        all_args.update({name: value for name, value in zip(params.keys(), args)})
-        all_args.update(kwargs)
+    def __init__(self, func_name, records_kv):
+        self.func_name = func_name
+        self.records_kv = records_kv
 
+    def __str__(self):
         records_kv = []
-        for name, value in all_args.items():
-            if name in ["self", "chat_env", "task_type"]:
-                continue
-            value = str(value)
+        for name, value in self.records_kv:
             value = html.unescape(value)
             value = markdown.markdown(value)
             value = re.sub(r'<[^>]*>', '', value)
             value = value.replace("\n", " ")
             records_kv.append([name, value])
-        records = f"**[{func.__name__}]**\n\n" + convert_to_markdown_table(records_kv)
-        log_online("System", records)
+        return f"**[{self.func_name}]**\n\n" + convert_to_markdown_table(records_kv)
+
+
+def log_arguments(func):
+    params = list(inspect.signature(func).parameters.keys())
+
+    def wrapper(*args, **kwargs):
+        all_args = {}
+        all_args.update({name: value for name, value in zip(params, args)})
+        all_args.update(kwargs)
+
+        records_kv = [[name, str(value)] for name, value in all_args.items()
+                      if name not in ["self", "chat_env", "task_type"]]
+        # the message is formatted lazily, by the writer thread in the deferred log mode
+        logging.info("%s: %s\n", "System", ArgumentsRecord(func.__name__, records_kv))
 
         return func(*args, **kwargs)
 
     return wrapper
+
+
+def write_file_atomic(path, content):
+    """write the content to a file that is replaced atomically, an interrupted write never leaves a truncated
+    file behind.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        os.replace(tmp_file, path)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
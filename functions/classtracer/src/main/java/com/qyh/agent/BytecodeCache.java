@@ -0,0 +1,244 @@
+package com.qyh.agent;
+
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.File;
+import java.io.FileInputStream;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.RandomAccessFile;
+import java.nio.channels.FileLock;
+import java.nio.file.Files;
+import java.nio.file.StandardCopyOption;
+import java.security.MessageDigest;
+import java.util.ArrayList;
+import java.util.HashMap;
+import java.util.List;
+import java.util.Map;
+import java.util.zip.CRC32;
+
+/**
+ * On-disk cache of the instrumented classes, shared by the runs of the agent with the same cacheDir:
+ *
+ * cacheDir/ids.log              the signatures of the instrumented methods and their CRC-32, line i is the
+ *                               method of id i
+ * cacheDir/classes/<key>.bin    the methods and the instrumented bytecode of a class
+ *
+ * The key of a class is the SHA-1 of the agent jar and the class file, so a changed class or a rebuilt agent
+ * is instrumented again. The ids are baked into the bytecode, they are assigned once in ids.log (under a file
+ * lock, the JVMs of parallel runs may share the cache) and stay the same in all later runs. A cacheDir holds
+ * the ids of one project (see agent_options), the ids of a run then only span the methods of its project.
+ * The lines of a JVM killed while appending fail their checksum and are cut off by the next run.
+ */
+public class BytecodeCache {
+
+    public static class Entry {
+        public final List<Integer> ids = new ArrayList<>();
+        public final List<String> signatures = new ArrayList<>();
+        public final List<Method> methods = new ArrayList<>();
+        public byte[] bytecode;
+    }
+
+    private final File classesDir;
+    private final File idsFile;
+    private final byte[] agentHash;
+    /**
+     * key: signature of the method
+     * value: methodId, the line of the signature in ids.log
+     */
+    private final Map<String, Integer> ids = new HashMap<>();
+    /**
+     * bytes of the complete lines of ids.log read so far
+     */
+    private long idsOffset = 0;
+
+    public BytecodeCache(String cacheDir) throws IOException {
+        this.classesDir = new File(cacheDir, "classes");
+        this.idsFile = new File(cacheDir, "ids.log");
+        this.classesDir.mkdirs();
+        this.agentHash = agentHash();
+    }
+
+    private static byte[] agentHash() {
+        try {
+            String agentJar = BytecodeCache.class.getProtectionDomain().getCodeSource().getLocation().getPath();
+            MessageDigest digest = MessageDigest.getInstance("SHA-1");
+            InputStream in = new BufferedInputStream(new FileInputStream(agentJar));
+            byte[] buffer = new byte[8192];
+            int n;
+            while ((n = in.read(buffer)) > 0) {
+                digest.update(buffer, 0, n);
+            }
+            in.close();
+            return digest.digest();
+        } catch (Exception e) {
+            // e.g. the agent runs from a classes directory, only the class files are compared
+            e.printStackTrace();
+            return new byte[0];
+        }
+    }
+
+    public String key(byte[] classfileBuffer) {
+        try {
+            MessageDigest digest = MessageDigest.getInstance("SHA-1");
+            digest.update(agentHash);
+            digest.update(classfileBuffer);
+            StringBuilder sb = new StringBuilder();
+            for (byte b : digest.digest()) {
+                sb.append(String.format("%02x", b));
+            }
+            return sb.toString();
+        } catch (Exception e) {
+            throw new RuntimeException(e);
+        }
+    }
+
+    /**
+     * the id of a method, a new id is appended to ids.log
+     */
+    public synchronized int idOf(String signature) throws IOException {
+        Integer id = ids.get(signature);
+        if (id != null) {
+            return id;
+        }
+        RandomAccessFile file = new RandomAccessFile(idsFile, "rw");
+        FileLock lock = file.getChannel().lock();
+        try {
+            // the ids appended by other runs since the last read
+            readIds(file);
+            id = ids.get(signature);
+            if (id == null) {
+                id = ids.size();
+                // after the complete lines, a torn line of a killed run is overwritten
+                file.setLength(idsOffset);
+                file.seek(idsOffset);
+                file.write((signature + " " + checksum(signature) + "\n").getBytes("UTF-8"));
+                idsOffset = file.length();
+                ids.put(signature, id);
+            }
+            return id;
+        } finally {
+            lock.release();
+            file.close();
+        }
+    }
+
+    /**
+     * read the lines appended since the last read, up to the first line without newline or with a wrong checksum
+     */
+    private void readIds(RandomAccessFile file) throws IOException {
+        long length = file.length();
+        if (length <= idsOffset) {
+            return;
+        }
+        byte[] buffer = new byte[(int) (length - idsOffset)];
+        file.seek(idsOffset);
+        file.readFully(buffer);
+        int start = 0;
+        for (int end = 0; end < buffer.length; end++) {
+            if (buffer[end] != '\n') {
+                continue;
+            }
+            String line = new String(buffer, start, end - start, "UTF-8");
+            int space = line.lastIndexOf(' ');
+            String signature = space < 0 ? null : line.substring(0, space);
+            if (signature == null || !line.substring(space + 1).equals(checksum(signature))) {
+                break;
+            }
+            ids.put(signature, ids.size());
+            start = end + 1;
+        }
+        idsOffset += start;
+    }
+
+    private static String checksum(String signature) throws IOException {
+        CRC32 crc = new CRC32();
+        crc.update(signature.getBytes("UTF-8"));
+        return Long.toHexString(crc.getValue());
+    }
+
+    /**
+     * the cached entry of a class, null if the class was not instrumented before
+     */
+    public Entry load(String key) {
+        File file = new File(classesDir, key + ".bin");
+        if (!file.exists()) {
+            return null;
+        }
+        try {
+            DataInputStream in = new DataInputStream(new BufferedInputStream(new FileInputStream(file)));
+            try {
+                Entry entry = new Entry();
+                int num = in.readInt();
+                for (int i = 0; i < num; i++) {
+                    entry.ids.add(in.readInt());
+                    entry.signatures.add(in.readUTF());
+                    Method method = new Method();
+                    method.setClassName(in.readUTF());
+                    method.setMethodName(in.readUTF());
+                    method.setParameterNameList(readList(in));
+                    method.setParameterTypeList(readList(in));
+                    method.setReturnType(in.readUTF());
+                    entry.methods.add(method);
+                }
+                entry.bytecode = new byte[in.readInt()];
+                in.readFully(entry.bytecode);
+                return entry;
+            } finally {
+                in.close();
+            }
+        } catch (Exception e) {
+            // a broken entry is instrumented again
+            e.printStackTrace();
+            return null;
+        }
+    }
+
+    public void store(String key, Entry entry) {
+        try {
+            File tmp = File.createTempFile(key, ".tmp", classesDir);
+            DataOutputStream out = new DataOutputStream(new BufferedOutputStream(new FileOutputStream(tmp)));
+            try {
+                out.writeInt(entry.ids.size());
+                for (int i = 0; i < entry.ids.size(); i++) {
+                    Method method = entry.methods.get(i);
+                    out.writeInt(entry.ids.get(i));
+                    out.writeUTF(entry.signatures.get(i));
+                    out.writeUTF(method.getClassName());
+                    out.writeUTF(method.getMethodName());
+                    writeList(out, method.getParameterNameList());
+                    writeList(out, method.getParameterTypeList());
+                    out.writeUTF(method.getReturnType());
+                }
+                out.writeInt(entry.bytecode.length);
+                out.write(entry.bytecode);
+            } finally {
+                out.close();
+            }
+            // other runs only see complete entries
+            Files.move(tmp.toPath(), new File(classesDir, key + ".bin").toPath(),
+                    StandardCopyOption.REPLACE_EXISTING, StandardCopyOption.ATOMIC_MOVE);
+        } catch (Exception e) {
+            e.printStackTrace();
+        }
+    }
+
+    private static List<String> readList(DataInputStream in) throws IOException {
+        int num = in.readInt();
+        List<String> list = new ArrayList<>(num);
+        for (int i = 0; i < num; i++) {
+            list.add(in.readUTF());
+        }
+        return list;
+    }
+
+    private static void writeList(DataOutputStream out, List<String> list) throws IOException {
+        out.writeInt(list.size());
+        for (String s : list) {
+            out.writeUTF(s);
+        }
+    }
+}
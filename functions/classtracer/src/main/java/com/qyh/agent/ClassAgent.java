@@ -1,6 +1,8 @@
 package com.qyh.agent;
 
 import java.lang.instrument.Instrumentation;
+import java.util.Timer;
+import java.util.TimerTask;
 
 
 public class ClassAgent {
@@ -8,18 +10,39 @@ public class ClassAgent {
     public static void premain(String argsString, Instrumentation inst) {
         String outputDir = null;
         String classesPath = null;
+        boolean counts = false;
+        String cacheDir = null;
+        String include = null;
+        String exclude = null;
+        String classes = null;
+        int flushInterval = 10;
+        boolean perTest = false;
         String[] args = argsString.split(",");
         for (String arg : args) {
-            String[] kv = arg.split("=");
+            String[] kv = arg.split("=", 2);
             String key = kv[0];
-            String value = kv[1];
+            String value = kv.length > 1 ? kv[1] : "";
             if (key.equals("outputDir")) {
                 outputDir = value;
             } else if (key.equals("classesPath")) {
                 classesPath = value;
+            } else if (key.equals("counts")) {
+                counts = Boolean.parseBoolean(value);
+            } else if (key.equals("cacheDir")) {
+                cacheDir = value;
+            } else if (key.equals("include")) {
+                include = value;
+            } else if (key.equals("exclude")) {
+                exclude = value;
+            } else if (key.equals("classes")) {
+                classes = value;
+            } else if (key.equals("flushInterval")) {
+                flushInterval = Integer.parseInt(value);
+            } else if (key.equals("perTest")) {
+                perTest = Boolean.parseBoolean(value);
             } else {
-                System.out.println("unknown arg: " + key);
-                return;
+                // e.g. an argument of a newer version of the agent, the others still apply
+                System.err.println("unknown arg: " + key + ", ignored");
             }
         }
         if (outputDir == null || classesPath == null) {
@@ -27,8 +50,27 @@ public class ClassAgent {
             return;
         }
 
-        ClassTransformer transformer = new ClassTransformer(outputDir, classesPath);
+        ClassTransformer transformer = new ClassTransformer(outputDir, classesPath,
+                new InstrumentScope(include, exclude, classes), counts, cacheDir, perTest);
         inst.addTransformer(transformer);
 
+        // the coverage is written when the JVM exits and, for a JVM killed before (e.g. by a test timeout),
+        // every flushInterval seconds. With perTest, the coverage of each test is written when the test ends
+        Runtime.getRuntime().addShutdownHook(new Thread() {
+            @Override
+            public void run() {
+                ClassTransformer.dump();
+            }
+        });
+        if (flushInterval > 0) {
+            Timer timer = new Timer("classtracer-dump", true);
+            timer.schedule(new TimerTask() {
+                @Override
+                public void run() {
+                    ClassTransformer.dump();
+                }
+            }, flushInterval * 1000L, flushInterval * 1000L);
+        }
+
     }
 }
\ No newline at end of file
@@ -3,13 +3,16 @@ package com.qyh.agent;
 import java.lang.instrument.ClassFileTransformer;
 import java.lang.instrument.IllegalClassFormatException;
 import java.lang.String;
+import java.security.CodeSource;
 import java.security.ProtectionDomain;
 import java.util.ArrayList;
+import java.util.Arrays;
 import java.util.HashSet;
 import java.util.List;
 import java.util.Map;
+import java.util.Set;
 import java.util.concurrent.ConcurrentHashMap;
-import java.util.concurrent.atomic.AtomicInteger;
+import java.util.concurrent.atomic.AtomicIntegerArray;
 import java.util.concurrent.atomic.AtomicReferenceArray;
 
 import javassist.CannotCompileException;
@@ -21,53 +24,317 @@ import javassist.NotFoundException;
 import javassist.bytecode.CodeAttribute;
 import javassist.bytecode.LocalVariableAttribute;
 
+import java.io.BufferedWriter;
 import java.io.File;
 import java.io.FileWriter;
+import java.io.IOException;
+import java.nio.file.Files;
+import java.nio.file.Paths;
+import java.nio.file.StandardCopyOption;
 
 public class ClassTransformer implements ClassFileTransformer {
-    private String instLogFile;
-    private String runLogFile;
     private String classesPath;
+    private InstrumentScope scope;
+    /**
+     * whether the test boundaries are taken from junit.framework.TestResult (see TestHook)
+     */
+    private boolean hookTests;
+    /**
+     * whether the code source of a protection domain is in classesPath, checked once per code source
+     */
+    private final Map<ProtectionDomain, Boolean> inClassesPath = new ConcurrentHashMap<>();
 
-    public static final int MAX_NUM = 1024 * 32;
-    private final static AtomicInteger index = new AtomicInteger(0);
     /**
-     * key: hashcode
+     * the method ids are kept in segments of SEGMENT_SIZE ids, a segment is allocated when its first id is
+     * generated, so the number of methods is only bounded by MAX_SEGMENTS * SEGMENT_SIZE
+     */
+    public static final int SEGMENT_BITS = 15;
+    public static final int SEGMENT_SIZE = 1 << SEGMENT_BITS;
+    public static final int SEGMENT_MASK = SEGMENT_SIZE - 1;
+    public static final int MAX_SEGMENTS = 1 << 12;
+    private static int index = 0;
+    /**
+     * the ids of the methods registered in this JVM, the first numRegistered are used. With the cache, the ids
+     * are shared by all runs of the project and those of a JVM are only a part of them
+     */
+    private static int[] registered = new int[1024];
+    private static int numRegistered = 0;
+    private static boolean registeredSorted = true;
+    /**
+     * key: signature of the method, e.g. com.example.Foo.bar(ILjava/lang/String;)V
      * value: methodId
      */
-    private final static Map<Integer, Integer> methodInfos = new ConcurrentHashMap<>();
-    private final static AtomicReferenceArray<Method> methodTagArr = new AtomicReferenceArray<>(MAX_NUM);
-    private final static HashSet<Integer> runedMethods = new HashSet<Integer>();
+    private final static Map<String, Integer> methodInfos = new ConcurrentHashMap<>();
+    private final static AtomicReferenceArray<Segment> segments = new AtomicReferenceArray<>(MAX_SEGMENTS);
+    /**
+     * the number of runs of each method is only recorded with the agent argument counts=true
+     */
+    private static boolean counts = false;
+    /**
+     * the instrumented classes of earlier runs, null without the agent argument cacheDir
+     */
+    private static BytecodeCache cache = null;
+    private static String outputDir;
+    private static String instLog;
+    /**
+     * a test has started (see TestHook), the probes are written per test
+     */
+    private static volatile boolean perTest = false;
 
-    public ClassTransformer(String outputDir, String classesPath) {
-        this.instLogFile = outputDir + File.separator + "inst.log";
-        this.runLogFile = outputDir + File.separator + "run.log";
+    public ClassTransformer(String outputDir, String classesPath, InstrumentScope scope, boolean counts,
+            String cacheDir, boolean hookTests) {
         this.classesPath = classesPath;
+        this.scope = scope;
+        this.hookTests = hookTests;
+        ClassTransformer.outputDir = outputDir;
+        ClassTransformer.instLog = outputDir + File.separator + "inst.log";
+        ClassTransformer.counts = counts;
+        if (cacheDir != null) {
+            try {
+                cache = new BytecodeCache(cacheDir);
+            } catch (Exception e) {
+                e.printStackTrace();
+            }
+        }
+    }
+
+    /**
+     * test boundary, the methods run from now on are covered by the test
+     */
+    public static synchronized void startTest(String testName) {
+        perTest = true;
+        resetProbes();
+    }
+
+    /**
+     * test boundary, the methods of the classes loaded or run since startTest are written to
+     * outputDir/testName/inst.log, the methods run to outputDir/testName/run.log and all instrumented methods so
+     * far to outputDir/inst.log, so the coverage of the finished tests survives a crash of the JVM. A class
+     * loaded by an earlier test of the JVM is only in the inst.log of the tests that run one of its methods
+     */
+    public static synchronized void finishTest(String testName) {
+        String testDir = testDir(testName);
+        writeMethods(testDir + File.separator + "inst.log", false, testClasses());
+        // the run log last, the logs of a test are complete once it exists
+        writeProbes(testDir);
+        writeInstLogs();
+        resetProbes();
+    }
+
+    private static String testDir(String testName) {
+        File testDir = new File(outputDir, testName);
+        testDir.mkdirs();
+        return testDir.getPath();
+    }
+
+    /**
+     * methods, probes and hit counts of SEGMENT_SIZE consecutive method ids. probes[i] is set when the
+     * method runs, the probes are written to the run log at the end of a test (see TestHook), periodically
+     * and when the JVM exits. loaded[i] is set when the class of the method is loaded, both are reset at the
+     * test boundaries
+     */
+    private static class Segment {
+        final AtomicReferenceArray<Method> methods = new AtomicReferenceArray<>(SEGMENT_SIZE);
+        final AtomicReferenceArray<String> signatures = new AtomicReferenceArray<>(SEGMENT_SIZE);
+        final boolean[] probes = new boolean[SEGMENT_SIZE];
+        final boolean[] loaded = new boolean[SEGMENT_SIZE];
+        final AtomicIntegerArray hitCounts = counts ? new AtomicIntegerArray(SEGMENT_SIZE) : null;
+    }
+
+    private static Segment segment(int methodId) {
+        return segments.get(methodId >>> SEGMENT_BITS);
+    }
+
+    /**
+     * the ids of the methods registered in this JVM in ascending order, the logs are written and the probes reset
+     * for these ids only
+     */
+    private static synchronized int[] methodIds() {
+        if (!registeredSorted) {
+            Arrays.sort(registered, 0, numRegistered);
+            registeredSorted = true;
+        }
+        return Arrays.copyOf(registered, numRegistered);
+    }
+
+    /**
+     * write the methods run so far to run.log, the instrumented methods to inst.log and the id -> signature
+     * dictionary to methods.log. Called periodically and by the shutdown hook of the agent, a JVM killed without
+     * running the hook keeps the last dump. With test boundaries, the run logs are only written by finishTest,
+     * a test cut off by the end of the JVM has none
+     */
+    public static synchronized void dump() {
+        new File(outputDir).mkdirs();
+        // the probes first, the methods of the written probes are then all in inst.log
+        if (!perTest) {
+            writeProbes(outputDir);
+        }
+        writeInstLogs();
+    }
+
+    private static void writeInstLogs() {
+        writeMethods(instLog, false, null);
+        writeSignatures(outputDir + File.separator + "methods.log");
+    }
+
+    /**
+     * the logs are written to a temporary file which then replaces the log, a JVM killed while writing leaves
+     * the previous complete log
+     */
+    private static BufferedWriter openLog(String file) throws IOException {
+        return new BufferedWriter(new FileWriter(file + ".tmp"));
+    }
+
+    private static void closeLog(BufferedWriter writer, String file) throws IOException {
+        writer.close();
+        Files.move(Paths.get(file + ".tmp"), Paths.get(file), StandardCopyOption.REPLACE_EXISTING,
+                StandardCopyOption.ATOMIC_MOVE);
+    }
+
+    private static void resetProbes() {
+        for (int i : methodIds()) {
+            Segment segment = segment(i);
+            segment.probes[i & SEGMENT_MASK] = false;
+            segment.loaded[i & SEGMENT_MASK] = false;
+            if (segment.hitCounts != null) {
+                segment.hitCounts.set(i & SEGMENT_MASK, 0);
+            }
+        }
+    }
+
+    private static void writeProbes(String dir) {
+        writeMethods(dir + File.separator + "run.log", true, null);
+        if (!counts) {
+            return;
+        }
+        // "methodId count", the signature of an id is in methods.log, its method is the line methodId of inst.log
+        try {
+            String file = dir + File.separator + "hits.log";
+            BufferedWriter writer = openLog(file);
+            for (int i : methodIds()) {
+                int count = segment(i).hitCounts.get(i & SEGMENT_MASK);
+                if (count > 0) {
+                    writer.write(i + " " + count + "\n");
+                }
+            }
+            closeLog(writer, file);
+        } catch (Exception e) {
+            e.printStackTrace();
+        }
+    }
+
+    /**
+     * the classes loaded or run since the last reset of the probes
+     */
+    private static Set<String> testClasses() {
+        Set<String> classNames = new HashSet<>();
+        for (int i : methodIds()) {
+            Segment segment = segment(i);
+            Method method = segment.methods.get(i & SEGMENT_MASK);
+            if (segment.loaded[i & SEGMENT_MASK] || segment.probes[i & SEGMENT_MASK]) {
+                classNames.add(method.getClassName());
+            }
+        }
+        return classNames;
+    }
+
+    /**
+     * write the methods in the order of their ids, only those whose probe is set if covered is true and those
+     * of classNames if it is not null. Without the cache, line i of inst.log is the method of id i
+     */
+    private static void writeMethods(String file, boolean covered, Set<String> classNames) {
+        try {
+            BufferedWriter writer = openLog(file);
+            for (int i : methodIds()) {
+                Segment segment = segment(i);
+                Method method = segment.methods.get(i & SEGMENT_MASK);
+                if ((!covered || segment.probes[i & SEGMENT_MASK])
+                        && (classNames == null || classNames.contains(method.getClassName()))) {
+                    writer.write(method.toString() + "\n");
+                }
+            }
+            closeLog(writer, file);
+        } catch (Exception e) {
+            e.printStackTrace();
+        }
+    }
+
+    /**
+     * write the id -> signature dictionary, "methodId signature" per line
+     */
+    private static void writeSignatures(String file) {
+        try {
+            BufferedWriter writer = openLog(file);
+            for (int i : methodIds()) {
+                writer.write(i + " " + segment(i).signatures.get(i & SEGMENT_MASK) + "\n");
+            }
+            closeLog(writer, file);
+        } catch (Exception e) {
+            e.printStackTrace();
+        }
     }
 
     @Override
     public byte[] transform(ClassLoader loader, String className, Class<?> classBeingRedefined,
             ProtectionDomain protectionDomain, byte[] classfileBuffer) throws IllegalClassFormatException {
 
-        // only transform classes in classesPath
-        if (!protectionDomain.getCodeSource().getLocation().getPath().contains(classesPath)) {
+        if (hookTests && TestHook.TEST_RESULT.equals(className)) {
+            return TestHook.instrument(loader, classfileBuffer);
+        }
+        // only transform classes in the scope and in classesPath
+        if (className == null || protectionDomain == null
+                || !scope.contains(className.replace("/", "."))) {
+            return null;
+        }
+        Boolean inPath = inClassesPath.get(protectionDomain);
+        if (inPath == null) {
+            CodeSource codeSource = protectionDomain.getCodeSource();
+            inPath = codeSource != null && codeSource.getLocation() != null
+                    && codeSource.getLocation().getPath().contains(classesPath);
+            inClassesPath.put(protectionDomain, inPath);
+        }
+        if (!inPath) {
             return null;
         }
 
         try {
+            // the class was instrumented by an earlier run
+            String key = null;
+            if (cache != null) {
+                key = cache.key(classfileBuffer);
+                BytecodeCache.Entry entry = cache.load(key);
+                if (entry != null && registerMethods(entry)) {
+                    return entry.bytecode;
+                }
+            }
+
             // solve className, consider inner class
             className = className.replace("/", ".");
             ClassPool pool = ClassPool.getDefault();
             CtClass ctClass = pool.get(className);
+            List<Integer> methodIds = new ArrayList<>();
             CtMethod[] cms = ctClass.getDeclaredMethods();
             for (CtMethod cm : cms) {
-                transformMethod(cm);
+                methodIds.add(transformMethod(cm));
             }
             CtConstructor[] ccs = ctClass.getConstructors();
             for (CtConstructor cc : ccs) {
-                transformConstructor(cc);
+                methodIds.add(transformConstructor(cc));
             }
-            return ctClass.toBytecode();
+            byte[] bytecode = ctClass.toBytecode();
+            if (cache != null) {
+                BytecodeCache.Entry entry = new BytecodeCache.Entry();
+                for (int methodId : methodIds) {
+                    if (methodId != -1) {
+                        entry.ids.add(methodId);
+                        entry.signatures.add(segment(methodId).signatures.get(methodId & SEGMENT_MASK));
+                        entry.methods.add(segment(methodId).methods.get(methodId & SEGMENT_MASK));
+                    }
+                }
+                entry.bytecode = bytecode;
+                cache.store(key, entry);
+            }
+            return bytecode;
         } catch (Exception e) {
             e.printStackTrace();
         }
@@ -75,10 +342,11 @@ public class ClassTransformer implements ClassFileTransformer {
     }
     
 
-    public static int generateMethodId(Integer hashcode, String clazzName, String methodName,
+    public static synchronized int generateMethodId(String signature, String clazzName, String methodName,
             List<String> parameterNameList, List<String> parameterTypeList, String returnType) {
-        if (methodInfos.containsKey(hashcode)) {
-            return methodInfos.get(hashcode);
+        Integer known = methodInfos.get(signature);
+        if (known != null) {
+            return known;
         }
 
         Method method = new Method();
@@ -88,16 +356,58 @@ public class ClassTransformer implements ClassFileTransformer {
         method.setParameterTypeList(parameterTypeList);
         method.setReturnType(returnType);
 
-        int methodId = index.getAndIncrement();
-        if (methodId > MAX_NUM) {
+        int methodId = index;
+        if (cache != null) {
+            // the ids of the cached classes are the same in all runs
+            try {
+                methodId = cache.idOf(signature);
+            } catch (Exception e) {
+                e.printStackTrace();
+                cache = null;
+            }
+        }
+        if (!registerMethod(methodId, signature, method)) {
+            System.err.println("too many methods, " + signature + " is not instrumented");
             return -1;
         }
-        methodTagArr.set(methodId, method);
-        methodInfos.put(hashcode, methodId);
         return methodId;
     }
 
-    private void transformConstructor(CtConstructor constructor)
+    private static synchronized boolean registerMethod(int methodId, String signature, Method method) {
+        int segmentId = methodId >>> SEGMENT_BITS;
+        if (segmentId >= MAX_SEGMENTS) {
+            return false;
+        }
+        if (segments.get(segmentId) == null) {
+            segments.set(segmentId, new Segment());
+        }
+        Segment segment = segments.get(segmentId);
+        if (segment.methods.get(methodId & SEGMENT_MASK) == null) {
+            // e.g. a class loaded by several class loaders is registered once
+            if (numRegistered == registered.length) {
+                registered = Arrays.copyOf(registered, 2 * numRegistered);
+            }
+            registeredSorted = registeredSorted && (numRegistered == 0 || registered[numRegistered - 1] < methodId);
+            registered[numRegistered++] = methodId;
+        }
+        segment.methods.set(methodId & SEGMENT_MASK, method);
+        segment.signatures.set(methodId & SEGMENT_MASK, signature);
+        segment.loaded[methodId & SEGMENT_MASK] = true;
+        methodInfos.put(signature, methodId);
+        index = Math.max(index, methodId + 1);
+        return true;
+    }
+
+    private static synchronized boolean registerMethods(BytecodeCache.Entry entry) {
+        for (int i = 0; i < entry.ids.size(); i++) {
+            if (!registerMethod(entry.ids.get(i), entry.signatures.get(i), entry.methods.get(i))) {
+                return false;
+            }
+        }
+        return true;
+    }
+
+    private int transformConstructor(CtConstructor constructor)
             throws CannotCompileException, NotFoundException {
         CtClass declaringClass = constructor.getDeclaringClass();
 
@@ -112,25 +422,21 @@ public class ClassTransformer implements ClassFileTransformer {
         CodeAttribute codeAttribute = constructor.getMethodInfo().getCodeAttribute();
         // if abstract or native method, codeAttribute will be null
         if (codeAttribute == null) {
-            return;
+            return -1;
         }
 
         String signature = declaringClass.getName() + "." + constructor.getName() + constructor.getSignature();
-        int idx = generateMethodId(signature.hashCode(), declaringClass.getName(), constructor.getName(),
+        int idx = generateMethodId(signature, declaringClass.getName(), constructor.getName(),
                 parameterNameList, parameterTypeList, "void");
         System.out.println(constructor.getName());
-        
-        try {
-            FileWriter fw = new FileWriter(instLogFile, true);
-            fw.write(methodTagArr.get(idx).toString() + "\n");
-            fw.close();
-        } catch (Exception e) {
-            e.printStackTrace();
+        if (idx == -1) {
+            return -1;
         }
-        constructor.insertBefore("com.qyh.agent.ClassTransformer.point(" + idx + ",\"" + runLogFile + "\");");
+        constructor.insertBefore("com.qyh.agent.ClassTransformer.point(" + idx + ");");
+        return idx;
     }
 
-    private void transformMethod(CtMethod method)
+    private int transformMethod(CtMethod method)
             throws CannotCompileException, NotFoundException {
 
         // parameterTypeList
@@ -144,7 +450,7 @@ public class ClassTransformer implements ClassFileTransformer {
         CodeAttribute codeAttribute = method.getMethodInfo().getCodeAttribute();
         // if abstract or native method, codeAttribute will be null
         if (codeAttribute == null) {
-            return;
+            return -1;
         }
 
         LocalVariableAttribute attribute = (LocalVariableAttribute) codeAttribute
@@ -155,31 +461,20 @@ public class ClassTransformer implements ClassFileTransformer {
 
         CtClass declaringClass = method.getDeclaringClass();
         String signature = declaringClass.getName() + "." + method.getName() + method.getSignature();
-        int idx = generateMethodId(signature.hashCode(), declaringClass.getName(), method.getName(),
+        int idx = generateMethodId(signature, declaringClass.getName(), method.getName(),
                 parameterNameList, parameterTypeList, method.getReturnType().getName());
-        
-        try {
-            FileWriter fw = new FileWriter(instLogFile, true);
-            fw.write(methodTagArr.get(idx).toString() + "\n");
-            fw.close();
-        } catch (Exception e) {
-            e.printStackTrace();
+        if (idx == -1) {
+            return -1;
         }
-        method.insertBefore("com.qyh.agent.ClassTransformer.point(" + idx + ",\"" + runLogFile + "\");");
+        method.insertBefore("com.qyh.agent.ClassTransformer.point(" + idx + ");");
+        return idx;
     }
 
-    public static void point(final int methodId, final String runLogFile) {
-        if (runedMethods.contains(methodId)) {
-            return;
-        }
-        runedMethods.add(methodId);
-        Method method = methodTagArr.get(methodId);
-        try {
-            FileWriter fw = new FileWriter(runLogFile, true);
-            fw.write(method.toString() + "\n");
-            fw.close();
-        } catch (Exception e) {
-            e.printStackTrace();
+    public static void point(final int methodId) {
+        Segment segment = segment(methodId);
+        segment.probes[methodId & SEGMENT_MASK] = true;
+        if (segment.hitCounts != null) {
+            segment.hitCounts.incrementAndGet(methodId & SEGMENT_MASK);
         }
     }
 }
@@ -0,0 +1,81 @@
+package com.qyh.agent;
+
+import java.util.ArrayList;
+import java.util.List;
+
+/**
+ * The classes to instrument, given by the agent arguments (a list is separated by ":"):
+ *
+ * include=com.example.*:org.foo.Bar    packages (with their sub packages) or classes to instrument
+ * exclude=com.example.generated.*      packages or classes not to instrument
+ * classes=Bar:com.example.Baz          allow-list of classes, a name without package matches the class in any package
+ *
+ * The inner classes of a class are in the scope of the class. Without include and classes all classes
+ * (except the excluded ones) are instrumented.
+ */
+public class InstrumentScope {
+    private final List<String> includes;
+    private final List<String> excludes;
+    private final List<String> classes;
+
+    public InstrumentScope(String include, String exclude, String classes) {
+        this.includes = split(include);
+        this.excludes = split(exclude);
+        this.classes = split(classes);
+    }
+
+    private static List<String> split(String value) {
+        List<String> list = new ArrayList<>();
+        if (value != null) {
+            for (String item : value.split(":")) {
+                if (!item.isEmpty()) {
+                    list.add(item);
+                }
+            }
+        }
+        return list;
+    }
+
+    /**
+     * e.g. com.example.* matches com.example.Foo and com.example.sub.Foo, com.example.Foo matches
+     * com.example.Foo and com.example.Foo$Inner
+     */
+    private static boolean matches(String pattern, String className) {
+        if (pattern.endsWith("*")) {
+            return className.startsWith(pattern.substring(0, pattern.length() - 1));
+        }
+        return className.equals(pattern) || className.startsWith(pattern + "$");
+    }
+
+    private boolean allowed(String className) {
+        int dollar = className.indexOf('$');
+        String outerName = dollar == -1 ? className : className.substring(0, dollar);
+        String simpleName = outerName.substring(outerName.lastIndexOf('.') + 1);
+        for (String name : classes) {
+            if (name.contains(".") ? outerName.equals(name) : simpleName.equals(name)) {
+                return true;
+            }
+        }
+        return false;
+    }
+
+    /**
+     * @param className e.g. com.example.Foo$Inner
+     */
+    public boolean contains(String className) {
+        for (String pattern : excludes) {
+            if (matches(pattern, className)) {
+                return false;
+            }
+        }
+        if (includes.isEmpty() && classes.isEmpty()) {
+            return true;
+        }
+        for (String pattern : includes) {
+            if (matches(pattern, className)) {
+                return true;
+            }
+        }
+        return allowed(className);
+    }
+}
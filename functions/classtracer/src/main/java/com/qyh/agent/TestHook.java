@@ -0,0 +1,52 @@
+package com.qyh.agent;
+
+import java.io.ByteArrayInputStream;
+
+import javassist.ClassPool;
+import javassist.CtClass;
+import javassist.LoaderClassPath;
+
+/**
+ * Test boundaries of a JVM that runs several tests, e.g. the tests of a suite run by the Defects4J harness:
+ *
+ * defects4j test -w ... -t com.example.FooTest::testA,testB -a -Djvmargs=-javaagent:classtracer-1.0.jar=...,perTest=true
+ *
+ * JUnit 3 runners and the JUnit 4 adapter of ant report every test to junit.framework.TestResult, its startTest
+ * and endTest are instrumented to call ClassTransformer.startTest and ClassTransformer.finishTest.
+ */
+public class TestHook {
+
+    public static final String TEST_RESULT = "junit/framework/TestResult";
+
+    /**
+     * the bytecode of TestResult with the test boundaries, null if it cannot be instrumented
+     */
+    public static byte[] instrument(ClassLoader loader, byte[] classfileBuffer) {
+        try {
+            ClassPool pool = new ClassPool(true);
+            if (loader != null) {
+                pool.appendClassPath(new LoaderClassPath(loader));
+            }
+            CtClass ctClass = pool.makeClass(new ByteArrayInputStream(classfileBuffer));
+            ctClass.getDeclaredMethod("startTest").insertBefore(
+                    "com.qyh.agent.ClassTransformer.startTest(com.qyh.agent.TestHook.testName(String.valueOf($1)));");
+            ctClass.getDeclaredMethod("endTest").insertBefore(
+                    "com.qyh.agent.ClassTransformer.finishTest(com.qyh.agent.TestHook.testName(String.valueOf($1)));");
+            return ctClass.toBytecode();
+        } catch (Exception e) {
+            e.printStackTrace();
+        }
+        return null;
+    }
+
+    /**
+     * the Defects4J name of a test, "com.example.FooTest::testA" for the description "testA(com.example.FooTest)"
+     */
+    public static String testName(String description) {
+        int open = description.lastIndexOf('(');
+        if (open <= 0 || !description.endsWith(")")) {
+            return description;
+        }
+        return description.substring(open + 1, description.length() - 1) + "::" + description.substring(0, open);
+    }
+}
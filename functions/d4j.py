@@ -3,6 +3,8 @@ import json
 import os
 import re
 import sys
+import threading
+from collections import defaultdict
 from functools import reduce
 from typing import Dict, List, Tuple
 
@@ -15,7 +17,7 @@ from chatdev.test_suite import (
     TestSuite,
     TestUtilityMethod,
 )
-from functions.instrument import run_instrument
+from functions.instrument import run_instrument_suite
 from functions.line_parser import (
     JavaClass,
     JavaMethod,
@@ -39,6 +41,16 @@ root = os.path.dirname(filepath)
 directory = os.path.join(root, "DebugResult")
 agent_jar = os.path.join(root, "functions/classtracer/target/classtracer-1.0.jar")
 
+# defects4j commands in the same working directory must not overlap (build outputs, failing_tests),
+# the test suites of a bug that run concurrently take turns on its buggy directory
+_buggy_path_locks = defaultdict(threading.Lock)
+_buggy_path_locks_lock = threading.Lock()
+
+
+def buggy_path_lock(buggy_path) -> threading.Lock:
+    with _buggy_path_locks_lock:
+        return _buggy_path_locks[os.path.realpath(buggy_path)]
+
 
 def check_out(version, project, bugID, project_path=None):
     cwd = os.getcwd()
@@ -267,7 +279,7 @@ def get_failed_tests(version, project, bugID, project_path, cache_path) -> TestF
     for test_suite in test_failure.test_suites:
         for test_case in test_suite.test_cases:
             test_name = test_case.name
-            print(f"<run instrumentation for {project}-{bugID}-{test_name}>")
+            print(f"<run test for {project}-{bugID}-{test_name}>")
             test_tmp_dir = os.path.join(tmp_path, test_suite.name, test_name)
             os.makedirs(test_tmp_dir, exist_ok=True)
 
@@ -276,8 +288,17 @@ def get_failed_tests(version, project, bugID, project_path, cache_path) -> TestF
             test_case.test_output = test_output
             test_case.stack_trace = stack_trace
 
-            # run instrumentation
-            run_instrument(test_name, buggy_path, test_tmp_dir, agent_jar, mode="test")
+        # run instrumentation, all tests of the suite run in one JVM
+        print(f"<run instrumentation for {project}-{bugID}-{test_suite.name}>")
+        run_instrument_suite([test_case.name for test_case in test_suite.test_cases], buggy_path,
+                             os.path.join(tmp_path, test_suite.name), agent_jar, mode="test",
+                             include=get_source_packages(buggy_path, test_path),
+                             classes=get_class_name_from_msg(tmp_path, test_suite))
+
+        for test_case in test_suite.test_cases:
+            test_name = test_case.name
+            test_tmp_dir = os.path.join(tmp_path, test_suite.name, test_name)
+            stack_trace = test_case.stack_trace
 
             # find all related test code
             run_log_file = os.path.join(test_tmp_dir, "run_test.log")
@@ -489,21 +510,26 @@ def extract_classes(
     tmp_path = os.path.join(cache_dir, "tmp")
 
     cmd = f"defects4j export -p dir.src.classes -w {buggy_path}"
-    src_path, err = run_cmd(cmd)
+    with buggy_path_lock(buggy_path):
+        src_path, err = run_cmd(cmd)
 
     loaded_classes = []
     covered_classes = []
     test_suite_name = test_suite.name
+    extra_class_names = get_class_name_from_msg(tmp_path, test_suite)
     print(f"[extracting classes for test suite {project}-{bugID}-{test_suite_name}...]")
+    # all tests of the suite run in one JVM, the coverage is recorded per test
+    with buggy_path_lock(buggy_path):
+        run_instrument_suite([test_case.name for test_case in test_suite.test_cases], buggy_path,
+                             os.path.join(tmp_path, test_suite.name), agent_jar, mode="src",
+                             include=get_source_packages(buggy_path, src_path), classes=extra_class_names)
     for test_case in test_suite.test_cases:
         test_name = test_case.name
         print(f"  <{project}-{bugID}-{test_name}>")
         test_tmp_dir = os.path.join(tmp_path, test_suite.name, test_name)
-        os.makedirs(test_tmp_dir, exist_ok=True)
         inst_log = os.path.join(test_tmp_dir, "inst_src.log")
         run_log = os.path.join(test_tmp_dir, "run_src.log")
         
-        run_instrument(test_name, buggy_path, test_tmp_dir, agent_jar, mode="src")
         class_list, covered_class_list = parse_coverage(inst_log, run_log)
         loaded_classes.append(class_list)
         if len(covered_class_list) == 0:
@@ -523,7 +549,6 @@ def extract_classes(
             print(f"Warning: skip classes intersection")
 
         extracted_class_names = set(common_class_names)
-        extra_class_names = get_class_name_from_msg(tmp_path, test_suite)
         for i in extra_class_names:
             for j in common_class_names:
                 if (i in j) and (j not in extracted_class_names):
@@ -537,7 +562,6 @@ def extract_classes(
         print(f"<classes selection for single failed test...>")
         class_names = list(covered_classes[0].keys())
         extracted_class_names = set(class_names)
-        extra_class_names = get_class_name_from_msg(tmp_path, test_suite)
         for i in extra_class_names:
             for j in class_names:
                 if (i in j.split(".")[-1]) and (j not in extracted_class_names):
@@ -554,6 +578,23 @@ def extract_classes(
     return loaded_classes, covered_classes, extracted_classes
 
 
+def get_source_packages(buggy_path, src_path):
+    """
+    The root packages of the java files in src_path as instrumentation scope, e.g., ["org.apache.commons.lang3.*"].
+    Empty if there are java files in the default package.
+    """
+    src_dir = os.path.join(buggy_path, src_path)
+    packages = set()
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        if any(filename.endswith(".java") for filename in filenames):
+            packages.add(os.path.relpath(dirpath, src_dir).replace(os.sep, "."))
+            # the sub packages are in the scope of the package
+            dirnames.clear()
+    if "." in packages:
+        return []
+    return sorted(f"{package}.*" for package in packages)
+
+
 def get_class_name_from_msg(tmp_path, test_suite):
     """
     Some buggy classes may have low method level coverage proportion rank because of the crash, 
@@ -1,5 +1,6 @@
-import tiktoken
+from functools import lru_cache
 
+from camel.utils import get_encoding
 from functions.d4j import extract_classes, filter_classes_Grace, filter_classes_Ochiai
 
 
@@ -221,8 +222,10 @@ def methods_list_prompt(java_class, model_type, method_doc_tokens=100, use_comme
         return prompt
 
 
+# the memo holds the truncated docs, a few per class and method of a bug
+@lru_cache(maxsize=1024)
 def check_tokens(model_type, doc, max_tokens):
-    encoding = tiktoken.encoding_for_model(model_type.value)
+    encoding = get_encoding(model_type.value)
     original_tokens = encoding.encode(doc)
     num_doc_tokens = len(original_tokens)
     if num_doc_tokens <= max_tokens:
@@ -1,9 +1,88 @@
+import functools
+import hashlib
 import os
+import subprocess as sp
+import zipfile
 
 from functions.utils import run_cmd
 
+# directory of the instrumented classes kept by the agent across runs, disabled if not set
+INST_CACHE_DIR = os.environ.get("INST_CACHE_DIR")
+# default scope of the instrumentation, ":" separated packages (e.g. com.example.*) or classes
+INST_INCLUDE = os.environ.get("INST_INCLUDE")
+INST_EXCLUDE = os.environ.get("INST_EXCLUDE")
+# seconds of an instrumented defects4j run before its JVM is killed
+INST_TIMEOUT = float(os.environ.get("INST_TIMEOUT", 1800))
 
-def run_instrument(test_name, buggy_dir, tmp_dir, agent_jar, mode="src"):
+
+@functools.lru_cache(maxsize=None)
+def _agent_entries(agent_jar, mtime):
+    with zipfile.ZipFile(agent_jar) as jar:
+        return frozenset(jar.namelist())
+
+
+def agent_has_class(agent_jar, class_name):
+    """
+    Whether the agent jar contains a class, e.g., "com.qyh.agent.TestHook". A jar built before the class was
+    added has to be rebuilt with `mvn package` in functions/classtracer.
+    """
+    entries = _agent_entries(agent_jar, os.path.getmtime(agent_jar))
+    return class_name.replace(".", "/") + ".class" in entries
+
+
+def project_cache_dir(classes_dir):
+    """
+    The cache of the project of `classes_dir` in INST_CACHE_DIR, each project has its own registry of method ids.
+    The project is the `d4j.project.id` of the Defects4J checkout containing `classes_dir`, a directory outside
+    of a checkout has a cache of its own.
+    """
+    project = None
+    checkout_dir = os.path.abspath(classes_dir)
+    while project is None and os.path.dirname(checkout_dir) != checkout_dir:
+        properties = os.path.join(checkout_dir, "defects4j.build.properties")
+        if os.path.exists(properties):
+            with open(properties, "r") as f:
+                for line in f:
+                    if line.startswith("d4j.project.id="):
+                        project = line.strip().split("=", 1)[1]
+        checkout_dir = os.path.dirname(checkout_dir)
+    if project is None:
+        project = hashlib.sha1(os.path.abspath(classes_dir).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(os.path.abspath(INST_CACHE_DIR), project)
+
+
+def agent_options(agent_jar, tmp_dir, classes_dir, include=None, exclude=None, classes=None, per_test=False):
+    """
+    The arguments of the agent. Only the classes matching `include` (packages such as "com.example.*" or classes)
+    or named in `classes` (e.g., the simple names of get_class_name_from_msg) are instrumented, except those
+    matching `exclude`. Without `include` and `classes` all classes in `classes_dir` are instrumented. A scope
+    needs an `agent_jar` with InstrumentScope, the cache of INST_CACHE_DIR is only used if `agent_jar` supports it.
+    With `per_test`, the logs of each test of the JVM are written to tmp_dir/<test_name> (see TestHook).
+    """
+    options = f"outputDir={tmp_dir},classesPath={classes_dir}"
+    include = ":".join(include) if include else INST_INCLUDE
+    exclude = ":".join(exclude) if exclude else INST_EXCLUDE
+    if (include or exclude or classes) and not agent_has_class(agent_jar, "com.qyh.agent.InstrumentScope"):
+        raise RuntimeError(f"No InstrumentScope in the agent jar {agent_jar}, rebuild it with `mvn package` "
+                           f"in functions/classtracer")
+    if include:
+        options += f",include={include}"
+    if exclude:
+        options += f",exclude={exclude}"
+    if classes:
+        options += f",classes={':'.join(classes)}"
+    if INST_CACHE_DIR:
+        if agent_has_class(agent_jar, "com.qyh.agent.BytecodeCache"):
+            options += f",cacheDir={project_cache_dir(classes_dir)}"
+        else:
+            print(f"Warning: no BytecodeCache in the agent jar {agent_jar}, INST_CACHE_DIR is not used, "
+                  f"rebuild it with `mvn package` in functions/classtracer")
+    if per_test:
+        options += ",perTest=true"
+    return options
+
+
+def run_instrument(test_name, buggy_dir, tmp_dir, agent_jar, mode="src", include=None, exclude=None, classes=None):
     
     log = ""
     
@@ -31,9 +110,13 @@ def run_instrument(test_name, buggy_dir, tmp_dir, agent_jar, mode="src"):
     except Exception as e:
         raise RuntimeError(f"Failed to export \"{property}\" for {buggy_dir}, {e}")
 
-    cmd2 = f"defects4j test -n -w {buggy_dir} -t {test_name} -a -Djvmargs=-javaagent:{agent_jar}=outputDir={tmp_dir},classesPath={classes_dir}"
-    out, err = run_cmd(cmd2)
-    log = log + out + err
+    cmd2 = f"defects4j test -n -w {buggy_dir} -t {test_name} -a -Djvmargs=-javaagent:{agent_jar}={agent_options(agent_jar, tmp_dir, classes_dir, include, exclude, classes)}"
+    try:
+        out, err = run_cmd(cmd2, timeout=INST_TIMEOUT)
+        log = log + out + err
+    except sp.TimeoutExpired:
+        # the agent flushes its logs periodically, the coverage up to the kill is kept
+        print(f"Warning: the instrumented run of {test_name} timed out after {INST_TIMEOUT}s")
     
     if os.path.exists(os.path.join(tmp_dir, "run.log")):
         os.rename(os.path.join(tmp_dir, "run.log"), run_log)
@@ -43,6 +126,87 @@ def run_instrument(test_name, buggy_dir, tmp_dir, agent_jar, mode="src"):
     return log
 
 
+def run_instrument_suite(test_names, buggy_dir, tmp_dir, agent_jar, mode="src", include=None, exclude=None,
+                         classes=None):
+    """
+    Run the tests of each test class in one JVM under instrumentation, instead of one defects4j run per test.
+    The tests are run by the Defects4J harness (`defects4j test -t Class::test1,test2`), the agent takes the test
+    boundaries from JUnit (see TestHook) and writes the logs of each test to tmp_dir/<test_name>, inst_{mode}.log
+    and run_{mode}.log as with run_instrument. The inst log of a test holds the classes loaded or run during the
+    test, a class loaded by an earlier test of the JVM and not run is missing. The runs are killed after
+    INST_TIMEOUT seconds, the tests without logs after the runs (e.g., the JVM timed out or crashed) are
+    instrumented one by one with run_instrument. The scope of the instrumentation (`include`, `exclude`,
+    `classes`) is described in agent_options.
+    """
+    log = ""
+
+    if mode == "src":
+        property = "dir.bin.classes"
+    elif mode == "test":
+        property = "dir.bin.tests"
+    else:
+        raise RuntimeError(
+            f"Unknown mode: {mode}, should be one of ['src', 'test']")
+
+    def done(test_name):
+        test_tmp_dir = os.path.join(tmp_dir, test_name)
+        return (os.path.exists(os.path.join(test_tmp_dir, f"inst_{mode}.log"))
+                and os.path.exists(os.path.join(test_tmp_dir, f"run_{mode}.log")))
+
+    todo = [test_name for test_name in test_names if not done(test_name)]
+    if len(todo) == 0:
+        print("instrumentation already done")
+        return log
+    if not agent_has_class(agent_jar, "com.qyh.agent.TestHook"):
+        raise RuntimeError(f"No TestHook in the agent jar {agent_jar}, rebuild it with `mvn package` "
+                           f"in functions/classtracer")
+
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    try:
+        cmd1 = f"defects4j export -p {property} -w {buggy_dir}"
+        out, err = run_cmd(cmd1)
+        log = log + out + err
+        classes_dir = os.path.join(buggy_dir, out)
+    except Exception as e:
+        raise RuntimeError(f"Failed to export \"{property}\" for {buggy_dir}, {e}")
+
+    # the logs of an interrupted run are not reused
+    test_methods = {}
+    for test_name in todo:
+        for file in ["inst.log", "run.log"]:
+            if os.path.exists(os.path.join(tmp_dir, test_name, file)):
+                os.remove(os.path.join(tmp_dir, test_name, file))
+        test_class, test_method = test_name.split("::")
+        test_methods.setdefault(test_class, []).append(test_method)
+
+    options = agent_options(agent_jar, tmp_dir, classes_dir, include, exclude, classes, per_test=True)
+    for test_class, methods in test_methods.items():
+        cmd2 = f"defects4j test -n -w {buggy_dir} -t {test_class}::{','.join(methods)} -a -Djvmargs=-javaagent:{agent_jar}={options}"
+        try:
+            out, err = run_cmd(cmd2, timeout=INST_TIMEOUT)
+            log = log + out + err
+        except sp.TimeoutExpired:
+            print(f"Warning: the instrumented run of {test_class} timed out after {INST_TIMEOUT}s")
+
+    for test_name in todo:
+        test_tmp_dir = os.path.join(tmp_dir, test_name)
+        # the run log is written last, the logs of a test are complete once it exists
+        if os.path.exists(os.path.join(test_tmp_dir, "run.log")):
+            os.rename(os.path.join(test_tmp_dir, "inst.log"), os.path.join(test_tmp_dir, f"inst_{mode}.log"))
+            os.rename(os.path.join(test_tmp_dir, "run.log"), os.path.join(test_tmp_dir, f"run_{mode}.log"))
+        else:
+            print(f"Warning: no coverage of {test_name} in the run of its test class, instrument it alone")
+            log = log + run_instrument(test_name, buggy_dir, test_tmp_dir, agent_jar, mode=mode,
+                                       include=include, exclude=exclude, classes=classes)
+    # the logs of the whole runs
+    for file in ["inst.log", "run.log"]:
+        if os.path.exists(os.path.join(tmp_dir, file)):
+            os.remove(os.path.join(tmp_dir, file))
+
+    return log
+
+
 def test():
     run_instrument(
         "com.google.javascript.jscomp.TypeCheckTest::testBadInterfaceExtendsNonExistentInterfaces",
@@ -1,3 +1,4 @@
+import logging
 import os
 import re
 from typing import List, Optional
@@ -166,15 +167,23 @@ def parse_test_run_log(lines):
 
 
 def parse_coverage(inst_file, run_file):
-    assert os.path.exists(inst_file), "Error: No instrument file:\n"
+    """
+    The logs are dumped by the agent periodically and when the JVM exits, the logs of a JVM killed by a
+    timeout may be older than the run or end with a truncated line. The methods of the run file missing in the
+    inst file are added, the malformed lines are logged and skipped.
+    """
+    assert os.path.exists(inst_file), f"Error: No instrument file: {inst_file}\n"
     classes_dict = {}
 
     # parse instrumentation file
     with open(inst_file, "r") as f:
-        for line in f:
+        for line_no, line in enumerate(f, 1):
             if line is None:
                 continue
             line = line.strip()
+            if len(line.split(" ")) != 3:
+                logging.warning(f"Malformed line {line_no} of {inst_file}: {line!r}")
+                continue
             class_name, method, _ = line.split(" ")
             inner = True if "$" in class_name else False
             # add outer class
@@ -190,10 +199,13 @@ def parse_coverage(inst_file, run_file):
     if os.path.exists(run_file):
         # parse method run file
         with open(run_file, "r") as f:
-            for line in f:
+            for line_no, line in enumerate(f, 1):
                 if line is None:
                     continue
                 line = line.strip()
+                if len(line.split(" ")) != 3:
+                    logging.warning(f"Malformed line {line_no} of {run_file}: {line!r}")
+                    continue
                 class_name, method, _ = line.split(" ")
                 inner = True if "$" in class_name else False
                 outer_class_name = class_name.split("$")[0] if inner else class_name
@@ -202,11 +214,11 @@ def parse_coverage(inst_file, run_file):
                     continue
                 key = class_name + "::" + method_sig
 
+                # a method instrumented after the last dump of the inst file
                 if outer_class_name not in classes_dict:
-                    raise Exception(f"{outer_class_name} not in inst file")
+                    classes_dict[outer_class_name] = JavaClass(outer_class_name)
                 if key not in classes_dict[outer_class_name].methods:
-                    raise Exception(
-                        f"{key} not in inst file")
+                    classes_dict[outer_class_name].add_methods(JavaMethod(class_name, method_sig, inner))
                 java_method = classes_dict[outer_class_name].methods[key]
                 if java_method._covered is False:
                     java_method.set_covered()
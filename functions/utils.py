@@ -1,11 +1,22 @@
 import os
 import re
+import signal
 import subprocess as sp
 
 
-def run_cmd(cmd: str):
-    p = sp.Popen(cmd.split(" "), stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE)
-    output, err = p.communicate()
+def run_cmd(cmd: str, cwd=None, timeout=None):
+    """
+    Run a command and return its output. After `timeout` seconds the command and the processes it started
+    (e.g., the JVM of the tests forked by defects4j) are killed and subprocess.TimeoutExpired is raised.
+    """
+    p = sp.Popen(cmd.split(" "), stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, cwd=cwd,
+                 start_new_session=timeout is not None)
+    try:
+        output, err = p.communicate(timeout=timeout)
+    except sp.TimeoutExpired:
+        os.killpg(p.pid, signal.SIGKILL)
+        p.communicate()
+        raise
     out = output.decode("utf-8")
     err = err.decode("utf-8")
     return out, err
@@ -0,0 +1,375 @@
+"""
+A local stand-in of the OpenAI chat completions API for load testing SoapFL without spending money.
+
+The answers are rule based and shaped like the conclusions each phase parses, the latency follows a
+configurable distribution and 429/500 errors can be injected. Point the backend at the server with:
+
+    python3 mock_server.py --port 8000 --latency normal --latency-mean 2 --error-429 0.05
+    export OPENAI_BASE_URL=http://127.0.0.1:8000/v1 OPENAI_API_KEY=mock
+    python3 run.py ...
+
+The request statistics are served on GET /stats and printed when the server stops.
+"""
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def count_tokens(text):
+    """
+    approximate token count, words and punctuations, so that the server does not need tiktoken
+    """
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+
+def stable_int(text, low, high):
+    """
+    deterministic integer in [low, high] for a text, the same prompt always gets the same answer
+    """
+    return low + int(hashlib.md5(text.encode()).hexdigest(), 16) % (high - low + 1)
+
+
+def filler(num_words, seed):
+    words = ["the", "method", "returns", "value", "when", "input", "is", "null", "so", "test",
+             "fails", "because", "state", "not", "updated", "correctly", "in", "this", "case"]
+    rnd = random.Random(seed)
+    sentences = []
+    while num_words > 0:
+        n = min(num_words, rnd.randint(8, 16))
+        sentence = " ".join(rnd.choice(words) for _ in range(n))
+        sentences.append(sentence[0].upper() + sentence[1:] + ".")
+        num_words -= n
+    return " ".join(sentences)
+
+
+def section(prompt, title):
+    """
+    the non-empty lines following a title line in the prompt
+    """
+    lines = prompt.split("\n")
+    for i, line in enumerate(lines):
+        if line.strip().startswith(title):
+            result = []
+            for next_line in lines[i + 1:]:
+                if next_line.strip() == "":
+                    if result:
+                        break
+                    continue
+                result.append(next_line.strip())
+            return result
+    return []
+
+
+def make_answer(prompt, num_words):
+    """
+    rule based answer in the format expected by each phase
+    """
+    seed = prompt
+    explanation = filler(num_words, seed)
+
+    # MethodReview, multiple methods in one table (NoMultipleMethodReview)
+    if "Suspiciousness Score" in prompt:
+        names = re.findall(r"method full name:(.+)", prompt)
+        rows = ["| Method Full Name | Reason | Suspiciousness Score |", "| --- | --- | --- |"]
+        for name in names:
+            rows.append(f"| {name.strip()} | {filler(12, name)} | {stable_int(name, 0, 10)} |")
+        return "\n".join(rows)
+
+    # MethodReview
+    if "#SCORE#" in prompt:
+        method_name = re.findall(r'code of the method "(.+?)"', prompt)
+        score = stable_int(method_name[0] if method_name else prompt, 0, 10)
+        return f"#{score}# {explanation}"
+
+    # SearchSuspiciousClass
+    if "Covered Classes List" in prompt:
+        test_suite = re.findall(r'test class "(.+?)"', prompt)
+        classes = [c for c in section(prompt, "Covered Classes List") if c not in test_suite]
+        if not classes:
+            return explanation
+        class_name = classes[stable_int(prompt, 0, len(classes) - 1)]
+        return f"According to the given information, the class #{class_name}# is the most suspicious. {explanation}"
+
+    # MethodDocEnhancement
+    if "| Method Full Name | Method Summary |" in prompt:
+        names = re.findall(r'Method Full Name: "(.+?)"', prompt)
+        rows = ["| Method Full Name | Method Summary |", "| --- | --- |"]
+        for name in names:
+            rows.append(f"| {name} | {filler(15, name)} |")
+        return "\n".join(rows)
+
+    # FindRelatedMethods
+    if "METHOD_FULL_NAME" in prompt:
+        names = []
+        for row in section(prompt, "| Index | Method Full Name"):
+            items = [item.strip() for item in row.strip("|").split("|")]
+            if len(items) >= 2 and items[0].isdigit():
+                names.append(items[1])
+        rnd = random.Random(seed)
+        selected = rnd.sample(names, min(len(names), 3))
+        return "\n".join(f"[{i + 1}] **{name}**: {filler(15, name)}" for i, name in enumerate(selected))
+
+    # TestBehaviorAnalysis, TestFailureAnalysis and the other chats
+    return explanation
+
+
+class MockState:
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.random = random.Random(args.seed)
+        self.window = []  # admission times of the last minute, for --rpm
+        self.prefixes = set()  # hashes of the prompt prefixes seen, for --prefix-cache
+        self.stats = {"requests": 0, "completed": 0, "streams_cut": 0, "error_429": 0, "error_500": 0,
+                      "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "in_flight": 0, "max_in_flight": 0}
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+            if key == "in_flight":
+                self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.stats["in_flight"])
+
+    def latency(self):
+        args = self.args
+        with self.lock:
+            if args.latency == "fixed":
+                value = args.latency_mean
+            elif args.latency == "normal":
+                value = self.random.gauss(args.latency_mean, args.latency_std)
+            elif args.latency == "lognormal":
+                # parameters of the underlying normal distribution from the mean and std of the latency
+                variance = (args.latency_std / args.latency_mean) ** 2 if args.latency_mean > 0 else 0
+                sigma = math.sqrt(math.log(1 + variance))
+                mu = math.log(max(args.latency_mean, 1e-6)) - sigma ** 2 / 2
+                value = self.random.lognormvariate(mu, sigma)
+            else:
+                value = self.random.expovariate(1 / args.latency_mean) if args.latency_mean > 0 else 0
+        return max(0.0, value)
+
+    def cached_tokens(self, messages):
+        """
+        simulates the prompt caching of the provider, the longest prompt prefix seen before is cached,
+        counted in blocks of 128 tokens from 1024 tokens on
+        """
+        if not self.args.prefix_cache:
+            return 0
+        tokens = []
+        for message in messages:
+            tokens += [message.get("role", "")] + re.findall(r"\w+|[^\w\s]", message.get("content") or "")
+        digest = hashlib.sha256()
+        keys = []
+        for end in range(128, len(tokens) + 1, 128):
+            digest.update("\x00".join(tokens[end - 128:end]).encode())
+            if end >= 1024:
+                keys.append((end, digest.hexdigest()))
+        cached = 0
+        with self.lock:
+            for end, key in keys:
+                if key in self.prefixes:
+                    cached = end
+            self.prefixes.update(key for _, key in keys)
+        return cached
+
+    def injected_error(self):
+        """
+        returns (status, retry_after) of an error to answer with, or None
+        """
+        args = self.args
+        with self.lock:
+            now = time.time()
+            if args.rpm > 0:
+                self.window = [t for t in self.window if t > now - 60]
+                if len(self.window) >= args.rpm:
+                    return 429, 60 - (now - self.window[0])
+                self.window.append(now)
+            draw = self.random.random()
+        if draw < args.error_429:
+            return 429, args.retry_after
+        if draw < args.error_429 + args.error_500:
+            return 500, None
+        return None
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: MockState = None
+
+    def log_message(self, format, *args):
+        if self.state.args.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            with self.state.lock:
+                self._send_json(200, dict(self.state.stats))
+        else:
+            self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        state = self.state
+        state.count("requests")
+
+        error = state.injected_error()
+        if error is not None:
+            status, retry_after = error
+            if status == 429:
+                state.count("error_429")
+                headers = {"retry-after": "{:.2f}".format(retry_after)} if retry_after is not None else {}
+                self._send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "requests",
+                                                "code": "rate_limit_exceeded"}}, headers)
+            else:
+                state.count("error_500")
+                self._send_json(500, {"error": {"message": "Internal server error (mock)", "type": "server_error"}})
+            return
+
+        messages = body.get("messages", [])
+        prompt = messages[-1]["content"] if messages else ""
+        content = make_answer(prompt, state.args.answer_words)
+        prompt_tokens = sum(count_tokens(m.get("content") or "") + 4 for m in messages) + 2
+        completion_tokens = count_tokens(content)
+        max_tokens = body.get("max_tokens")
+        finish_reason = "stop"
+        if max_tokens is not None and completion_tokens > max_tokens:
+            content = " ".join(content.split(" ")[:max_tokens])
+            completion_tokens = count_tokens(content)
+            finish_reason = "length"
+        cached_tokens = min(state.cached_tokens(messages), prompt_tokens)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens,
+                 "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+        state.count("cached_tokens", cached_tokens)
+        completion_id = "chatcmpl-mock-" + uuid.uuid4().hex[:12]
+        model = body.get("model", "mock")
+
+        state.count("in_flight")
+        try:
+            if body.get("stream"):
+                self._stream(completion_id, model, content, usage, finish_reason,
+                             (body.get("stream_options") or {}).get("include_usage", False))
+            else:
+                time.sleep(state.latency() + state.args.token_latency * completion_tokens)
+                self._send_json(200, {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "finish_reason": finish_reason,
+                                 "message": {"role": "assistant", "content": content}}],
+                    "usage": usage,
+                })
+                state.count("completed")
+                state.count("prompt_tokens", prompt_tokens)
+                state.count("completion_tokens", completion_tokens)
+        finally:
+            state.count("in_flight", -1)
+
+    def _stream(self, completion_id, model, content, usage, finish_reason, include_usage):
+        """
+        server-sent events, the first chunk is sent after the latency, then one chunk per word
+        """
+        state = self.state
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def chunk(delta, finish=None, chunk_usage=None):
+            data = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                    "model": model, "choices": [] if delta is None else
+                    [{"index": 0, "delta": delta, "finish_reason": finish}]}
+            if chunk_usage is not None:
+                data["usage"] = chunk_usage
+            self.wfile.write(f"data: {json.dumps(data)}\n\n".encode())
+            self.wfile.flush()
+
+        sent_tokens = 0
+        try:
+            time.sleep(state.latency())
+            chunk({"role": "assistant", "content": ""})
+            for word in re.findall(r"\S+\s*|\s+", content):
+                time.sleep(state.args.token_latency * count_tokens(word))
+                chunk({"content": word})
+                sent_tokens += count_tokens(word)
+            chunk({}, finish_reason)
+            if include_usage:
+                chunk(None, chunk_usage=usage)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+            state.count("completed")
+        except (BrokenPipeError, ConnectionResetError):
+            # the client closed the stream, e.g., cut off at the conclusion pattern
+            state.count("streams_cut")
+        state.count("prompt_tokens", usage["prompt_tokens"])
+        state.count("completion_tokens", sent_tokens)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OpenAI compatible mock server for load testing')
+    parser.add_argument('--host', type=str, default="127.0.0.1",
+                        help="Host to listen on")
+    parser.add_argument('--port', type=int, default=8000,
+                        help="Port to listen on")
+    parser.add_argument('--latency', type=str, default="fixed", choices=["fixed", "normal", "lognormal", "exponential"],
+                        help="Distribution of the latency before the first token")
+    parser.add_argument('--latency-mean', type=float, default=1.0,
+                        help="Mean latency before the first token in seconds")
+    parser.add_argument('--latency-std', type=float, default=0.5,
+                        help="Standard deviation of the latency in seconds (normal and lognormal)")
+    parser.add_argument('--token-latency', type=float, default=0.01,
+                        help="Generation time per completion token in seconds")
+    parser.add_argument('--answer-words', type=int, default=200,
+                        help="Number of words of the free-text explanations")
+    parser.add_argument('--error-429', type=float, default=0.0,
+                        help="Probability of answering with a 429 error")
+    parser.add_argument('--error-500', type=float, default=0.0,
+                        help="Probability of answering with a 500 error")
+    parser.add_argument('--retry-after', type=float, default=1.0,
+                        help="retry-after header of injected 429 errors in seconds")
+    parser.add_argument('--rpm', type=int, default=0,
+                        help="Requests per minute enforced with 429 errors, 0 for no limit")
+    parser.add_argument('--prefix-cache', action="store_true",
+                        help="Simulate the prompt caching of the provider, reported as cached_tokens in the usage")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Random seed of latencies and errors")
+    parser.add_argument('--verbose', action="store_true",
+                        help="Log every request")
+    args = parser.parse_args()
+
+    MockHandler.state = MockState(args)
+    server = ThreadingHTTPServer((args.host, args.port), MockHandler)
+    server.daemon_threads = True
+    print(f"Mock OpenAI server on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(MockHandler.state.stats, indent=4))
+
+
+if __name__ == "__main__":
+    main()
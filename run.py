@@ -12,11 +12,11 @@
 # limitations under the License.
 # =========== Copyright 2023 @ CAMEL-AI.org. All Rights Reserved. ===========
 import argparse
-import logging
 import os
 import pickle
 import random
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 from camel.typing import ModelType
 from functions.d4j import check_out, get_failed_tests
@@ -25,6 +25,7 @@ root = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(root)
 
 from chatdev.chat_chain import ChatChain
+from chatdev.utils import setup_logging
 
 
 def get_config(company):
@@ -59,6 +60,43 @@ def get_config(company):
 
     return tuple(config_paths)
 
+def run_test_suite(chat_chain, test_suite, test_cases):
+    print("-" * 100)
+
+    # ----------------------------------------
+    #      Set Test Suite and Test Cases
+    # ----------------------------------------
+
+    chat_chain.test_suite = test_suite
+    chat_chain.test_cases = test_cases
+    print(f"Start DebugDev for test suite {chat_chain.test_suite.name}...")
+    if len(test_suite.test_cases) > len(test_cases):
+        print(f"Test cases {len(test_suite.test_cases)} => {len(test_cases)}")
+    else:
+        print(f"Test cases {len(test_suite.test_cases)}")
+
+    # ----------------------------------------
+    #          Pre Processing
+    # ----------------------------------------
+
+    chat_chain.pre_processing()
+    print(f"Pre processing finished!")
+
+    # ----------------------------------------
+    #          Personnel Recruitment
+    # ----------------------------------------
+
+    chat_chain.make_recruitment()
+    print(f"Employees recruitment finished!")
+
+    # ----------------------------------------
+    #          Chat Chain
+    # ----------------------------------------
+
+    chat_chain.execute_chain()
+    print("-" * 100)
+
+
 def main():
     parser = argparse.ArgumentParser(description='argparse')
     parser.add_argument('--config', type=str, default="Default",
@@ -129,9 +167,7 @@ def main():
     # ----------------------------------------
     #          Init Log
     # ----------------------------------------
-    logging.basicConfig(filename=chat_chain.log_filepath, level=logging.INFO,
-                        format='[%(asctime)s %(levelname)s] %(message)s',
-                        datefmt='%Y-%d-%m %H:%M:%S')
+    setup_logging(chat_chain.log_filepath, chat_chain.config.get("log_mode", "sync"))
 
     # ----------------------------------------
     #          Run ChatChain for each test suite
@@ -142,49 +178,46 @@ def main():
     if len(test_suites) > num_test_suites:
         test_suites = random.sample(test_suites, num_test_suites)
         print(f"Test suites {len(failed_tests.test_suites)} => {num_test_suites}")
+    test_cases = []
     for test_suite in test_suites:
-        print("-" * 100)
-
-        # ----------------------------------------
-        #      Set Test Suite and Test Cases
-        # ----------------------------------------
-        
-        chat_chain.test_suite = test_suite
-        print(f"Start DebugDev for test suite {chat_chain.test_suite.name}...")
-        
         num_test_cases = chat_chain.chat_env.config.num_test_cases
         if len(test_suite.test_cases) > num_test_cases:
-            chat_chain.test_cases = random.sample(test_suite.test_cases, num_test_cases)
-            print(f"Test cases {len(test_suite.test_cases)} => {num_test_cases}")
+            test_cases.append(random.sample(test_suite.test_cases, num_test_cases))
         else:
-            chat_chain.test_cases = test_suite.test_cases
-            print(f"Test cases {len(test_suite.test_cases)}")
-
-        # ----------------------------------------
-        #          Pre Processing
-        # ----------------------------------------
-
-        chat_chain.pre_processing()
-        print(f"Pre processing finished!")
-
-        # ----------------------------------------
-        #          Personnel Recruitment
-        # ----------------------------------------
-
-        chat_chain.make_recruitment()
-        print(f"Employees recruitment finished!")
-
-        # ----------------------------------------
-        #          Chat Chain
-        # ----------------------------------------
-
-        chat_chain.execute_chain()
-        print("-" * 100)
+            test_cases.append(test_suite.test_cases)
+
+    # with "prefetch", the coverage of the test suites is extracted in the background while the early phases
+    # wait on the model
+    with ThreadPoolExecutor(max_workers=1) as prefetch_executor:
+        if chat_chain.chat_env.config.prefetch:
+            for test_suite in test_suites:
+                chat_chain.prefetch(prefetch_executor, test_suite)
+
+        try:
+            if chat_chain.chat_env.config.concurrent_suites and len(test_suites) > 1:
+                # each test suite runs on its own copy of the chain, the results are merged in the order of the test suites
+                suite_chains = [chat_chain.fork(test_suite, cases) for test_suite, cases in zip(test_suites, test_cases)]
+                with ThreadPoolExecutor(max_workers=len(suite_chains)) as executor:
+                    list(executor.map(run_test_suite, suite_chains, test_suites, test_cases))
+                chat_chain.merge(suite_chains)
+            else:
+                for test_suite, cases in zip(test_suites, test_cases):
+                    run_test_suite(chat_chain, test_suite, cases)
+        finally:
+            # the extractions not started yet are not needed anymore
+            for future in chat_chain.chat_env.prefetched.values():
+                future.cancel()
     
     # ----------------------------------------
     #          Post Processing
     # ----------------------------------------
 
+    if chat_chain.chat_env.pending_batch:
+        # the result is written by the next run, once the batch answers are in the checkpoints
+        print(f"Requests collected into the batch, d4j{args.version}-{args.project}-{args.bugID} is pending!")
+        print("*" * 100)
+        return
+
     chat_chain.post_processing()
     print(f"Post processing finished!")
     print("*" * 100)
@@ -1,5 +1,8 @@
+import glob
+import json
 import os
 import subprocess
+import time
 
 from joblib import Parallel, delayed
 
@@ -190,12 +193,12 @@ D4J = {
 #     }
 # }
 
-def run_single_project(version, proj, bug_id, config, model, output_dir):
+def run_single_project(version, proj, bug_id, config, model, output_dir, env=None):
     cmd = f"python3 run.py --config {config} --version {version} --project {proj} --bugID {bug_id} --model {model} --output {output_dir}"
-    result = subprocess.run(cmd.split(" "))
+    result = subprocess.run(cmd.split(" "), env=env)
     return result.returncode
 
-def run_project(config, model, output_dir, num_jobs=None):
+def run_project(config, model, output_dir, num_jobs=None, env=None):
     jobs = []
     for version in D4J:
         for proj in D4J[version]:
@@ -209,7 +212,7 @@ def run_project(config, model, output_dir, num_jobs=None):
                 jobs.append((version, proj, bug_id, config, model, output_dir))
                 
     results = Parallel(n_jobs=num_jobs)(
-        delayed(run_single_project)(version, proj, bug_id, config, model, output_dir) 
+        delayed(run_single_project)(version, proj, bug_id, config, model, output_dir, env) 
         for version, proj, bug_id, config, model, output_dir in jobs
     )
     
@@ -218,6 +221,104 @@ def run_project(config, model, output_dir, num_jobs=None):
         return False
     return True
 
+def merge_batch_requests(batch_dir, max_requests=50000):
+    """
+    merge the requests collected by all bugs into batch input files of at most max_requests requests
+    Returns:
+        input_paths: the batch input files
+        manifest: custom_id => checkpoint file of the answer
+    """
+    manifest = {}
+    bodies = {}
+    for request_file in sorted(glob.glob(os.path.join(batch_dir, "requests", "*.jsonl"))):
+        with open(request_file, "r", encoding="utf8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                if os.path.exists(request["checkpoint"]):
+                    continue
+                manifest[request["custom_id"]] = request["checkpoint"]
+                bodies[request["custom_id"]] = request["body"]
+
+    input_paths = []
+    custom_ids = list(bodies)
+    for i in range(0, len(custom_ids), max_requests):
+        input_path = os.path.join(batch_dir, f"input_{i // max_requests}.jsonl")
+        with open(input_path, "w", encoding="utf8") as f:
+            for custom_id in custom_ids[i:i + max_requests]:
+                f.write(json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions",
+                                    "body": bodies[custom_id]}) + "\n")
+        input_paths.append(input_path)
+    return input_paths, manifest
+
+def write_batch_results(results, manifest):
+    """
+    write the answers of a batch to the checkpoints of their requests, the same as a single turn chatting
+    Returns:
+        the number of written checkpoints
+    """
+    from chatdev.utils import write_file_atomic
+    num_written = 0
+    for result in results:
+        checkpoint = manifest.get(result.get("custom_id"))
+        response = result.get("response") or {}
+        if checkpoint is None or response.get("status_code") != 200:
+            print(f"Batch request {result.get('custom_id')} failed: {result.get('error')}")
+            continue
+        content = response["body"]["choices"][0]["message"]["content"]
+        # a truncated checkpoint would count as answered in the next run
+        write_file_atomic(checkpoint, content.split("<INFO>")[-1])
+        num_written += 1
+    return num_written
+
+def run_project_batch(config, model, output_dir, num_jobs=None, batch_dir="batch", batch_backend=None,
+                      poll_interval=60):
+    """
+    run the project with the MethodReview requests answered by a batch (e.g., in nightly sweeps):
+    1. run all bugs, the MethodReview requests are collected into batch_dir instead of calling the API
+    2. submit the collected requests and poll until the batches are done
+    3. write the answers to the MethodReview checkpoints
+    4. run all bugs again, MethodReview loads its conclusions from the checkpoints, failed requests are sent directly
+    the submitted batch ids are kept in batch_dir/batches.json, so an interrupted sweep resumes polling
+    """
+    from camel.model_backend import OpenAIBatchBackend
+    from chatdev.utils import write_file_atomic
+    batch_dir = os.path.abspath(batch_dir)
+    batch_backend = batch_backend or OpenAIBatchBackend()
+    state_file = os.path.join(batch_dir, "batches.json")
+    os.makedirs(batch_dir, exist_ok=True)
+
+    if os.path.exists(state_file):
+        with open(state_file, "r") as f:
+            state = json.load(f)
+    else:
+        env = dict(os.environ, LLM_BATCH_DIR=batch_dir)
+        success = run_project(config, model, output_dir, num_jobs, env=env)
+        input_paths, manifest = merge_batch_requests(batch_dir)
+        print(f"{len(manifest)} requests collected in {len(input_paths)} batches")
+        if not manifest:
+            # no bug waits for a batch answer, the first run is the whole sweep
+            return success
+        state = {"manifest": manifest, "batches": [batch_backend.submit(path) for path in input_paths]}
+        write_file_atomic(state_file, json.dumps(state))
+
+    for batch_id in state["batches"]:
+        status = batch_backend.status(batch_id)
+        while status not in {"completed", "failed", "expired", "cancelled"}:
+            print(f"Batch {batch_id} is {status}, wait {poll_interval}s")
+            time.sleep(poll_interval)
+            status = batch_backend.status(batch_id)
+        print(f"Batch {batch_id} is {status}")
+        if status in {"completed", "expired"}:
+            num_written = write_batch_results(batch_backend.results(batch_id), state["manifest"])
+            print(f"{num_written} answers written to checkpoints")
+    os.remove(state_file)
+
+    env = dict(os.environ)
+    env.pop("LLM_BATCH_DIR", None)
+    return run_project(config, model, output_dir, num_jobs, env=env)
+
 def run_single():
     cmd = f"python run.py --config Default --version 1.4.0 --project Closure --bugID 26 --model GPT_3_5_TURBO --output Default_d4j140_GPT35_TURBO"
     result = subprocess.run(cmd.split(" "))
@@ -254,8 +355,11 @@ if __name__ == "__main__":
     # model = "GPT_3_5_TURBO"
     # output_dir = "results/NoTestFailureAnalysis_d4j140_GPT35_TURBO"
     
+    # with LLM_MAX_CONCURRENCY set, the requests in flight follow an adaptive window and num_jobs can be raised
     num_jobs = 8
     success = run_project(config, model, output_dir, num_jobs)
+    # the MethodReview requests answered by the discounted Batch API
+    # success = run_project_batch(config, model, output_dir, num_jobs, batch_dir=f"batch/{output_dir}")
     if not success:
         print("Project execution failed")
     # run_single()
\ No newline at end of file
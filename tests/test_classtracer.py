@@ -0,0 +1,97 @@
+"""
+Runs the classtracer agent jar of functions/classtracer/target on com.qyh.app.Main, the runs need `java` on PATH
+"""
+import os
+import shutil
+import subprocess
+import zipfile
+import zlib
+
+import pytest
+
+from functions import instrument
+from functions.instrument import agent_has_class, agent_options
+from functions.line_parser import parse_coverage
+
+CLASSTRACER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "functions", "classtracer")
+AGENT_JAR = os.path.join(CLASSTRACER_DIR, "target", "classtracer-1.0.jar")
+APP_CLASSES = ["com/qyh/app/Main.class", "com/qyh/app/Main$A.class", "com/qyh/app/Main$B.class"]
+
+requires_java = pytest.mark.skipif(shutil.which("java") is None, reason="java is not on PATH")
+
+
+@pytest.fixture
+def classes_dir(tmp_path):
+    # the classes of the app, outside of the agent jar which contains them too
+    classes_dir = tmp_path / "classes"
+    with zipfile.ZipFile(os.path.join(CLASSTRACER_DIR, "target", "original-classtracer-1.0.jar")) as jar:
+        for name in APP_CLASSES:
+            jar.extract(name, classes_dir)
+    return str(classes_dir)
+
+
+def run_agent(tmp_path, classes_dir, **scope):
+    output_dir = str(tmp_path / "output")
+    options = agent_options(AGENT_JAR, output_dir, classes_dir, **scope)
+    result = subprocess.run(["java", f"-javaagent:{AGENT_JAR}={options}", "-cp", classes_dir, "com.qyh.app.Main"],
+                            capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    inst_log = os.path.join(output_dir, "inst.log")
+    assert os.path.getsize(inst_log) > 0, result.stdout + result.stderr
+    return parse_coverage(inst_log, os.path.join(output_dir, "run.log"))
+
+
+def method_ids(classes):
+    # the methods of the inner classes are in their outer class
+    return {method.inst_id for java_class in classes for method in java_class.methods.values()}
+
+
+def test_agent_jar_is_up_to_date():
+    for class_name in ["TestHook", "BytecodeCache", "InstrumentScope"]:
+        assert agent_has_class(AGENT_JAR, f"com.qyh.agent.{class_name}")
+
+
+@requires_java
+def test_no_scope(tmp_path, classes_dir):
+    classes, covered_classes = run_agent(tmp_path, classes_dir)
+    assert len(method_ids(classes)) == 8
+    assert "com.qyh.app.Main$B::sayHello()" in method_ids(classes)
+    # all but minus and the constructor of Main are run
+    assert [(c.class_name, c.n_covered_methods) for c in covered_classes] == [("com.qyh.app.Main", 6)]
+
+
+@requires_java
+def test_include_exclude(tmp_path, classes_dir):
+    classes, covered_classes = run_agent(tmp_path, classes_dir, include=["com.qyh.app.*"],
+                                         exclude=["com.qyh.app.Main$B"])
+    assert len(method_ids(classes)) == 6
+    assert not any("Main$B" in method_id for method_id in method_ids(classes))
+    assert [(c.class_name, c.n_covered_methods) for c in covered_classes] == [("com.qyh.app.Main", 4)]
+
+
+@requires_java
+def test_classes(tmp_path, classes_dir):
+    # a simple name matches the class in any package, with its inner classes
+    classes, _ = run_agent(tmp_path, classes_dir, include=["org.other.*"], classes=["Main"])
+    assert len(method_ids(classes)) == 8
+
+
+@requires_java
+def test_cache_registry(tmp_path, classes_dir, monkeypatch):
+    # a registry with the ids of other runs and the torn line of a killed run
+    monkeypatch.setattr(instrument, "INST_CACHE_DIR", str(tmp_path / "cache"))
+    ids_log = os.path.join(instrument.project_cache_dir(classes_dir), "ids.log")
+    os.makedirs(os.path.dirname(ids_log))
+    with open(ids_log, "w") as f:
+        for i in range(1000):
+            signature = f"org.other.C{i}.m()V"
+            f.write(f"{signature} {zlib.crc32(signature.encode()):x}\n")
+        f.write("org.other.Torn.m(")
+    for _ in range(2):
+        classes, covered_classes = run_agent(tmp_path, classes_dir)
+        assert [(c.class_name, c.n_covered_methods) for c in covered_classes] == [("com.qyh.app.Main", 6)]
+        with open(tmp_path / "output" / "methods.log") as f:
+            assert [int(line.split(" ")[0]) for line in f] == list(range(1000, 1008))
+    with open(ids_log) as f:
+        lines = f.read().split("\n")
+    assert len(lines) == 1009 and lines[-1] == ""
@@ -0,0 +1,145 @@
+"""
+Tests of the instrumented runs of functions/instrument.py with a stand-in for defects4j
+"""
+import importlib
+import os
+import re
+import subprocess as sp
+import time
+
+import pytest
+
+from functions import instrument
+from functions.d4j import get_source_packages
+from functions.utils import run_cmd
+
+AGENT_JAR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "functions", "classtracer",
+                         "target", "classtracer-1.0.jar")
+
+
+class FakeDefects4J:
+    """
+    Writes the logs the agent would write for the tests of `-t`, except for the `crashed` tests in the runs of
+    their test class, and times out on the test classes in `stalled`
+    """
+
+    def __init__(self, crashed=(), stalled=()):
+        self.crashed = crashed
+        self.stalled = stalled
+        self.cmds = []
+
+    def __call__(self, cmd, cwd=None, timeout=None):
+        self.cmds.append(cmd)
+        if cmd.startswith("defects4j export"):
+            return "build/classes", ""
+        test_class, methods = re.search(r"-t (\S+)::(\S+) ", cmd).groups()
+        if test_class in self.stalled:
+            raise sp.TimeoutExpired(cmd, timeout)
+        output_dir = re.search(r"outputDir=([^,]+)", cmd).group(1)
+        per_test = ",perTest=true" in cmd
+        for method in methods.split(","):
+            test_name = f"{test_class}::{method}"
+            if per_test and test_name in self.crashed:
+                continue
+            test_dir = os.path.join(output_dir, test_name) if per_test else output_dir
+            os.makedirs(test_dir, exist_ok=True)
+            for log in ["inst.log", "run.log"]:
+                with open(os.path.join(test_dir, log), "w") as f:
+                    f.write(f"{test_class} {method}() void\n")
+        return "", ""
+
+
+@pytest.fixture
+def defects4j(monkeypatch):
+    def install(**kwargs):
+        fake = FakeDefects4J(**kwargs)
+        monkeypatch.setattr(instrument, "run_cmd", fake)
+        return fake
+    return install
+
+
+def test_suite_runs_each_test_class_in_the_harness(tmp_path, defects4j):
+    fake = defects4j(crashed=["a.ATest::test2"], stalled=["b.BTest"])
+    tests = ["a.ATest::test1", "a.ATest::test2", "b.BTest::test1"]
+    instrument.run_instrument_suite(tests, "buggy", str(tmp_path), AGENT_JAR)
+    runs = [cmd for cmd in fake.cmds if cmd.startswith("defects4j test")]
+    assert [re.search(r"-t (\S+)", cmd).group(1) for cmd in runs] == [
+        "a.ATest::test1,test2", "b.BTest::test1", "a.ATest::test2", "b.BTest::test1"]
+    assert all(",perTest=true" in cmd for cmd in runs[:2])
+    # the crashed test is run alone, the test of the stalled class times out again and has no logs
+    assert sorted(os.listdir(tmp_path / "a.ATest::test1")) == ["inst_src.log", "run_src.log"]
+    assert sorted(os.listdir(tmp_path / "a.ATest::test2")) == ["inst_src.log", "run_src.log"]
+    assert os.listdir(tmp_path / "b.BTest::test1") == []
+
+
+def test_finished_tests_are_not_run_again(tmp_path, defects4j):
+    fake = defects4j()
+    instrument.run_instrument_suite(["a.ATest::test1"], "buggy", str(tmp_path), AGENT_JAR)
+    instrument.run_instrument_suite(["a.ATest::test1", "a.ATest::test2"], "buggy", str(tmp_path), AGENT_JAR)
+    runs = [cmd for cmd in fake.cmds if cmd.startswith("defects4j test")]
+    assert [re.search(r"-t (\S+)", cmd).group(1) for cmd in runs] == ["a.ATest::test1", "a.ATest::test2"]
+
+
+def test_run_cmd_is_killed_after_the_timeout():
+    start = time.monotonic()
+    with pytest.raises(sp.TimeoutExpired):
+        run_cmd("sleep 30", timeout=0.2)
+    assert time.monotonic() - start < 10
+
+
+def test_each_project_has_its_own_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(instrument, "INST_CACHE_DIR", str(tmp_path / "cache"))
+    for bug in ["1", "2"]:
+        checkout_dir = tmp_path / "Lang" / bug / "buggy"
+        (checkout_dir / "target" / "classes").mkdir(parents=True)
+        (checkout_dir / "defects4j.build.properties").write_text(f"d4j.bug.id={bug}\nd4j.project.id=Lang\n")
+        assert instrument.project_cache_dir(str(checkout_dir / "target" / "classes")) == str(tmp_path / "cache" / "Lang")
+    other_dir = instrument.project_cache_dir(str(tmp_path / "classes"))
+    assert os.path.dirname(other_dir) == str(tmp_path / "cache") and other_dir != str(tmp_path / "cache" / "Lang")
+
+
+@pytest.fixture
+def environ(monkeypatch):
+    """
+    Sets the environment variables and reloads instrument.py, which reads them on import
+    """
+    def setenv(**variables):
+        for name in ["INST_INCLUDE", "INST_EXCLUDE", "INST_CACHE_DIR"]:
+            monkeypatch.delenv(name, raising=False)
+        for name, value in variables.items():
+            monkeypatch.setenv(name, value)
+        importlib.reload(instrument)
+
+    yield setenv
+    monkeypatch.undo()
+    importlib.reload(instrument)
+
+
+def test_agent_options(tmp_path, environ):
+    environ()
+    assert instrument.agent_options(AGENT_JAR, "tmp", "classes") == "outputDir=tmp,classesPath=classes"
+    assert instrument.agent_options(AGENT_JAR, "tmp", "classes", include=["com.example.*", "org.foo.Bar"],
+                                    exclude=["com.example.gen.*"], classes=["Bar", "Baz"], per_test=True) == (
+        "outputDir=tmp,classesPath=classes,include=com.example.*:org.foo.Bar,exclude=com.example.gen.*,"
+        "classes=Bar:Baz,perTest=true")
+
+
+def test_agent_options_from_the_environment(tmp_path, environ):
+    environ(INST_INCLUDE="com.example.*", INST_EXCLUDE="com.example.gen.*", INST_CACHE_DIR=str(tmp_path / "cache"))
+    cache_dir = instrument.project_cache_dir("classes")
+    assert cache_dir.startswith(str(tmp_path / "cache" / ""))
+    assert instrument.agent_options(AGENT_JAR, "tmp", "classes") == (
+        f"outputDir=tmp,classesPath=classes,include=com.example.*,exclude=com.example.gen.*,cacheDir={cache_dir}")
+    # the arguments take precedence over the environment
+    assert instrument.agent_options(AGENT_JAR, "tmp", "classes", include=["org.foo.*"], exclude=["org.foo.gen.*"]) == (
+        f"outputDir=tmp,classesPath=classes,include=org.foo.*,exclude=org.foo.gen.*,cacheDir={cache_dir}")
+
+
+def test_source_packages(tmp_path):
+    for path in ["src/org/apache/commons/lang3/StringUtils.java", "src/org/apache/commons/lang3/text/StrMatcher.java",
+                 "src/org/apache/commons/lang3/text/package.html", "src/com/other/Util.java"]:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text("")
+    assert get_source_packages(str(tmp_path), "src") == ["com.other.*", "org.apache.commons.lang3.*"]
+    (tmp_path / "src" / "Main.java").write_text("")
+    assert get_source_packages(str(tmp_path), "src") == []
@@ -0,0 +1,29 @@
+"""
+Tests of the coverage logs parsing of functions/line_parser.py
+"""
+import logging
+
+import pytest
+
+from functions.line_parser import parse_coverage
+
+
+def test_missing_inst_file_raises(tmp_path):
+    with pytest.raises(AssertionError):
+        parse_coverage(str(tmp_path / "inst.log"), str(tmp_path / "run.log"))
+
+
+def test_logs_of_a_killed_jvm(tmp_path, caplog):
+    # the run file is newer than the inst file and both end with a truncated line
+    inst_log = tmp_path / "inst.log"
+    inst_log.write_text("com.example.Foo a() int\ncom.example.Foo b() int\ncom.example.Fo")
+    run_log = tmp_path / "run.log"
+    run_log.write_text("com.example.Foo a() int\ncom.example.Bar c() void\ncom.example.Bar d()")
+    with caplog.at_level(logging.WARNING):
+        classes, covered_classes = parse_coverage(str(inst_log), str(run_log))
+    assert sorted(c.class_name for c in classes) == ["com.example.Bar", "com.example.Foo"]
+    assert sorted((c.class_name, c.n_covered_methods) for c in covered_classes) == [
+        ("com.example.Bar", 1), ("com.example.Foo", 1)]
+    assert [record.getMessage() for record in caplog.records] == [
+        f"Malformed line 3 of {inst_log}: 'com.example.Fo'",
+        f"Malformed line 3 of {run_log}: 'com.example.Bar d()'"]
@@ -0,0 +1,477 @@
+"""
+Tests of the OpenAI backend in camel/model_backend.py against a fake client, no API key or network is needed
+"""
+import asyncio
+import concurrent.futures
+import fcntl
+import importlib
+import json
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+import openai
+import pytest
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+from camel import model_backend
+from camel.model_backend import (AsyncOpenAIModel, ConcurrencyController, Hedger, OpenAIModel, RateLimiter,
+                                 ResponseCache, SingleFlight)
+from camel.typing import ModelType
+
+MODEL = ModelType.GPT_3_5_TURBO.value
+MESSAGES = [{"role": "system", "content": "You are a tester."}, {"role": "user", "content": "Review the method."}]
+
+
+def completion(content="The method is buggy.", completion_id="chatcmpl-fake"):
+    return ChatCompletion(id=completion_id, created=0, model="gpt-3.5-turbo", object="chat.completion",
+                          choices=[dict(index=0, finish_reason="stop",
+                                        message=dict(role="assistant", content=content))],
+                          usage=dict(prompt_tokens=10, completion_tokens=5, total_tokens=15))
+
+
+def http_response(status_code, headers=None):
+    # a response of the http package the SDK is built on, for the API errors
+    http = importlib.import_module(type(openai.DEFAULT_CONNECTION_LIMITS).__module__.split(".")[0])
+    request = http.Request("POST", "http://fake/v1/chat/completions")
+    return http.Response(status_code, headers=headers, request=request)
+
+
+class FakeSocket:
+    def __init__(self):
+        self.shut = threading.Event()
+
+    def shutdown(self, how):
+        self.shut.set()
+
+
+class FakeStream:
+    r"""A streamed answer, a stalled one never comes, its read only ends
+    when its socket is shut down."""
+
+    def __init__(self, content, stalled):
+        self.content = content
+        self.stalled = stalled
+        self.socket = FakeSocket()
+        self.closed = False
+        self.response = SimpleNamespace(is_closed=False, extensions={
+            "network_stream": SimpleNamespace(get_extra_info=lambda name: self.socket)})
+
+    def __iter__(self):
+        if self.stalled:
+            self.socket.shut.wait(5)
+            return
+        yield ChatCompletionChunk(id="chatcmpl-fake", created=0, model="gpt-3.5-turbo",
+                                  object="chat.completion.chunk",
+                                  choices=[dict(index=0, finish_reason="stop", delta=dict(content=self.content))])
+        yield ChatCompletionChunk(id="chatcmpl-fake", created=0, model="gpt-3.5-turbo",
+                                  object="chat.completion.chunk", choices=[],
+                                  usage=dict(prompt_tokens=10, completion_tokens=5, total_tokens=15))
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCompletions:
+    def __init__(self):
+        self.calls = []
+        self.streams = []
+        self.lock = threading.Lock()
+        # set by a test to hold the answers back
+        self.release = threading.Event()
+        self.release.set()
+        self.errors = []
+        # the numbers of the calls whose answer never comes
+        self.stalled = set()
+
+    def create(self, **kwargs):
+        with self.lock:
+            self.calls.append(kwargs)
+            number = len(self.calls)
+            error = self.errors.pop(0) if self.errors else None
+        self.release.wait(5)
+        if error is not None:
+            raise error
+        if kwargs.get("stream"):
+            stream = FakeStream("answer {}".format(number), number in self.stalled)
+            self.streams.append(stream)
+            return stream
+        return completion("answer {}".format(number))
+
+
+class FakeClient:
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=FakeCompletions())
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # no limits, no hedging and no cache unless a test enables them
+    monkeypatch.setattr(model_backend, "LLM_RPM", 0)
+    monkeypatch.setattr(model_backend, "LLM_TPM", 0)
+    monkeypatch.setattr(model_backend, "LLM_MAX_CONCURRENCY", 0)
+    monkeypatch.setattr(model_backend, "LLM_HEDGE_PERCENTILE", 0)
+    monkeypatch.setattr(model_backend, "LLM_CACHE_DIR", None)
+    monkeypatch.setattr(model_backend, "_rate_limiters", {})
+    monkeypatch.setattr(model_backend, "_concurrency_controllers", {})
+    monkeypatch.setattr(model_backend, "_response_cache", None)
+    monkeypatch.setattr(model_backend, "num_tokens_from_string", lambda string, model: len(string.split()))
+    client = FakeClient()
+    monkeypatch.setattr(model_backend, "_client", client)
+    return client
+
+
+@pytest.fixture
+def cache(monkeypatch, tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache"), 1024 * 1024)
+    monkeypatch.setattr(model_backend, "LLM_CACHE_DIR", cache.directory)
+    monkeypatch.setattr(model_backend, "_response_cache", cache)
+    return cache
+
+
+def make_model():
+    return OpenAIModel(ModelType.GPT_3_5_TURBO, {"temperature": 0.2})
+
+
+def test_cache_miss_then_hit(client, cache):
+    first = make_model().run(messages=MESSAGES)
+    second = make_model().run(messages=MESSAGES)
+    assert len(client.chat.completions.calls) == 1
+    assert second.choices[0].message.content == first.choices[0].message.content
+
+    make_model().run(messages=MESSAGES[:1])
+    assert len(client.chat.completions.calls) == 2
+
+
+def test_replay(client, cache):
+    make_model().run(messages=MESSAGES)
+    cache.replay = True
+    assert make_model().run(messages=MESSAGES).choices[0].message.content == "answer 1"
+    with pytest.raises(RuntimeError):
+        make_model().run(messages=MESSAGES[:1])
+    assert len(client.chat.completions.calls) == 1
+
+
+def test_lru_eviction(tmp_path):
+    cache = ResponseCache(str(tmp_path), 1024 * 1024)
+    cache.put("a1", completion())
+    size = os.path.getsize(cache._path("a1"))
+    # room for three entries
+    cache.max_bytes = 3 * size + size // 2
+    for key in ["a1", "b2", "c3"]:
+        cache.put(key, completion())
+        os.utime(cache._path(key), (time.time() - 100, time.time() - 100))
+    # a1 becomes the most recently used entry
+    assert cache.get("a1") is not None
+    cache.put("d4", completion())
+    assert cache.get("b2") is None
+    assert all(cache.get(key) is not None for key in ["a1", "c3", "d4"])
+
+
+def test_size_of_overwritten_entry(tmp_path):
+    cache = ResponseCache(str(tmp_path), 1024 * 1024)
+    cache.put("a1", completion())
+    for _ in range(5):
+        cache.put("a1", completion())
+    assert cache._size == os.path.getsize(cache._path("a1"))
+
+
+def test_orphaned_tmp_files_are_removed(tmp_path):
+    cache = ResponseCache(str(tmp_path), 1024 * 1024)
+    os.makedirs(os.path.dirname(cache._path("a1")))
+    orphan = cache._path("a1") + ".123.456.tmp"
+    writing = cache._path("a1") + ".789.456.tmp"
+    for path in [orphan, writing]:
+        with open(path, "w") as f:
+            f.write("{")
+    old = time.time() - 2 * ResponseCache.TMP_MAX_AGE
+    os.utime(orphan, (old, old))
+    cache.put("a1", completion())
+    assert not os.path.exists(orphan)
+    assert os.path.exists(writing)
+    assert cache._size == os.path.getsize(cache._path("a1"))
+
+
+def age_state(path, seconds):
+    # as if the last update of the shared state was ``seconds`` ago
+    with open(path) as f:
+        state = json.load(f)
+    state["time"] -= seconds
+    with open(path, "w") as f:
+        json.dump(state, f)
+
+
+def test_limiter_refills_requests(tmp_path):
+    limiter = RateLimiter(str(tmp_path / "model.json"), rpm=2, tpm=0)
+    assert limiter._reserve(10) == 0
+    assert limiter._reserve(10) == 0
+    assert limiter._reserve(10) == pytest.approx(30, abs=1)
+    # half a minute refills one request of two per minute
+    age_state(limiter.path, 30)
+    assert limiter._reserve(10) == 0
+    assert limiter._reserve(10) > 0
+
+
+def test_limiter_refills_tokens(tmp_path):
+    limiter = RateLimiter(str(tmp_path / "model.json"), rpm=0, tpm=600)
+    assert limiter._reserve(500) == 0
+    assert limiter._reserve(400) == pytest.approx(30, abs=1)
+    age_state(limiter.path, 30)
+    assert limiter._reserve(400) == 0
+    # the completion tokens put the bucket into debt
+    limiter.charge(300)
+    assert limiter._reserve(1) == pytest.approx(30.1, abs=1)
+    # a prompt larger than the budget waits for a full bucket, not forever
+    age_state(limiter.path, 120)
+    assert limiter._reserve(10000) == 0
+
+
+def test_limiter_shared_by_processes(tmp_path):
+    # a second limiter on the same file stands for another process
+    first = RateLimiter(str(tmp_path / "model.json"), rpm=1, tpm=0)
+    second = RateLimiter(str(tmp_path / "model.json"), rpm=1, tpm=0)
+    assert first._reserve(1) == 0
+    assert second._reserve(1) > 0
+    second.block(10)
+    age_state(first.path, 60)
+    assert first._reserve(1) == pytest.approx(10, abs=1)
+
+
+def test_window_is_halved_once_per_overload(tmp_path):
+    controller = ConcurrencyController(str(tmp_path / "model.concurrency.json"), 1, 16, 3.0)
+    with open(controller.path, "w") as f:
+        json.dump({"window": 8.0, "leases": {}, "last_decrease": 0, "latency": {}}, f)
+    leases = [controller.acquire() for _ in range(4)]
+    controller.release(leases[0], "MethodReview", 1.0, "overload")
+    assert controller.window() == 4
+    # the requests sent before the decrease do not decrease the window again
+    controller.release(leases[1], "MethodReview", 1.0, "overload")
+    controller.release(leases[2], "MethodReview", 1.0, "error")
+    assert controller.window() == 4
+    time.sleep(0.01)
+    lease = controller.acquire()
+    controller.release(lease, "MethodReview", 1.0, "overload")
+    assert controller.window() == 2
+    # the window stays within its bounds
+    controller.release(leases[3], "MethodReview", 1.0, "ok")
+    assert controller.window() == 2.5
+    for _ in range(3):
+        time.sleep(0.01)
+        controller.release(controller.acquire(), "MethodReview", 1.0, "overload")
+    assert controller.window() == 1
+
+
+def test_window_grows_with_answers_and_admits_its_size(tmp_path):
+    controller = ConcurrencyController(str(tmp_path / "model.concurrency.json"), 2, 3, 3.0)
+    leases = [controller._admit() for _ in range(3)]
+    assert leases[2] is None
+    # one answer grows the window by 1 / window
+    controller.release(leases[0], "MethodReview", 1.0, "ok")
+    assert controller.window() == 2.5
+    controller.release(leases[1], "MethodReview", 1.0, "ok")
+    assert controller.window() == 2.9
+    leases = [controller._admit() for _ in range(3)]
+    assert leases[2] is None
+    for lease in leases[:2]:
+        controller.release(lease, "MethodReview", 1.0, "ok")
+    assert controller.window() == 3
+
+
+def test_latency_spike_halves_the_window(tmp_path):
+    controller = ConcurrencyController(str(tmp_path / "model.concurrency.json"), 1, 64, 3.0)
+    for _ in range(30):
+        controller.release(controller.acquire(), "MethodReview", 1.0, "ok")
+    window = controller.window()
+    # the latencies are tracked per key, a slow phase is no spike of its own
+    controller.release(controller.acquire(), "TestBehaviorAnalysis", 5.0, "ok")
+    assert controller.window() > window
+    window = controller.window()
+    controller.release(controller.acquire(), "MethodReview", 5.0, "ok")
+    assert controller.window() == window / 2
+
+
+def test_leases_of_dead_processes_are_dropped(tmp_path):
+    controller = ConcurrencyController(str(tmp_path / "model.concurrency.json"), 1, 1, 3.0)
+    assert controller._admit() is not None
+    with open(controller.path) as f:
+        state = json.load(f)
+    # a pid beyond the pid range of the kernel is never alive
+    state["leases"] = {"4194305:0": 0}
+    with open(controller.path, "w") as f:
+        json.dump(state, f)
+    assert controller._admit() is not None
+
+
+def test_waits_for_the_state_file_do_not_block_the_loop(tmp_path):
+    limiter = RateLimiter(str(tmp_path / "model.json"), rpm=10, tpm=0)
+    controller = ConcurrencyController(str(tmp_path / "model.concurrency.json"), 1, 4, 3.0)
+
+    async def acquire():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.ensure_future(tick())
+        await limiter.aacquire(1)
+        await controller.aacquire()
+        ticker.cancel()
+        return ticks
+
+    # another process holds the lock of both state files for 0.3s
+    files = [open(path, "a") for path in [limiter.path, controller.path]]
+    for f in files:
+        fcntl.flock(f, fcntl.LOCK_EX)
+    timer = threading.Timer(0.3, lambda: [f.close() for f in files])
+    timer.start()
+    assert asyncio.run(acquire()) >= 10
+    timer.join()
+
+
+class CountingSingleFlight(SingleFlight):
+    def __init__(self):
+        super().__init__()
+        self.joined = threading.Semaphore(0)
+
+    def _join(self, key):
+        joined = super()._join(key)
+        self.joined.release()
+        return joined
+
+
+def test_concurrent_identical_prompts_are_coalesced(client, monkeypatch):
+    single_flight = CountingSingleFlight()
+    monkeypatch.setattr(model_backend, "_single_flight", single_flight)
+    client.chat.completions.release.clear()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
+        futures = [executor.submit(make_model().run, messages=MESSAGES) for _ in range(4)]
+        futures.append(executor.submit(make_model().run, messages=MESSAGES[:1]))
+        for _ in futures:
+            assert single_flight.joined.acquire(timeout=5)
+        client.chat.completions.release.set()
+        answers = [future.result().choices[0].message.content for future in futures]
+    # one request for the four identical prompts and one for the other prompt
+    assert len(client.chat.completions.calls) == 2
+    assert len(set(answers[:4])) == 1
+    assert answers[4] != answers[0]
+    assert single_flight._calls == {}
+
+
+def test_coalesced_callers_get_the_error_of_the_request(client, monkeypatch):
+    single_flight = CountingSingleFlight()
+    monkeypatch.setattr(model_backend, "_single_flight", single_flight)
+    client.chat.completions.release.clear()
+    client.chat.completions.errors.append(openai.BadRequestError("bad prompt", response=http_response(400),
+                                                                 body=None))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [executor.submit(make_model().run, messages=MESSAGES) for _ in range(3)]
+        for _ in futures:
+            assert single_flight.joined.acquire(timeout=5)
+        client.chat.completions.release.set()
+        for future in futures:
+            with pytest.raises(openai.BadRequestError):
+                future.result()
+    assert len(client.chat.completions.calls) == 1
+    # the failed request is not remembered
+    assert make_model().run(messages=MESSAGES).choices[0].message.content == "answer 2"
+
+
+def test_concurrent_identical_prompts_are_coalesced_async(client, monkeypatch):
+    calls = []
+
+    async def create(**kwargs):
+        calls.append(kwargs)
+        # the other coroutines of the gather join while the request is in flight
+        await asyncio.sleep(0.1)
+        return completion("answer {}".format(len(calls)))
+
+    async_client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    monkeypatch.setattr(model_backend, "get_async_openai_client", lambda: async_client)
+
+    async def review():
+        model = AsyncOpenAIModel(ModelType.GPT_3_5_TURBO, {"temperature": 0.2})
+        return await asyncio.gather(*[model.arun(messages=MESSAGES) for _ in range(4)])
+
+    answers = asyncio.run(review())
+    assert len(calls) == 1
+    assert {answer.choices[0].message.content for answer in answers} == {"answer 1"}
+
+
+def test_max_tokens_is_per_request(client):
+    model = OpenAIModel(ModelType.GPT_4, {"temperature": 0.2})
+    short = [{"role": "user", "content": "short prompt"}]
+    long = [{"role": "user", "content": "word " * 6000}]
+    client.chat.completions.release.clear()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(model.run, messages=messages) for messages in [long, short]]
+        while len(client.chat.completions.calls) < 2:
+            time.sleep(0.01)
+        client.chat.completions.release.set()
+        for future in futures:
+            future.result()
+    budgets = {len(call["messages"][0]["content"].split()): call["max_tokens"]
+               for call in client.chat.completions.calls}
+    # the 8192 tokens of GPT-4 less the prompt and 15 tokens per message
+    assert budgets == {6000: 8192 - 6015, 2: 8192 - 17}
+    assert "max_tokens" not in model.model_config_dict
+    assert model.make_request_body(short)["max_tokens"] == 8192 - 17
+    assert "max_tokens" not in model.model_config_dict
+
+
+@pytest.fixture
+def hedging(client, monkeypatch, tmp_path):
+    # the completions of MethodReview are hedged after 0.05s in flight, the requests wait 0.3s for the limiter
+    hedger = Hedger(percentile=50, budget=1.0, min_samples=1, window=10)
+    hedger.record((MODEL, "MethodReview"), 0.05, 1000)
+    monkeypatch.setattr(model_backend, "LLM_HEDGE_PERCENTILE", 50)
+    monkeypatch.setattr(model_backend, "_hedger", hedger)
+    limiter = RateLimiter(str(tmp_path / "model.json"), rpm=1000, tpm=0)
+    limiter.block(0.3)
+    controller = ConcurrencyController(str(tmp_path / "model.concurrency.json"), 4, 4, 3.0)
+    monkeypatch.setattr(model_backend, "_rate_limiters", {MODEL: limiter})
+    monkeypatch.setattr(model_backend, "_concurrency_controllers", {MODEL: controller})
+    return hedger, controller
+
+
+def in_flight(controller):
+    with open(controller.path) as f:
+        return json.load(f)["leases"]
+
+
+def test_losing_hedged_request_is_aborted(client, hedging):
+    hedger, controller = hedging
+    client.chat.completions.stalled.add(1)
+    start = time.monotonic()
+    response = make_model().run(messages=MESSAGES, latency_key="MethodReview")
+    assert time.monotonic() - start < 2
+    assert response.choices[0].message.content == "answer 2"
+    stalled = client.chat.completions.streams[0]
+    assert stalled.socket.shut.is_set()
+    assert in_flight(controller) == {}
+    # the latency of the duplicate, without the wait for the limiter
+    assert hedger._latencies[(MODEL, "MethodReview")][-1] < 0.25
+    time.sleep(0.1)
+    assert stalled.closed
+
+
+def test_losing_hedged_request_is_cancelled_async(client, hedging, monkeypatch):
+    hedger, controller = hedging
+    calls = []
+
+    async def create(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            await asyncio.sleep(10)
+        return completion("answer {}".format(len(calls)))
+
+    async_client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    monkeypatch.setattr(model_backend, "get_async_openai_client", lambda: async_client)
+    model = AsyncOpenAIModel(ModelType.GPT_3_5_TURBO, {"temperature": 0.2})
+    response = asyncio.run(model.arun(messages=MESSAGES, latency_key="MethodReview"))
+    assert response.choices[0].message.content == "answer 2"
+    assert in_flight(controller) == {}
+    assert hedger._latencies[(MODEL, "MethodReview")][-1] < 0.25
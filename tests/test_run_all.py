@@ -0,0 +1,68 @@
+"""
+Tests of the batch sweep of run_all.py with a stand-in for the bug runs
+"""
+import json
+import os
+
+import pytest
+
+import run_all
+
+
+class FailingBackend:
+    def submit(self, input_path):
+        raise AssertionError("nothing should be submitted")
+
+
+@pytest.fixture
+def runs(monkeypatch):
+    runs = []
+
+    def run_project(config, model, output_dir, num_jobs=None, env=None):
+        runs.append(env.get("LLM_BATCH_DIR"))
+        return True
+
+    monkeypatch.setattr(run_all, "run_project", run_project)
+    return runs
+
+
+def test_sweep_without_requests(tmp_path, runs):
+    batch_dir = tmp_path / "batch"
+    assert run_all.run_project_batch("Default", "GPT_3_5_TURBO", str(tmp_path / "out"), batch_dir=str(batch_dir),
+                                     batch_backend=FailingBackend())
+    assert runs == [str(batch_dir)]
+    assert not os.path.exists(batch_dir / "batches.json")
+
+
+def test_batch_results_are_written_to_checkpoints(tmp_path):
+    checkpoint = tmp_path / "bug" / "checkpoint" / "MethodReview_1.txt"
+    manifest = {"request-1": str(checkpoint), "request-2": str(tmp_path / "bug" / "checkpoint" / "other.txt")}
+    results = [
+        {"custom_id": "request-1", "error": None,
+         "response": {"status_code": 200, "body": {"choices": [{"message": {"content": "thinking <INFO> #8# it"}}]}}},
+        {"custom_id": "request-2", "response": None, "error": {"code": "RateLimitError", "message": "slow down"}},
+    ]
+    assert run_all.write_batch_results(results, manifest) == 1
+    assert checkpoint.read_text() == " #8# it"
+    assert os.listdir(checkpoint.parent) == ["MethodReview_1.txt"]
+
+
+def test_interrupted_sweep_resumes_polling(tmp_path, runs):
+    batch_dir = tmp_path / "batch"
+    checkpoint = tmp_path / "checkpoint.txt"
+    batch_dir.mkdir()
+    (batch_dir / "batches.json").write_text(json.dumps({"manifest": {"request-1": str(checkpoint)},
+                                                         "batches": ["batch_1"]}))
+
+    class DoneBackend:
+        def status(self, batch_id):
+            return "completed"
+
+        def results(self, batch_id):
+            return [{"custom_id": "request-1", "error": None,
+                     "response": {"status_code": 200, "body": {"choices": [{"message": {"content": "#3#"}}]}}}]
+
+    assert run_all.run_project_batch("Default", "GPT_3_5_TURBO", str(tmp_path / "out"), batch_dir=str(batch_dir),
+                                     batch_backend=DoneBackend())
+    assert checkpoint.read_text() == "#3#"
+    assert runs == [None]
@@ -0,0 +1,50 @@
+"""
+Tests of the post info of chatdev/statistics.py, from the usage ledger or from the log of an older run
+"""
+import json
+
+from chatdev.statistics import get_cost, get_info
+
+LOG = """[2024-01-01 00:00:00 INFO] **[Start Chat]**
+[2024-01-01 00:00:01 INFO] **[OpenAI_Usage_Info Receive]**
+prompt_tokens: 1000
+completion_tokens: 100
+total_tokens: 1100
+cached_tokens: 400
+
+[2024-01-01 00:00:02 INFO] **[OpenAI_Usage_Info Receive]**
+prompt_tokens: 500
+completion_tokens: 50
+total_tokens: 550
+cached_tokens: 0
+"""
+
+
+def info_value(info, name):
+    return info.split("**{}**=".format(name))[1].split("\n")[0]
+
+
+def test_usage_of_a_run_without_ledger(tmp_path):
+    log = tmp_path / "run.log"
+    log.write_text(LOG)
+    info = get_info(str(tmp_path), str(log), str(tmp_path / "run.usage.jsonl"))
+    assert info_value(info, "num_prompt_tokens") == "1500"
+    assert info_value(info, "num_completion_tokens") == "150"
+    assert info_value(info, "num_total_tokens") == "1650"
+    assert info_value(info, "num_cached_tokens") == "400"
+    assert info_value(info, "num_model_calls") == "2"
+    assert info_value(info, "cost") == "${:.6f}".format(get_cost(1500, 150, 400))
+
+
+def test_usage_of_the_ledger(tmp_path):
+    log = tmp_path / "run.log"
+    log.write_text(LOG)
+    ledger = tmp_path / "run.usage.jsonl"
+    row = {"phase": "MethodReview", "prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15,
+           "cached_tokens": 0, "hedged_prompt_tokens": 0, "latency": 1.0, "queue_wait": 0.0, "retries": 0,
+           "cache_hit": False, "coalesced": False}
+    ledger.write_text(json.dumps(row) + "\n")
+    info = get_info(str(tmp_path), str(log), str(ledger))
+    assert info_value(info, "num_prompt_tokens") == "10"
+    assert info_value(info, "num_model_calls") == "1"
+    assert info_value(info, "cost[MethodReview]") == "${:.6f}".format(get_cost(10, 5))
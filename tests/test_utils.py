@@ -0,0 +1,45 @@
+"""
+Tests of the memoized token counting of camel/utils.py
+"""
+import pytest
+
+from camel import utils
+
+
+class FakeEncoding:
+    def __init__(self):
+        self.calls = 0
+
+    def encode(self, text):
+        self.calls += 1
+        return text.split()
+
+
+@pytest.fixture
+def encoding(monkeypatch):
+    encoding = FakeEncoding()
+    monkeypatch.setattr(utils, "get_encoding", lambda model_name: encoding)
+    monkeypatch.setattr(utils, "_token_counts", utils.OrderedDict())
+    return encoding
+
+
+def test_counts_are_memoized(encoding):
+    prompt = "a prompt of six tokens " * 1000
+    assert utils.num_tokens_from_string(prompt, "gpt-4") == 5000
+    assert utils.num_tokens_from_string("".join(prompt), "gpt-4") == 5000
+    assert encoding.calls == 1
+    assert utils.num_tokens_from_string(prompt, "gpt-3.5-turbo") == 5000
+    assert encoding.calls == 2
+
+
+def test_memo_is_bounded_and_keeps_no_prompts(encoding, monkeypatch):
+    monkeypatch.setattr(utils, "_TOKEN_COUNTS_SIZE", 2)
+    for text in ["one", "two two", "three three three"]:
+        utils.num_tokens_from_string(text, "gpt-4")
+    assert len(utils._token_counts) == 2
+    assert all(len(digest) == 16 for digest, _ in utils._token_counts)
+    # the least recently used count was dropped
+    assert utils.num_tokens_from_string("one", "gpt-4") == 1
+    assert encoding.calls == 4
+    assert utils.num_tokens_from_string("three three three", "gpt-4") == 3
+    assert encoding.calls == 4